@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# Purpose:
+# Microbenchmarks of the hot paths of libbuckets and libc2f on synthetic bucket
+# names and bucket trees, offline and without Splunk. Reports CPU time, peak
+# memory and the memory blocks left allocated per case. With --save the results
+# become a baseline, --compare fails if a case got slower or bigger than it.
+
+from __future__ import print_function
+from lib import libc2f
+from lib import libbuckets
+from lib import libbench
+import os, sys
+import argparse
+import random
+import shutil
+import tempfile
+
+# Bucket ends are spread over ten years before this time
+NOW = 1700000000
+GUID = '5B3E1F2A-9C41-4D6B-8E2F-1A2B3C4D5E6F'
+
+def bucket_names(count: int) -> list:
+    rnd = random.Random(count)
+    names = []
+    for bucket_id in range(count):
+        end = NOW - rnd.randrange(0, 10 * 365 * 86400)
+        names.append('db_%s_%s_%s_%s' % (end, end - rnd.randrange(3600, 86400), bucket_id, GUID))
+    return names
+
+def bucket_index(count: int):
+    buckets = libbuckets.BucketIndex(index='bench')
+    for bucket_name in bucket_names(count):
+        buckets.add(bucket_name)
+    return buckets
+
+def make_bucket(root: str, files: int, size: int = 0) -> str:
+    """ A bucket with files tsidx and data files beside rawdata/journal.gz """
+    bucket = tempfile.mkdtemp(prefix='db_', dir=root)
+    os.mkdir(os.path.join(bucket, 'rawdata'))
+    data = os.urandom(size // 2) * 2
+    with open(os.path.join(bucket, 'rawdata', 'journal.gz'), 'wb') as f:
+        f.write(data)
+    for n in range(files):
+        name = '%s.tsidx' % n if n % 2 == 0 else '%s.data' % n
+        with open(os.path.join(bucket, name), 'wb') as f:
+            f.write(data)
+    return bucket
+
+def cases(names: list, files: list, root: str) -> list:
+    """ (case, func, setup) of every benchmark """
+    result = []
+    for count in names:
+        bucket_list = bucket_names(count)
+        buckets = bucket_index(count)
+        result.append(('bucket_parse[%s]' % count, lambda arg, bucket_list=bucket_list: [libbuckets.Bucket(name=name) for name in bucket_list], None))
+        result.append(('index_add[%s]' % count, lambda arg, bucket_list=bucket_list: [arg.add(name) for name in bucket_list], lambda: libbuckets.BucketIndex(index='bench')))
+        result.append(('filter[%s]' % count, lambda arg, buckets=buckets: buckets.filter(NOW - 400 * 86400, NOW - 300 * 86400), None))
+        result.append(('older[%s]' % count, lambda arg, buckets=buckets: buckets.older(365), None))
+        result.append(('kvout[%s]' % count, lambda arg, bucket_list=bucket_list: [log_event(name).kvout() for name in bucket_list], None))
+    for count in files:
+        bucket = make_bucket(root, count)
+        result.append(('getBucketSize[%s]' % count, lambda arg, bucket=bucket: libc2f.getBucketSize(bucket), None))
+        result.append(('handleNewBucket[%s]' % count, lambda arg: libc2f.handleNewBucket(arg, os.listdir(arg)), lambda count=count: make_bucket(root, count)))
+        # Old-style buckets are few, but their files are large
+        oldfiles = max(2, count // 100)
+        result.append(('handleOldBucket[%s:%sx1MB]' % (count, oldfiles), lambda arg: libc2f.handleOldBucket(arg, os.listdir(arg)), lambda oldfiles=oldfiles: make_bucket(root, oldfiles, 1024 * 1024)))
+    return result
+
+def log_event(bucket_name: str):
+    """ A logDict with the fields of an archive event of cold2frozen.py """
+    logFields = libc2f.logDict()
+    logFields.add('status', 'archived')
+    logFields.add('bucketname', bucket_name)
+    logFields.add('indexname', 'bench')
+    logFields.add('sourcedir', '/opt/splunk/var/lib/splunk/bench/colddb/' + bucket_name)
+    logFields.add('targetdir', '/archive/bench/' + bucket_name)
+    logFields.add('bucketsize_b', 123456789)
+    logFields.add('copytime_ms', 1234.567)
+    for n in range(20):
+        logFields.add('t_span%s_ms' % n, n * 1.5)
+    return logFields
+
+def main():
+
+    # Argument Parser
+    parser = argparse.ArgumentParser(description='Microbenchmarks of libbuckets and libc2f')
+    parser.add_argument('-n','--names', metavar='counts', dest='names', type=str, help='Comma separated numbers of bucket names', required=False, default='1000,100000,1000000')
+    parser.add_argument('-f','--files', metavar='counts', dest='files', type=str, help='Comma separated numbers of files per synthetic bucket', required=False, default='100,10000')
+    parser.add_argument('-r','--repeat', metavar='repeat', dest='repeat', type=int, help='Timed runs per case, the best one counts', required=False, default=3)
+    parser.add_argument('-k','--filter', metavar='substring', dest='filter', type=str, help='Only run the cases containing this substring', required=False)
+    parser.add_argument('-s','--save', metavar='baselinefile', dest='save', type=str, help='Save the results as a baseline', required=False)
+    parser.add_argument('-c','--compare', metavar='baselinefile', dest='compare', type=str, help='Compare the results with a baseline, exit 1 on a regression', required=False)
+    parser.add_argument('-t','--threshold', metavar='percent', dest='threshold', type=float, help='Allowed growth of CPU time and peak memory against the baseline in percent', required=False, default=20)
+    parser.add_argument('-w','--workdir', metavar='workdir', dest='workdir', type=str, help='Directory for the synthetic bucket trees', required=False)
+
+    args = parser.parse_args()
+
+    baseline = libbench.load(args.compare) if args.compare else {}
+    root = tempfile.mkdtemp(prefix='c2f_bench_', dir=args.workdir)
+    results = {}
+    try:
+        names = [int(count) for count in args.names.split(',') if count]
+        files = [int(count) for count in args.files.split(',') if count]
+        print("%-28s %12s %12s %12s %14s %10s" % ('case', 'cpu_ms', 'wall_ms', 'peak_kb', 'alloc_blocks', 'vs_base'))
+        for case, func, setup in cases(names, files, root):
+            if args.filter and args.filter not in case:
+                continue
+            result = libbench.measure(func, setup, args.repeat)
+            results[case] = result
+            change = ''
+            if case in baseline and baseline[case]['cpu_ms'] > 0:
+                change = '%+.1f%%' % ((result['cpu_ms'] / baseline[case]['cpu_ms'] - 1) * 100)
+            print("%-28s %12s %12s %12s %14s %10s" % (case, result['cpu_ms'], result['wall_ms'], result['peak_kb'], result['alloc_blocks'], change), flush=True)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    if args.save:
+        libbench.save(results, args.save)
+        print("Saved baseline %s" % args.save)
+    if args.compare:
+        regressions = libbench.compare(results, baseline, args.threshold)
+        for case, metric, base, current in regressions:
+            print("REGRESSION: %s %s %s -> %s" % (case, metric, base, current))
+        if regressions:
+            sys.exit('%s regression(s) of more than %s%% against %s' % (len(regressions), args.threshold, args.compare))
+        print("No regressions against %s" % args.compare)
+
+if __name__ == "__main__":
+    main()
+    sys.exit()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+# Purpose:
+# Migrates archived buckets from the backend of one config file to the backend
+# of another one, e.g. from dir to s3, without thawing them. Buckets are copied
+# in parallel, verified against their checksums on the target and recorded in a
+# checkpoint file, so an interrupted migration continues where it stopped.
+
+from __future__ import print_function
+from lib import libc2f
+from lib import libmigrate
+from lib import libverify
+from lib import libmetrics
+import os, sys
+import argparse
+import logging, logging.handlers
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Verify SPLUNK_HOME
+libc2f.verifySplunkHome()
+SPLUNK_HOME = os.environ['SPLUNK_HOME']
+
+# Create Logger
+from lib import liblogger
+logger = liblogger.setup_logging('splunk.cold2frozen')
+
+# To enable debugging
+#logger.setLevel(logging.DEBUG)
+
+def main():
+
+    # Define the App Path
+    app_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+    logger.debug('Starting main()')
+
+    # Argument Parser
+    parser = argparse.ArgumentParser(description='Migrate archived buckets to another backend')
+    parser.add_argument('-t','--target-config', metavar='configfile', dest='target_config', type=str, help='config file of the target backend, e.g. cold2frozen_s3.conf', required=True)
+    parser.add_argument('-c','--config', metavar='configfile', dest='configfile', type=str, help='config file of the source backend', default='cold2frozen.conf', required=False)
+    parser.add_argument('-i','--index', metavar='index', dest='index', type=str, help='Index(es)', action='append', nargs='*', required=False)
+    parser.add_argument('-p','--numprocs', metavar='numprocs', dest='numprocs', type=int, help='Number of buckets migrated in parallel, the maximum with --target-mbps', required=False, default=4)
+    parser.add_argument('-k','--checkpoint', metavar='checkpointfile', dest='checkpoint', type=str, help='Skip the buckets listed in this file and add every migrated one, resumes an interrupted run', required=False)
+    parser.add_argument('-w','--workdir', metavar='workdir', dest='workdir', type=str, help='Directory for buckets downloaded from a non-dir source (default: target archive dir or temp dir)', required=False)
+    parser.add_argument('--size-only', dest='size_only', action="store_true", help='Verify the sizes only, do not compare checksums')
+    parser.add_argument('--target-mbps', metavar='mbps', dest='target_mbps', type=float, help='Throughput target in MB/s, the buckets in flight are adjusted toward it between 1 and --numprocs', required=False, default=0)
+    parser.add_argument('--progress', metavar='seconds', dest='progress', type=int, help='Interval of the progress events', required=False, default=60)
+    parser.add_argument('-r','--dryrun', action="store_true", help='Only print the buckets to migrate')
+
+    args = parser.parse_args()
+
+    # Read in config files
+    config = libc2f.readConfig(app_path, args.configfile)
+    target_config = libc2f.readConfig(app_path, args.target_config)
+    # Get the storage handlers
+    source = libc2f.connStorage(config)
+    target = libc2f.connStorage(target_config)
+    # s3 archives are the same if the bucket matches too
+    if source.type == target.type and source.archive_dir == target.archive_dir and (source.type != 's3' or source.s3_bucket == target.s3_bucket):
+        msg = 'Source and target are the same archive %s' % source.archive_dir
+        logger.error(msg)
+        sys.exit(msg)
+    # Get the metrics exporter
+    metrics = libmetrics.fromConfig(config)
+
+    workdir = args.workdir
+    if workdir is None:
+        # Downloads to the target filesystem are moved into the archive by reflink or copy_file_range
+        workdir = target.archive_dir if target.type == 'dir' else tempfile.gettempdir()
+    if not os.access(workdir, os.W_OK):
+        msg = 'Cannot write to directory %s' % workdir
+        logger.error(msg)
+        sys.exit(msg)
+
+    index_list = libc2f.listIndexes(source)
+    if args.index:
+        for index in args.index[0]:
+            if index not in index_list:
+                print("ERROR: Index '%s' does not exist on storage" % index)
+                sys.exit(1)
+        index_list = [index for index in index_list if index in args.index[0]]
+
+    checkpoint = libverify.VerifyCheckpoint(args.checkpoint)
+    local = threading.local()
+    counts = {}
+    counts_lock = threading.Lock()
+    remaining_b = 0
+
+    def migrate_locked(index: str, bucket_name: str, size: int) -> str:
+        # boto3 resources must not be shared between threads
+        if not hasattr(local, 'source'):
+            local.source = libc2f.connStorage(config)
+            local.target = libc2f.connStorage(target_config)
+        # The lock keeps a cold2frozen.py archiving to the target from copying the same bucket
+        lock_file = os.path.join(index, bucket_name.split('_', 1)[1] + '.lock')
+        local.target.create_index_dir(index)
+        if not libc2f.getLock(local.target, lock_file, timeout=10):
+            return 'lock_timeout'
+        renewer = libc2f.LockRenewer(local.target, lock_file)
+        renewer.start()
+        try:
+            return libmigrate.migrate_bucket(local.source, local.target, index, bucket_name, size, workdir, hash_pool, not args.size_only)
+        finally:
+            renewer.stop()
+            libc2f.releaseLock(local.target, lock_file)
+
+    def migrate(index: str, bucket_name: str, size: int) -> None:
+        nonlocal remaining_b
+        logFields = libc2f.logDict()
+        logFields.add('status', None)
+        logFields.add('indexname', index)
+        logFields.add('bucketname', bucket_name)
+        logFields.add('bucketsize_b', size)
+        migratestart = time.time()
+        # Connecting and locking fail like the copy, getLock exits on a stale s3 lock
+        try:
+            status = migrate_locked(index, bucket_name, size)
+        except (Exception, SystemExit) as ex:
+            logger.error('Failed to migrate bucket=%s: %s', bucket_name, ex)
+            status = 'failed'
+        seconds = time.time() - migratestart
+        logFields.add('status', status)
+        logFields.add('migratetime_ms', round(seconds * 1000, 3))
+        logFields.add('mbps', round(size / 1024 / 1024 / seconds, 3) if seconds > 0 and status == 'migrated' else 0)
+        if status.startswith('failed'):
+            logger.error(logFields.kvout())
+        else:
+            logger.info(logFields.kvout())
+        metrics.record('migrate', {'index': index, 'backend': target.type}, status, seconds, size if status == 'migrated' else None)
+        if status in ('migrated', 'existed'):
+            checkpoint.record(index, bucket_name)
+        if status == 'migrated':
+            throughput.add(size)
+        with counts_lock:
+            counts[status] = counts.get(status, 0) + 1
+            remaining_b -= size
+
+    def migrate_released(index: str, bucket_name: str, size: int) -> None:
+        try:
+            migrate(index, bucket_name, size)
+        finally:
+            throughput.release()
+
+    # One listing with sizes per index, the buckets of the whole run are known before copying
+    todo = []
+    for index in index_list:
+        with libc2f.span('list'):
+            bucket_info = libc2f.listBucketsInfo(source, index)
+        for bucket_name, info in sorted(bucket_info.items()):
+            if checkpoint.done(index, bucket_name):
+                logger.debug("Skipping migrated bucket %s/%s", index, bucket_name)
+                continue
+            if args.dryrun:
+                print("(Dryrun) Migrate bucket (size_b: %s) %s" % (info['size'], os.path.join(index,bucket_name)))
+                continue
+            todo.append((index, bucket_name, info['size']))
+            remaining_b += info['size']
+
+    # Hashing of dir targets in threads, hashlib releases the GIL for large updates
+    hash_pool = ThreadPoolExecutor(max_workers=args.numprocs)
+    done = threading.Event()
+    throughput = libmigrate.Throughput(args.numprocs, args.target_mbps)
+
+    def progress() -> None:
+        while not done.wait(args.progress):
+            logFields = libc2f.logDict()
+            logFields.add('status', 'progress')
+            for key, value in throughput.interval(remaining_b).items():
+                logFields.add(key, value)
+            logger.info(logFields.kvout())
+
+    progress_thread = threading.Thread(target=progress, daemon=True)
+    progress_thread.start()
+    migratestart = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=args.numprocs, thread_name_prefix='migrate') as pool:
+            futures = {}
+            for index, bucket_name, size in todo:
+                # Submitted as the throughput target allows, the pool runs at most numprocs
+                throughput.acquire()
+                futures[pool.submit(migrate_released, index, bucket_name, size)] = bucket_name
+        # Errors after the migration itself, e.g. of the checkpoint, count as failed
+        for future, bucket_name in futures.items():
+            try:
+                future.result()
+            except Exception as ex:
+                logger.error('Failed to record migrated bucket=%s: %s', bucket_name, ex)
+                with counts_lock:
+                    counts['failed'] = counts.get('failed', 0) + 1
+    finally:
+        done.set()
+        hash_pool.shutdown()
+    seconds = time.time() - migratestart
+
+    # Totals of the whole run
+    failed = sum(count for status, count in counts.items() if status.startswith('failed') or status == 'lock_timeout')
+    logFields = libc2f.logDict()
+    logFields.add('status', 'summary')
+    logFields.add('bucketcount', len(todo))
+    for status, count in sorted(counts.items()):
+        logFields.add(status, count)
+    logFields.add('migrated_b', throughput.total_b)
+    logFields.add('migratetime_ms', round(seconds * 1000, 3))
+    logFields.add('mbps', throughput.mbps())
+    logFields.addstats(total=True)
+    logger.info(logFields.kvout())
+    metrics.flush()
+
+    if not args.dryrun:
+        print("Migrated %s bytes of %s bucket(s) in %.1f s (%s MB/s)" % (throughput.total_b, len(todo), seconds, throughput.mbps()))
+    if failed:
+        sys.exit('Migration failed for %s bucket(s), run again to retry' % failed)
+
+if __name__ == "__main__":
+    main()
+    sys.exit()
@@ -3,13 +3,14 @@
 from __future__ import print_function
 from lib import libc2f
 from lib import libbuckets
+from lib import librebuild
+from lib import libmetrics
 import os, sys
 import argparse
-import subprocess
-import re
 import logging
 import time
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Value
+from queue import Empty
 from io import open
 from six.moves import range
 
@@ -24,76 +25,62 @@ logger = liblogger.setup_logging('splunk.cold2frozen')
 # To enable debugging
 #logger.setLevel(logging.DEBUG)
 
-# Create queue
+# Create queues
 queue = Queue()
-
-def parse_output(output):
-    output = output.split("\n")
-    for line in output:
-        for level in [r'INFO',r'WARN',r'ERROR']:
-            p = re.compile(level)
-            if p.findall(line):
-                msg = line
-                if level == 'INFO' or level == 'WARN':
-                    return msg
-                if level == 'ERROR':
-                    skip = re.compile(r'IndexConfig - Asked to check if idx= is an index')
-                    if not skip.findall(line):
-                        return msg
-
-def worker(workerid: int, thaweddir: str):
+results = Queue()
+
+def acquire_slot(limit, active):
+    # Wait until the number of running rebuilds is below the current limit
+    while True:
+        with active.get_lock():
+            if active.value < limit.value:
+                active.value += 1
+                return
+        time.sleep(0.5)
+
+def release_slot(active):
+    with active.get_lock():
+        active.value -= 1
+
+def worker(workerid: int, thaweddir: str, limit, active, nice, ionice, timeout):
     logger.debug('Starting worker(), workerid: %s', workerid)
-    global queue
-    while not queue.empty():
+    global queue, results
+    while True:
+        acquire_slot(limit, active)
         bucketname = queue.get()
-        rebuild_bucket(workerid, bucketname, thaweddir)
-
-
-def rebuild_bucket(workerid: int, bucketname: str, thaweddir: str):
-    logFields = libc2f.logDict()
-    logFields.add('status', 'rebuilt')
-    logger.debug('Starting rebuild_bucket(), workerid: %s, bucketname: %s' % (workerid, bucketname))
-    logFields.add('bucketname', bucketname)
-    logger.debug("bucketname is %s" % bucketname)
-    destdir = os.path.join(thaweddir, bucketname)
-    logFields.add('destdir', destdir)
-    logger.debug("destdir is %s" % destdir)
-    msg = '%s: START - Rebuilding bucket %s' % (workerid, bucketname)
-    print(msg, flush=True)
-    bucket_size_source = libc2f.getBucketSize(os.path.join(thaweddir,bucketname))
-    logFields.add('bucketsize_b', bucket_size_source)
-    # Run the rebuild command
-    rebuildstart = time.time() * 1000
-    process = subprocess.run(['splunk', 'rebuild', os.path.join(thaweddir,bucketname)],capture_output=True)
-    rebuildend = time.time() * 1000
-    bucket_size_full = libc2f.getBucketSize(os.path.join(thaweddir,bucketname))
-    logFields.add('bucketsize_full_b', bucket_size_full)
-    logFields.add('rebuildtime_ms', round(rebuildend - rebuildstart,3))
-
-    if process.returncode == 0:
-        status = 'SUCCESS'
-        logFields.add('status', 'rebuilt')
-    else:
-        status = 'ERROR'
-        logFields.add('status', 'failed_rebuilt')
-    # Parse the output
-    # Unfortunately, the command outputs all to stderr
-    output = process.stderr.decode('utf-8')
-    outmsg = parse_output(output)
-    msg = '%s: %s - Rebuilding bucket %s\n%s' % (workerid, status, bucketname, outmsg)
-    print(msg, flush=True)
-    if outmsg and len(outmsg) > 0:
-        logFields.add('output', "'" + outmsg + "'")
-    logger.info(logFields.kvout())
-
+        # One stop marker per worker follows the last bucket
+        if bucketname is None:
+            release_slot(active)
+            break
+        rebuildstart = time.time()
+        try:
+            status, reason = librebuild.rebuild_bucket(workerid, bucketname, thaweddir, nice=nice, ionice=ionice, timeout=timeout)
+        except Exception as ex:
+            logger.error('Failed to rebuild bucket=%s: %s', bucketname, ex)
+            status, reason = 'failed_rebuilt', 'exception'
+        release_slot(active)
+        results.put((bucketname, status, reason, time.time() - rebuildstart))
 
 def main():
+
+    # Define the App Path
+    app_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
     logger.debug('Starting main()')
 
     # Argument Parser
     parser = argparse.ArgumentParser(description='Rebuild Frozen Buckets')
     parser.add_argument('-t','--thaweddb', metavar='thaweddb', dest='thaweddb', type=str, help='Thaweddb Directory', required=True)
-    parser.add_argument('-p','--numprocs', metavar='numprocs', dest='numprocs', type=int, help='Number of processes', required=False, default=1)
+    parser.add_argument('-p','--numprocs', metavar='numprocs', dest='numprocs', type=int, help='Number of processes (maximum with --adaptive)', required=False, default=1)
+    parser.add_argument('-a','--adaptive', action="store_true", help='Adapt the number of processes to the system pressure')
+    parser.add_argument('--minprocs', metavar='minprocs', dest='minprocs', type=int, help='Minimum number of processes with --adaptive', required=False, default=1)
+    parser.add_argument('--pressure-high', metavar='percent', dest='pressure_high', type=float, help='Lower the processes above this pressure (default: 40 for PSI, 90 for load average)', required=False, default=None)
+    parser.add_argument('--pressure-low', metavar='percent', dest='pressure_low', type=float, help='Raise the processes below this pressure (default: 10 for PSI, 60 for load average)', required=False, default=None)
+    parser.add_argument('--interval', metavar='seconds', dest='interval', type=int, help='Seconds between concurrency adjustments', required=False, default=10)
+    parser.add_argument('--nice', metavar='nice', dest='nice', type=int, help='Nice increment for the rebuild processes', required=False, default=None)
+    parser.add_argument('--ionice', metavar='class', dest='ionice', type=int, choices=[1, 2, 3], help='IO scheduling class for the rebuild processes (1: realtime, 2: best-effort, 3: idle)', required=False, default=None)
+    parser.add_argument('--timeout', metavar='seconds', dest='timeout', type=int, help='Kill a rebuild after this many seconds (0 = no timeout)', required=False, default=0)
+    parser.add_argument('-f','--force', action="store_true", help='Rebuild also buckets which have been rebuilt already')
 
     args = parser.parse_args()
 
@@ -112,6 +99,16 @@ def main():
         logger.error(msg)
         sys.exit(msg)
 
+    # Metrics exporter, the config is optional on hosts which only rebuild
+    metrics = libmetrics.Metrics()
+    if os.path.isfile(os.path.join(app_path, 'local', 'cold2frozen.conf')):
+        metrics = libmetrics.fromConfig(libc2f.readConfig(app_path))
+    # The thawed directory is usually $SPLUNK_DB/<index>/thaweddb
+    metrics_labels = {'index': os.path.basename(os.path.dirname(os.path.abspath(THAWED_DIR))), 'backend': 'thawed'}
+
+    # Rebuild results of earlier runs
+    state = librebuild.RebuildState(THAWED_DIR)
+
     buckets = libbuckets.BucketIndex(index='restored')
     for object in os.scandir(THAWED_DIR):
         if not os.path.isdir(object):
@@ -119,20 +116,60 @@ def main():
         bucket_name = object.name
         buckets.add(bucket_name)
    
-    # Put all the bucketnames to the queue
+    # Put all the bucketnames to the queue, skip the finished ones
+    queued = 0
     for bucket_obj in buckets:
+        if not args.force and state.done(THAWED_DIR, bucket_obj.name):
+            librebuild.skip_bucket(bucket_obj.name, THAWED_DIR)
+            continue
         queue.put(bucket_obj.name)
+        queued += 1
+
+    for workerid in range(args.numprocs):
+        queue.put(None)
+
+    # Shared process limit, fixed unless running adaptive
+    controller = None
+    if args.adaptive:
+        controller = librebuild.ConcurrencyController(args.minprocs, args.numprocs, args.pressure_high, args.pressure_low)
+        limit = Value('i', controller.minprocs)
+    else:
+        limit = Value('i', args.numprocs)
+    active = Value('i', 0)
 
     jobs = []
     for workerid in range(args.numprocs):
-        process = Process(target=worker, args=(workerid,THAWED_DIR))
+        process = Process(target=worker, args=(workerid,THAWED_DIR,limit,active,args.nice,args.ionice,args.timeout))
         jobs.append(process)
 
     for job in jobs:
         job.start()
 
+    # Checkpoint every result, the results queue must be drained before joining
+    failed = 0
+    nextadjust = time.time() + args.interval
+    while queued > 0:
+        if controller and time.time() >= nextadjust:
+            limit.value = controller.adjust(limit.value, active.value)
+            nextadjust = time.time() + args.interval
+        try:
+            bucketname, status, reason, seconds = results.get(timeout=1)
+        except Empty:
+            if not any(job.is_alive() for job in jobs):
+                break
+            continue
+        state.record(bucketname, status, reason)
+        metrics.record('rebuild', metrics_labels, status, seconds)
+        queued -= 1
+        if status != 'rebuilt':
+            failed += 1
+
     for job in jobs:
         job.join()
+    metrics.flush()
+
+    if failed:
+        sys.exit('Rebuild failed for %s bucket(s), rerun to retry them' % failed)
 
 if __name__ == "__main__":
     main()
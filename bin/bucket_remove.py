@@ -3,6 +3,8 @@
 from __future__ import print_function
 from lib import libc2f
 from lib import libbuckets
+from lib import libretention
+from lib import libmetrics
 import os, sys
 import argparse
 import datetime
@@ -20,6 +22,9 @@ logger = liblogger.setup_logging('splunk.cold2frozen')
 # To enable debugging
 #logger.setLevel(logging.DEBUG)
 
+# Metrics exporter, replaced in main() if METRICS_FILE is configured
+metrics = libmetrics.Metrics()
+
 def main():
 
     # Define the App Path
@@ -30,13 +35,56 @@ def main():
     # Argument Parser
     parser = argparse.ArgumentParser(description='Remove Frozen Buckets')
     parser.add_argument('-i','--index', metavar='index', dest='index', type=str, help='Index(es)', action='append', nargs='*', required=False)
-    parser.add_argument('-d','--days', metavar='days', dest='days', type=str, help='older than days', required=True)
-    parser.add_argument('-t','--usectime', action="store_true", help='Filesystem creation date')
+    parser.add_argument('-d','--days', metavar='days', dest='days', type=str, help='older than days', required=False)
+    parser.add_argument('-t','--usectime', action="store_true", help='Archive date (filesystem creation date for dir, upload date for s3)')
     parser.add_argument('-r','--dryrun', action="store_true", help='Do not delete the buckets')
+    parser.add_argument('-w','--plan', metavar='planfile', dest='plan', type=str, help='Write the buckets to remove to a plan file, do not delete them', required=False)
+    parser.add_argument('-x','--execute', metavar='planfile', dest='execute', type=str, help='Remove the buckets of a plan file, resumes an interrupted run', required=False)
+    parser.add_argument('-p','--numprocs', metavar='numprocs', dest='numprocs', type=int, help='Number of parallel deletions with --execute, parallel listings with --policy', required=False, default=1)
+    parser.add_argument('-o','--policy', action="store_true", help='Apply the retention policies of cold2frozen.conf instead of --days')
 
     args = parser.parse_args()
 
+    # Read in config file
+    config = libc2f.readConfig(app_path)
+    # Get the metrics exporter
+    global metrics
+    metrics = libmetrics.fromConfig(config)
+
+    # Execute a plan written earlier
+    if args.execute:
+        plan = libretention.read_plan(args.execute)
+        failed = libretention.execute_plan(config, plan, args.execute, args.numprocs, dryrun=args.dryrun, metrics=metrics)
+        if failed:
+            print("ERROR: Failed to remove %s bucket(s), run again to retry" % failed)
+            sys.exit(1)
+        return
+
+    # Retention policies, evaluated in one pass and removed by the plan executor
+    if args.policy:
+        storage = libc2f.connStorage(config)
+        index_list = libc2f.listIndexes(storage)
+        if args.index:
+            for index in args.index[0]:
+                if index not in index_list:
+                    print("ERROR: Index '%s' does not exist on storage" % index)
+                    sys.exit(1)
+            index_list = [index for index in index_list if index in args.index[0]]
+        plan = libretention.build_policy_plan(config, storage, index_list, args.numprocs)
+        if args.plan:
+            libretention.write_plan(plan, args.plan)
+            libretention.print_plan(plan)
+            return
+        failed = libretention.execute_plan(config, plan, numprocs=args.numprocs, dryrun=args.dryrun, metrics=metrics)
+        if failed:
+            print("ERROR: Failed to remove %s bucket(s)" % failed)
+            sys.exit(1)
+        return
+
     # Check Arguments
+    if args.days is None:
+        print("ERROR: Argument days is required unless a plan is executed or policies are applied!")
+        sys.exit(1)
     if not args.days.isdigit():
         msg = "ERROR: Argument days=%s must be a number!" % args.days
         print(msg)
@@ -49,15 +97,9 @@ def main():
     # Create logFields Object
     logFields = libc2f.logDict()
 
-    # Read in config file
-    config = libc2f.readConfig(app_path)
     # Get the storage handler
     storage = libc2f.connStorage(config)
 
-    if args.usectime and storage.type != 'dir':
-        print("ERROR: Bucket remove based on ctime for storage type %s is not supported" % storage.type)
-        sys.exit(1)
-
     logFields.add('status', None)
 
     index_list = libc2f.listIndexes(storage)
@@ -69,54 +111,70 @@ def main():
                 print("ERROR: Index '%s' does not exist on storage" % index)
                 sys.exit(1)
 
+    # Write a plan for a later execution
+    if args.plan:
+        plan_indexes = [index for index in index_list if not args.index or index in args.index[0]]
+        plan = libretention.build_plan(storage, plan_indexes, int(args.days), args.usectime)
+        libretention.write_plan(plan, args.plan)
+        libretention.print_plan(plan)
+        return
+
     if not args.usectime:
         for index in index_list:
             if args.index and index not in args.index[0]:
                 continue
-            logger.debug("Scanning Index %s" % index)
+            logger.debug("Scanning Index %s", index)
             # Initialize bucket container object
             buckets = libbuckets.BucketIndex(index=index)
-            # Add all the buckets to the container
-            bucket_list = libc2f.listBuckets(storage, index)
-            for bucket_name in bucket_list:
-                buckets.add(bucket_name)
+            # Add all the buckets to the container, the S3 listing has the sizes already
+            with libc2f.span('list'):
+                bucket_info = libc2f.listBucketsInfo(storage, index, sizes=False)
+            for bucket_name, info in bucket_info.items():
+                buckets.add(bucket_name, size=info['size'], archived=info['archived'])
 
             # Loop through the filtered objects
             for bucket_obj in buckets.older(int(args.days)):
+                libc2f.stats_reset()
                 logFields.add('bucketname', bucket_obj.name)
-                logger.debug("bucketname is %s" % bucket_obj.name)
+                logger.debug("bucketname is %s", bucket_obj.name)
                 logFields.add('indexname', buckets.index)
-                logger.debug("indexname is %s" % buckets.index)
+                logger.debug("indexname is %s", buckets.index)
                 bucket_epoch_end = bucket_obj.end
                 logFields.add('bucketend', bucket_epoch_end)
-                logger.debug("bucket_epoch_end is %s" % bucket_epoch_end)
+                logger.debug("bucket_epoch_end is %s", bucket_epoch_end)
                 bucket_epoch_start = bucket_obj.start
                 logFields.add('bucketstart', bucket_epoch_start)
-                logger.debug("bucket_epoch_start is %s" % bucket_epoch_start)
+                logger.debug("bucket_epoch_start is %s", bucket_epoch_start)
                 bucket_name_prefix = bucket_obj.prefix
                 logFields.add('bucketprefix', bucket_name_prefix)
-                logger.debug("bucket_name_prefix is %s" % bucket_name_prefix)
+                logger.debug("bucket_name_prefix is %s", bucket_name_prefix)
                 logFields.add('peerguid', bucket_obj.peer)
-                logger.debug("peer_guid is %s" % bucket_obj.peer)
+                logger.debug("peer_guid is %s", bucket_obj.peer)
                 bucket_id = bucket_obj.id
                 logFields.add('bucketid', bucket_id)
-                normalized_bucket_name_array = bucket_name.split("_")[1:]
+                normalized_bucket_name_array = bucket_obj.name.split("_")[1:]
                 normalized_bucket_name = "_".join(normalized_bucket_name_array)
                 logFields.add('buckename_norm', normalized_bucket_name)
-                logger.debug("normalized_bucket_name is %s" % normalized_bucket_name)
+                logger.debug("normalized_bucket_name is %s", normalized_bucket_name)
 
                 destdir = libc2f.bucketDir(storage, os.path.join(buckets.index,bucket_obj.name))
                 logFields.add('destdir', destdir)
-                bucket_size_source = libc2f.getBucketSizeTarget(storage, os.path.join(buckets.index,bucket_obj.name))
+                bucket_size_source = bucket_obj.size
+                if bucket_size_source is None:
+                    with libc2f.span('size_target'):
+                        bucket_size_source = libc2f.getBucketSizeTarget(storage, os.path.join(buckets.index,bucket_obj.name))
                 logFields.add('bucketsize_b', bucket_size_source)
 
                 if not args.dryrun:
                     rmstart = time.time() * 1000
-                    libc2f.removeBucket(storage, index, bucket_obj.name)
+                    with libc2f.span('remove'):
+                        libc2f.removeBucket(storage, index, bucket_obj.name)
                     rmend = time.time() * 1000
                     logFields.add('rmtime_ms', round(rmend - rmstart,3))
                     logFields.add('status', 'removed')
-                    logger.debug("status is %s" % 'removed')
+                    metrics.record('remove', {'index': index, 'backend': storage.type}, 'removed', (rmend - rmstart) / 1000, bucket_size_source)
+                    logger.debug("status is %s", 'removed')
+                    logFields.addstats()
                     logger.info(logFields.kvout())
                 else:
                     bucket_enddate = datetime.datetime.strftime(datetime.datetime.fromtimestamp(bucket_obj.end), "%d.%m.%Y %H:%M:%S")
@@ -127,34 +185,48 @@ def main():
         for index in index_list:
             if args.index and index not in args.index[0]:
                 continue
-            index_dir = os.path.join(storage.archive_dir, index)
-            for object in os.scandir(index_dir):
-                bucket_name = object.name
-                if not bucket_name.startswith('db_') and not bucket_name.startswith('rb_'):
-                    continue
-                bucket_dir = os.path.join(index_dir, object.name)
-                bucket_stats = os.stat(bucket_dir)
-                logger.debug("bucketname=%s, destdir=%s %s" % (bucket_name, bucket_dir, bucket_stats))
-                
-                if datetime.datetime.fromtimestamp(bucket_stats.st_ctime) < check_tstamp:
-                    destdir = os.path.join(index_dir,bucket_name)
+            # Archive times come from one listing: the directory ctime for dir,
+            # the LastModified of the objects for s3
+            with libc2f.span('list'):
+                bucket_info = libc2f.listBucketsInfo(storage, index, sizes=False)
+            for bucket_name, info in bucket_info.items():
+                bucket_dir = libc2f.bucketDir(storage, os.path.join(index,bucket_name))
+                bucket_ctime = info['archived']
+                logger.debug("bucketname=%s, destdir=%s, archived=%s", bucket_name, bucket_dir, bucket_ctime)
+
+                if datetime.datetime.fromtimestamp(bucket_ctime) < check_tstamp:
+                    destdir = bucket_dir
                     logFields.add('destdir', destdir)
-                    logger.debug("destdir is %s" % destdir)
+                    logger.debug("destdir is %s", destdir)
                     logFields.add('indexname', index)
-                    logger.debug("indexname is %s" % index)
-                    logFields.add('bucket_create_date', int(bucket_stats.st_ctime))
-                    logger.debug("bucket_create_date is %s" % int(bucket_stats.st_ctime))
+                    logger.debug("indexname is %s", index)
+                    logFields.add('bucket_create_date', int(bucket_ctime))
+                    logger.debug("bucket_create_date is %s", int(bucket_ctime))
                     logFields.add('check_date', int(datetime.datetime.timestamp(check_tstamp)))
-                    logger.debug("check_date is %s" % int(datetime.datetime.timestamp(check_tstamp)))
+                    logger.debug("check_date is %s", int(datetime.datetime.timestamp(check_tstamp)))
                     if not args.dryrun:
-                        libc2f.removeBucket(storage, index, bucket_name)
+                        libc2f.stats_reset()
+                        rmstart = time.time()
+                        with libc2f.span('remove'):
+                            libc2f.removeBucket(storage, index, bucket_name)
                         logFields.add('status', 'removed')
-                        logger.debug("status is %s" % 'removed')
+                        metrics.record('remove', {'index': index, 'backend': storage.type}, 'removed', time.time() - rmstart, info['size'])
+                        logger.debug("status is %s", 'removed')
+                        logFields.addstats()
                         logger.info(logFields.kvout())
                     else:
-                        bucket_date = datetime.datetime.strftime(datetime.datetime.fromtimestamp(bucket_stats.st_ctime), "%d.%m.%Y %H:%M:%S")
+                        bucket_date = datetime.datetime.strftime(datetime.datetime.fromtimestamp(bucket_ctime), "%d.%m.%Y %H:%M:%S")
                         print("(Dryrun) Remove bucket (ctime: %s) %s" % (bucket_date,bucket_dir))
 
+def log_summary():
+    # Totals of the whole run, including listings and plan execution
+    logFields = libc2f.logDict()
+    logFields.add('status', 'summary')
+    logFields.addstats(total=True)
+    logger.info(logFields.kvout())
+    metrics.flush()
+
 if __name__ == "__main__":
     main()
+    log_summary()
     sys.exit()
@@ -3,10 +3,19 @@
 from __future__ import print_function
 from lib import libc2f
 from lib import libbuckets
+from lib import librebuild
+from lib import libmetrics
+from lib import libcompress
+from lib import libcache
+from lib import libtarstream
+from lib import libplan
 import os, sys
 import argparse
 import logging, logging.handlers
 import time
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 # Verify SPLUNK_HOME
@@ -20,6 +29,260 @@ logger = liblogger.setup_logging('splunk.cold2frozen')
 # To enable debugging
 #logger.setLevel(logging.DEBUG)
 
+# Metrics exporter, replaced in main() if METRICS_FILE is configured
+metrics = libmetrics.Metrics()
+# Restore cache, replaced in main() if RESTORE_CACHE_DIR is configured
+cache = libcache.RestoreCache()
+
+def restore_bucket(storage, index: str, bucket_name: str, restoredir: str, stats: bool = True, decompress: int = 0, size=None) -> str:
+    """ Restore one bucket into restoredir and verify its size, returns the status.
+        Concurrent callers pass stats=False, the span and request fields are per process.
+        With decompress > 0 the compressed index files of old-style buckets are
+        decompressed afterwards with that many threads. The archived size is
+        looked up unless the listing has given it. """
+    if stats:
+        libc2f.stats_reset()
+    logFields = libc2f.logDict()
+    logFields.add('status', None)
+    logFields.add('bucketname', bucket_name)
+    logFields.add('indexname', index)
+    sourcedir = libc2f.bucketDir(storage, os.path.join(index,bucket_name))
+    logFields.add('sourcedir', sourcedir)
+    targetdir = os.path.join(restoredir,bucket_name)
+    logFields.add('targetdir', targetdir)
+    bucket_size_source = size
+    if bucket_size_source is None:
+        with libc2f.span('size_source'):
+            bucket_size_source = libc2f.getBucketSizeTarget(storage, os.path.join(index,bucket_name))
+
+    if os.path.isdir(targetdir):
+        with libc2f.span('size_walk'):
+            bucket_size = libc2f.getBucketSize(targetdir)
+        # A decompressed bucket is bigger than the archived one, its marker has the archived size
+        if decompress and libcompress.decompressed_size(targetdir) == bucket_size_source:
+            bucket_size = bucket_size_source
+        if bucket_size == bucket_size_source:
+            logFields.add('restoretime_ms', 0)
+            logFields.add('bucketsize_b', bucket_size)
+            logFields.add('status', 'existed')
+            msg = "Found existing bucket %s" % sourcedir
+            print(msg, flush=True)
+            if stats:
+                logFields.addstats()
+            logger.info(logFields.kvout())
+            return 'existed'
+        else:
+            msg = "Found existing bucket with different size (will extract again) %s" % sourcedir
+            print(msg, flush=True)
+    logFields.add('status', 'restored')
+    metrics_labels = {'index': index, 'backend': storage.type}
+    restorestart = time.time() * 1000
+    with libc2f.span('cache'):
+        cached = cache.serve(index, bucket_name, bucket_size_source, restoredir)
+    if cache.enabled:
+        logFields.add('cache', 'hit' if cached else 'miss')
+    if cached:
+        msg = "Restoring bucket %s from cache" % sourcedir
+        print(msg, flush=True)
+    else:
+        msg = "Restoring bucket %s" % sourcedir
+        print(msg, flush=True)
+        metrics.start('restore', metrics_labels)
+        try:
+            with libc2f.span('restore'):
+                libc2f.restoreBucket(storage, index, bucket_name, restoredir)
+        finally:
+            metrics.finish('restore', metrics_labels)
+    restoreend = time.time() * 1000
+    # Cache hits are labelled apart, they would skew the restore latencies
+    metrics.observe('c2f_operation_seconds', dict(metrics_labels, op='restore_cached' if cached else 'restore'), (restoreend - restorestart) / 1000)
+    logFields.add('restoretime_ms', round(restoreend - restorestart,3))
+    with libc2f.span('size_walk'):
+        bucket_size = libc2f.getBucketSize(targetdir)
+    logFields.add('bucketsize_b', bucket_size)
+    if stats:
+        logFields.addstats()
+    if bucket_size != bucket_size_source:
+        logFields.add('status', 'failed_size')
+        metrics.inc('c2f_operations', dict(metrics_labels, op='restore', status='failed_size'))
+        logger.info(logFields.kvout())
+        msg = 'Restored bucket sizes differ sourcebucket=%s (sourcesize=%s) targetbucket=%s (targetsize=%s)' % (sourcedir, bucket_size_source, targetdir, bucket_size)
+        logger.error(msg)
+        return 'failed_size'
+    # The cache keeps the bucket as archived, decompression replaces the cloned files
+    if not cached:
+        with libc2f.span('cache'):
+            cache.insert(index, bucket_name, bucket_size_source, restoredir)
+    if decompress:
+        with libc2f.span('decompress'):
+            decompress_stats = libc2f.decompressBucket(targetdir, decompress)
+        libcompress.mark_decompressed(targetdir, bucket_size_source)
+        libcompress.logstats(logFields, decompress_stats, 'decompress')
+        if stats:
+            logFields.addstats()
+    metrics.inc('c2f_operations', dict(metrics_labels, op='restore', status='restored'))
+    metrics.inc('c2f_bytes', dict(metrics_labels, op='restore'), bucket_size)
+    logger.info(logFields.kvout())
+    return 'restored'
+
+def prefetch_buckets(storage, index: str, buckets) -> int:
+    """ Restore buckets into the cache only, returns the number of buckets fetched """
+    fetched = 0
+    for bucket_obj in buckets:
+        bucket_name = bucket_obj.name
+        size = libc2f.getBucketSizeTarget(storage, os.path.join(index,bucket_name))
+        if cache.contains(index, bucket_name, size):
+            continue
+        workdir = cache.workdir()
+        try:
+            with libc2f.span('prefetch'):
+                libc2f.restoreBucket(storage, index, bucket_name, workdir)
+            if libc2f.getBucketSize(os.path.join(workdir,bucket_name)) != size:
+                logger.warning('Prefetched bucket sizes differ bucket=%s, not caching it', bucket_name)
+                continue
+            cache.insert(index, bucket_name, size, workdir)
+            fetched += 1
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return fetched
+
+class RebuildBacklog:
+    """ Bytes of restored buckets waiting for or running a rebuild, bounded by a disk budget """
+
+    def __init__(self, budget: int):
+        self._budget = budget
+        self._used = 0
+        self._cond = threading.Condition()
+
+    def reserve(self, size: int) -> None:
+        # Always admit a bucket into an empty backlog, otherwise a bucket larger
+        # than the budget would block forever
+        with self._cond:
+            waitstart = time.time()
+            while self._budget > 0 and self._used > 0 and self._used + size > self._budget:
+                self._cond.wait()
+            if time.time() - waitstart > 0.1:
+                logger.debug("Restore waited %.1fs for rebuild backlog (used=%s, budget=%s)", time.time() - waitstart, self._used, self._budget)
+            self._used += size
+
+    def release(self, size: int) -> None:
+        with self._cond:
+            self._used -= size
+            self._cond.notify_all()
+
+def restore_rebuild(config, index: str, buckets, restoredir: str, restoreprocs: int, rebuildprocs: int, backlog_budget: int, rebuild_timeout=0, decompress=0) -> int:
+    """ Restore buckets and hand each one to a rebuild worker as soon as it is verified, returns the failure count """
+    backlog = RebuildBacklog(backlog_budget)
+    state = librebuild.RebuildState(restoredir)
+    local = threading.local()
+    failed = []
+
+    def rebuild(bucket_name: str, size: int, existed: bool) -> None:
+        try:
+            # A freshly restored bucket is always rebuilt, the state may be from an older copy
+            if existed and state.done(restoredir, bucket_name):
+                librebuild.skip_bucket(bucket_name, restoredir)
+                return
+            status, reason = librebuild.rebuild_bucket(threading.current_thread().name, bucket_name, restoredir, timeout=rebuild_timeout)
+            state.record(bucket_name, status, reason)
+            if status != 'rebuilt':
+                failed.append(bucket_name)
+        except Exception as ex:
+            logger.error('Failed to rebuild bucket=%s: %s', bucket_name, ex)
+            failed.append(bucket_name)
+        finally:
+            backlog.release(size)
+
+    def restore(bucket_name: str, size) -> None:
+        reserved = False
+        try:
+            # boto3 resources must not be shared between threads, so every
+            # download thread gets its own storage handler
+            if not hasattr(local, 'storage'):
+                local.storage = libc2f.connStorage(config)
+            if size is None:
+                size = libc2f.getBucketSizeTarget(local.storage, os.path.join(index,bucket_name))
+            backlog.reserve(size)
+            reserved = True
+            status = restore_bucket(local.storage, index, bucket_name, restoredir, stats=False, decompress=decompress, size=size)
+        except (Exception, SystemExit) as ex:
+            logger.error('Failed to restore bucket=%s: %s', bucket_name, ex)
+            status = 'failed'
+        if status in ('restored', 'existed'):
+            rebuild_pool.submit(rebuild, bucket_name, size, status == 'existed')
+        else:
+            failed.append(bucket_name)
+            if reserved:
+                backlog.release(size)
+
+    with ThreadPoolExecutor(max_workers=rebuildprocs, thread_name_prefix='rebuild') as rebuild_pool:
+        with ThreadPoolExecutor(max_workers=restoreprocs, thread_name_prefix='restore') as restore_pool:
+            futures = {restore_pool.submit(restore, bucket_obj.name, bucket_obj.size): bucket_obj.name for bucket_obj in buckets}
+        for future, bucket_name in futures.items():
+            try:
+                future.result()
+            except Exception as ex:
+                logger.error('Failed to restore bucket=%s: %s', bucket_name, ex)
+                failed.append(bucket_name)
+
+    return len(failed)
+
+def list_selected(storage, index: str, start_tstamp: int, end_tstamp: int):
+    """ The buckets of the index and those of the time range with their sizes, and
+        the object count per selected bucket. s3 returns the sizes with its listing,
+        a dir archive is only walked for the selected buckets. """
+    buckets = libbuckets.BucketIndex(index=index)
+    with libc2f.span('list'):
+        bucket_info = libc2f.listBucketsInfo(storage, index, sizes=storage.type != 'dir')
+    for bucket_name, info in bucket_info.items():
+        buckets.add(bucket_name, size=info['size'], archived=info['archived'])
+    selected = buckets.filter(start_tstamp, end_tstamp)
+    if storage.type != 'dir':
+        return buckets, selected, {bucket_obj.name: bucket_info[bucket_obj.name]['objects'] for bucket_obj in selected}
+    sized = libbuckets.BucketIndex(index=index, name='filtered')
+    objects = {}
+    with libc2f.span('size_source'):
+        for bucket_obj in selected:
+            bucket_files = storage.bucket_files(index, bucket_obj.name)
+            sized.add(bucket_obj.name, size=sum(entry['size'] for entry in bucket_files.values()), archived=bucket_obj.archived)
+            objects[bucket_obj.name] = len(bucket_files)
+    return buckets, sized, objects
+
+def print_plan(plan) -> None:
+    print("Plan: %s bucket(s), %s bytes, %s objects, estimated %s s at %s MB/s" % (len(plan.admitted), plan.bytes, plan.objects, plan.estimate_s, plan.mbps))
+    print("      %s bytes needed on the target at an expansion of %s" % (plan.needed_b, plan.expansion))
+    print("      %s bucket(s) restored already, %s bucket(s) do not fit (free: %s bytes, limit: %s bytes)" % (len(plan.existing), len(plan.deferred), plan.free_b, plan.limit_b))
+
+def stream_tar(storage, index: str, buckets, args) -> None:
+    """ Writes the buckets as one tar stream, nothing is stored locally """
+    outputs, tar = libtarstream.open_output(args.tar, args.tar_compress)
+    streamstart = time.time()
+    try:
+        result = libtarstream.write_tar(storage, index, [bucket_obj.name for bucket_obj in buckets], tar, args.stream_threads, args.stream_memory * 1024 * 1024)
+        tar.close()
+        for fileobj in outputs:
+            fileobj.close()
+    except BrokenPipeError:
+        msg = 'Reader of the tar stream went away'
+        logger.error(msg)
+        # Python flushes stdout at exit, which would fail again on the closed pipe
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(msg)
+    seconds = time.time() - streamstart
+    logFields = libc2f.logDict()
+    logFields.add('status', 'streamed')
+    logFields.add('indexname', index)
+    logFields.add('bucketcount', buckets.len())
+    logFields.add('files', result['files'])
+    logFields.add('streamed_b', result['bytes'])
+    logFields.add('compression', args.tar_compress)
+    logFields.add('streamtime_ms', round(seconds * 1000, 3))
+    logFields.add('mbps', round(result['bytes'] / 1024 / 1024 / seconds, 3) if seconds > 0 else 0)
+    logFields.addstats(total=True)
+    logger.info(logFields.kvout())
+    metrics.record('stream', {'index': index, 'backend': storage.type}, 'streamed', seconds, result['bytes'])
+    metrics.flush()
+
 def main():
 
     # Define the App Path
@@ -32,8 +295,26 @@ def main():
     parser.add_argument('-i','--index', metavar='index', dest='index', type=str, help='Index Name', required=True)
     parser.add_argument('-s','--start', metavar='startdate', dest='startdate', type=str, help='start day: DDMMYYYY', required=True)
     parser.add_argument('-e','--end', metavar='enddate', dest='enddate', type=str, help='end day: DDMMYYYY', required=True)
-    parser.add_argument('-t','--target', metavar='targetdir', dest='targetdir', type=str, help='target directory', required=True)
+    parser.add_argument('-t','--target', metavar='targetdir', dest='targetdir', type=str, help='target directory', required=False)
+    parser.add_argument('-T','--tar', metavar='tarfile', dest='tar', type=str, nargs='?', const='-', help='Stream the buckets as a tar to this file or a pipe instead of a target directory (default: stdout)', required=False)
+    parser.add_argument('--tar-compress', metavar='compression', dest='tar_compress', type=str, choices=libtarstream.COMPRESSIONS, help='Compression of the tar stream: %s' % ', '.join(libtarstream.COMPRESSIONS), required=False, default='none')
+    parser.add_argument('--stream-memory', metavar='memory_mb', dest='stream_memory', type=int, help='Memory for files fetched ahead of the tar stream in MB', required=False, default=256)
+    parser.add_argument('--stream-threads', metavar='threads', dest='stream_threads', type=int, help='Number of files fetched ahead of the tar stream in parallel', required=False, default=4)
     parser.add_argument('-c','--config', metavar='configfile', dest='configfile', type=str, help='config file', default='cold2frozen.conf', required=False)
+    parser.add_argument('-r','--rebuild', action="store_true", help='Rebuild each bucket as soon as it is restored')
+    parser.add_argument('--restoreprocs', metavar='restoreprocs', dest='restoreprocs', type=int, help='Number of concurrent restores (with --rebuild)', required=False, default=1)
+    parser.add_argument('-p','--numprocs', metavar='numprocs', dest='numprocs', type=int, help='Number of concurrent rebuilds (with --rebuild)', required=False, default=1)
+    parser.add_argument('--rebuild-timeout', metavar='seconds', dest='rebuild_timeout', type=int, help='Kill a rebuild after this many seconds (0 = no timeout)', required=False, default=0)
+    parser.add_argument('-b','--backlog', metavar='backlog_mb', dest='backlog', type=int, help='Pause restores while restored, not yet rebuilt buckets exceed this size in MB (0 = unlimited)', required=False, default=0)
+    parser.add_argument('--prefetch', metavar='count', dest='prefetch', type=int, help='Also fetch this many buckets before and after the time range into the restore cache', required=False, default=0)
+    parser.add_argument('--plan', action="store_true", help='Only print the restore plan: bytes, objects, estimated duration and the buckets which fit')
+    parser.add_argument('--order', metavar='order', dest='order', type=str, choices=libplan.ORDERS, help='Order of the restore: %s' % ', '.join(libplan.ORDERS), required=False, default='oldest')
+    parser.add_argument('--budget', metavar='budget_mb', dest='budget', type=int, help='Stop admitting buckets once this many MB are planned', required=False, default=0)
+    parser.add_argument('--reserve', metavar='reserve_mb', dest='reserve', type=int, help='Free space in MB to leave on the target', required=False, default=1024)
+    parser.add_argument('--partial', action="store_true", help='Restore the buckets which fit if not all of them fit into the target')
+    parser.add_argument('--mbps', metavar='mbps', dest='mbps', type=float, help='Throughput in MB/s for the estimated duration (default depends on the archive type)', required=False)
+    parser.add_argument('--expansion', metavar='ratio', dest='expansion', type=float, help='Ratio of the restored to the archived size of a bucket, for the space check (default: %s with --decompress, %s with --rebuild, else 1)' % (libplan.DEFAULT_EXPANSION['decompress'], libplan.DEFAULT_EXPANSION['rebuild']), required=False)
+    parser.add_argument('-z','--decompress', metavar='threads', dest='decompress', type=int, nargs='?', const=1, help='Decompress the index files of old-style (pre 4.2) buckets after the restore, optionally with several threads', required=False, default=0)
 
 
     args = parser.parse_args()
@@ -42,74 +323,104 @@ def main():
     start_tstamp = int(datetime.strptime(args.startdate + " 00:00:00", "%d%m%Y %H:%M:%S").timestamp())
     end_tstamp = int(datetime.strptime(args.enddate + " 23:59:59", "%d%m%Y %H:%M:%S").timestamp() + 1)
 
+    if (args.targetdir is None) == (args.tar is None):
+        print("ERROR: Either a target directory or a tar stream must be given!")
+        sys.exit(1)
+    if args.tar == '-' and sys.stdout.isatty():
+        print("ERROR: Refusing to write a tar stream to a terminal, redirect or pipe it!")
+        sys.exit(1)
+
     # Validate permissions on destination dir
-    if not os.access(args.targetdir, os.W_OK):
+    if args.targetdir is not None and not os.access(args.targetdir, os.W_OK):
         msg = 'Cannot write to directory %s' % args.targetdir
         logger.error(msg)
         raise Exception(msg)
     
-    # Create logFields Object
-    logFields = libc2f.logDict()
-
     # Read in config file
     config = libc2f.readConfig(app_path,args.configfile)
     # Get the storage handler
     storage = libc2f.connStorage(config)
-
-    logFields.add('status', None)
+    # Get the metrics exporter
+    global metrics
+    metrics = libmetrics.fromConfig(config)
+    # Get the restore cache
+    global cache
+    cache = libcache.fromConfig(config)
+    if args.prefetch and not cache.enabled:
+        msg = 'Prefetching needs a restore cache, set RESTORE_CACHE_DIR'
+        logger.error(msg)
+        sys.exit(msg)
 
     # Check if index exists
     if not libc2f.indexExists(storage, args.index):
         msg = 'Index %s does not exists in storage location' % args.index
         sys.exit(msg)
 
-    # Initialize bucket container object
-    buckets = libbuckets.BucketIndex(index=args.index)
-
-    # Add all the buckets to the container
-    bucket_list = libc2f.listBuckets(storage, args.index)
-    for bucket_name in bucket_list:
-        buckets.add(bucket_name)
-
-    # Loop through the filtered objects
-    for bucket_obj in buckets.filter(start_tstamp, end_tstamp):
-        logFields.add('bucketname', bucket_obj.name)
-        logFields.add('indexname', buckets.index)
-        sourcedir = libc2f.bucketDir(storage, os.path.join(buckets.index,bucket_obj.name))
-        logFields.add('sourcedir', sourcedir)
-        targetdir = os.path.join(args.targetdir,bucket_obj.name)
-        logFields.add('targetdir', targetdir)
-        bucket_size_source = libc2f.getBucketSizeTarget(storage, os.path.join(buckets.index,bucket_obj.name))
-
-        if os.path.isdir(targetdir):
-            bucket_size = libc2f.getBucketSize(targetdir)
-            if bucket_size == bucket_size_source:
-                logFields.add('restoretime_ms', 0)
-                logFields.add('bucketsize_b', bucket_size)
-                logFields.add('status', 'existed')
-                msg = "Found existing bucket %s" % sourcedir
-                print(msg)
-                logger.info(logFields.kvout())
-                continue
-            else:
-                msg = "Found existing bucket with different size (will extract again) %s" % sourcedir
-                print(msg)
-        logFields.add('status', 'restored')
-        msg = "Restoring bucket %s" % sourcedir
-        print(msg)
-        restorestart = time.time() * 1000
-        libc2f.restoreBucket(storage, buckets.index, bucket_obj.name, args.targetdir)
-        restoreend = time.time() * 1000
-        logFields.add('restoretime_ms', round(restoreend - restorestart,3))
-        bucket_size = libc2f.getBucketSize(targetdir) 
-        logFields.add('bucketsize_b', bucket_size)
-        if bucket_size != bucket_size_source:
-            logFields.add('status', 'failed_size')
-            logger.info(logFields.kvout())
-            msg = 'Restored bucket sizes differ sourcebucket=%s (sourcesize=%s) targetbucket=%s (targetsize=%s)' % (sourcedir, bucket_size_source, targetdir, bucket_size)
-            logger.error(msg)
-            sys.exit(msg)
-        logger.info(logFields.kvout())
+    # One listing of the index with the sizes of the buckets
+    buckets, selected, objects = list_selected(storage, args.index, start_tstamp, end_tstamp)
+    if args.tar is not None:
+        stream_tar(storage, buckets.index, selected, args)
+        return
+
+    # Admit the buckets which fit into the target before downloading anything
+    expansion = args.expansion if args.expansion is not None else libplan.default_expansion(bool(args.decompress), args.rebuild)
+    plan = libplan.plan_restore(selected, objects, args.targetdir, storage.type, args.order, args.reserve * 1024 * 1024, args.budget * 1024 * 1024, args.mbps, expansion)
+    logFields = libc2f.logDict()
+    logFields.add('status', 'plan')
+    logFields.add('indexname', buckets.index)
+    logFields.add('bucketcount', selected.len())
+    for key, value in plan.fields().items():
+        logFields.add(key, value)
+    logger.info(logFields.kvout())
+    print_plan(plan)
+    if args.plan:
+        for bucket_obj in plan.admitted:
+            print("(Plan) Restore bucket (size_b: %s) %s" % (bucket_obj.size, bucket_obj.name))
+        for bucket_obj in plan.deferred:
+            print("(Plan) Does not fit (size_b: %s) %s" % (bucket_obj.size, bucket_obj.name))
+        return
+    # A byte budget limits the restore on purpose, missing space only with --partial
+    if not plan.complete and not args.budget and not args.partial:
+        msg = 'Not enough space in %s for %s bucket(s), free up space or restore the ones which fit with --partial' % (args.targetdir, len(plan.deferred))
+        logger.error(msg)
+        sys.exit(msg)
+    selected = libbuckets.BucketIndex(index=buckets.index, name='planned')
+    for bucket_obj in plan.buckets:
+        selected.append(bucket_obj)
+
+    failed = 0
+    if not args.rebuild:
+        for bucket_obj in selected:
+            status = restore_bucket(storage, buckets.index, bucket_obj.name, args.targetdir, decompress=args.decompress, size=bucket_obj.size)
+            if status == 'failed_size':
+                failed += 1
+                break
+    else:
+        failed = restore_rebuild(config, buckets.index, selected, args.targetdir, args.restoreprocs, args.numprocs, args.backlog * 1024 * 1024, args.rebuild_timeout, args.decompress)
+    prefetched = 0
+    if args.prefetch and not failed:
+        prefetched = prefetch_buckets(storage, buckets.index, buckets.adjacent(start_tstamp, end_tstamp, args.prefetch))
+
+    # Totals of the whole run
+    logFields = libc2f.logDict()
+    logFields.add('status', 'summary')
+    logFields.add('indexname', buckets.index)
+    logFields.add('bucketcount', selected.len())
+    logFields.add('deferred', len(plan.deferred))
+    logFields.add('failed', failed)
+    if cache.enabled:
+        totals = libc2f.stats_fields(total=True)
+        lookups = totals.get('n_cache_hit', 0) + totals.get('n_cache_miss', 0)
+        logFields.add('cache_hit_rate', round(totals.get('n_cache_hit', 0) / lookups, 3) if lookups else 0)
+        logFields.add('prefetched', prefetched)
+    logFields.addstats(total=True)
+    logger.info(logFields.kvout())
+    metrics.flush()
+
+    if failed and not args.rebuild:
+        sys.exit('Restore of bucket failed, sizes differ')
+    if failed:
+        sys.exit('Restore and rebuild failed for %s bucket(s)' % failed)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+# Purpose:
+# Verifies archived buckets against the checksums recorded at archive time
+# (ARCHIVE_CHECKSUMS = true). On dir storage the files are hashed with a pool of
+# processes, on s3 the ETags of the listing are compared, so nothing is downloaded
+# unless --deep is given for objects whose ETag is not an MD5.
+
+from __future__ import print_function
+from lib import libc2f
+from lib import libverify
+from lib import libmetrics
+import os, sys
+import argparse
+import logging, logging.handlers
+import math
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Verify SPLUNK_HOME
+libc2f.verifySplunkHome()
+SPLUNK_HOME = os.environ['SPLUNK_HOME']
+
+# Create Logger
+from lib import liblogger
+logger = liblogger.setup_logging('splunk.cold2frozen')
+
+# To enable debugging
+#logger.setLevel(logging.DEBUG)
+
+def log_result(result: dict, seconds: float, metrics, backend: str) -> str:
+    status = libverify.status(result)
+    logFields = libc2f.logDict()
+    logFields.add('status', status)
+    logFields.add('indexname', result['index'])
+    logFields.add('bucketname', result['bucket'])
+    logFields.add('files', result['files'])
+    logFields.add('verified_b', result['bytes'])
+    logFields.add('verifytime_ms', round(seconds * 1000, 3))
+    for key in ('missing', 'unexpected', 'mismatched', 'unverified'):
+        if result[key]:
+            logFields.add(key, '|'.join(result[key]))
+    if status == 'corrupt':
+        logger.error(logFields.kvout())
+    else:
+        logger.info(logFields.kvout())
+    metrics.record('verify', {'index': result['index'], 'backend': backend}, status, seconds, result['bytes'])
+    return status
+
+def main():
+
+    # Define the App Path
+    app_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+    logger.debug('Starting main()')
+
+    # Argument Parser
+    parser = argparse.ArgumentParser(description='Verify archived buckets against their checksums')
+    parser.add_argument('-i','--index', metavar='index', dest='index', type=str, help='Index(es)', action='append', nargs='*', required=False)
+    parser.add_argument('-p','--numprocs', metavar='numprocs', dest='numprocs', type=int, help='Number of hashing processes (dir) or verifying threads (s3)', required=False, default=os.cpu_count() or 1)
+    parser.add_argument('-s','--sample', metavar='percent', dest='sample', type=float, help='Verify a random sample of this percentage of the buckets of each index', required=False, default=100)
+    parser.add_argument('--seed', metavar='seed', dest='seed', type=int, help='Seed of the random sample, to verify the same sample again', required=False)
+    parser.add_argument('-c','--checkpoint', metavar='checkpointfile', dest='checkpoint', type=str, help='Skip the buckets listed in this file and add every checked one, resumes an interrupted run', required=False)
+    parser.add_argument('-d','--deep', action="store_true", help='Download and hash s3 objects which cannot be verified by their ETag or checksum')
+
+    args = parser.parse_args()
+
+    # Check Arguments
+    if not 0 < args.sample <= 100:
+        print("ERROR: Argument sample=%s must be a percentage between 0 and 100!" % args.sample)
+        sys.exit(1)
+
+    # Read in config file
+    config = libc2f.readConfig(app_path)
+    # Get the storage handler
+    storage = libc2f.connStorage(config)
+    # Get the metrics exporter
+    metrics = libmetrics.fromConfig(config)
+
+    index_list = libc2f.listIndexes(storage)
+
+    # Verify index arguments
+    if args.index:
+        for index in args.index[0]:
+            if index not in index_list:
+                print("ERROR: Index '%s' does not exist on storage" % index)
+                sys.exit(1)
+        index_list = [index for index in index_list if index in args.index[0]]
+
+    checkpoint = libverify.VerifyCheckpoint(args.checkpoint)
+    sampler = random.Random(args.seed)
+    local = threading.local()
+    counts = {'verified': 0, 'corrupt': 0, 'unverified': 0, 'no_checksums': 0}
+    verified_b = 0
+
+    def verify_s3(index, bucket_name, manifest):
+        # boto3 resources must not be shared between threads
+        if not hasattr(local, 'storage'):
+            local.storage = libc2f.connStorage(config)
+            if local.storage.type == 'tier':
+                local.storage = local.storage.remote
+        return libverify.verify_s3(local.storage, index, bucket_name, manifest, args.deep)
+
+    # Processes hash the files of dir storage, threads list and compare on s3,
+    # a tiered storage verifies each bucket on its nearest tier
+    hash_pool = ProcessPoolExecutor(max_workers=args.numprocs) if storage.type in ('dir', 'tier') else None
+    s3_pool = ThreadPoolExecutor(max_workers=args.numprocs) if storage.type in ('s3', 'tier') else None
+
+    # Buckets being verified, a few per worker keep the pool busy across buckets
+    pending = deque()
+
+    def finish_oldest():
+        nonlocal verified_b
+        verification, bucketstart = pending.popleft()
+        result = verification.result()
+        status = log_result(result, time.time() - bucketstart, metrics, storage.type)
+        counts[status] += 1
+        verified_b += result['bytes']
+        checkpoint.record(result['index'], result['bucket'])
+
+    verifystart = time.time()
+    try:
+        for index in index_list:
+            logger.debug("Verifying Index %s", index)
+            with libc2f.span('list'):
+                bucket_list = sorted(libc2f.listBuckets(storage, index))
+            if args.sample < 100:
+                bucket_list = sampler.sample(bucket_list, math.ceil(len(bucket_list) * args.sample / 100))
+            for bucket_name in bucket_list:
+                if checkpoint.done(index, bucket_name):
+                    logger.debug("Skipping verified bucket %s/%s", index, bucket_name)
+                    continue
+                manifest = libc2f.readChecksums(storage, index, bucket_name)
+                if manifest is None:
+                    logFields = libc2f.logDict()
+                    logFields.add('status', 'no_checksums')
+                    logFields.add('indexname', index)
+                    logFields.add('bucketname', bucket_name)
+                    logger.info(logFields.kvout())
+                    counts['no_checksums'] += 1
+                    continue
+                backend = storage
+                if storage.type == 'tier':
+                    backend = storage.nearest(os.path.join(index,bucket_name))
+                if backend.type == 'dir':
+                    verification = libverify.DirVerification(backend, index, bucket_name, manifest, hash_pool)
+                else:
+                    verification = s3_pool.submit(verify_s3, index, bucket_name, manifest)
+                pending.append((verification, time.time()))
+                while len(pending) > 2 * args.numprocs:
+                    finish_oldest()
+        while pending:
+            finish_oldest()
+    finally:
+        for pool in (hash_pool, s3_pool):
+            if pool:
+                pool.shutdown()
+    seconds = time.time() - verifystart
+
+    # Totals of the whole run
+    gbps = round(verified_b / seconds / 1000 ** 3, 3) if seconds > 0 else 0
+    logFields = libc2f.logDict()
+    logFields.add('status', 'summary')
+    for status, count in counts.items():
+        logFields.add(status, count)
+    logFields.add('verified_b', verified_b)
+    logFields.add('verifytime_ms', round(seconds * 1000, 3))
+    logFields.add('verify_gbps', gbps)
+    logFields.addstats(total=True)
+    logger.info(logFields.kvout())
+    metrics.flush()
+
+    print("Verified: %s, Corrupt: %s, Unverified: %s, No checksums: %s" % (counts['verified'], counts['corrupt'], counts['unverified'], counts['no_checksums']))
+    print("Verified %s bytes in %.1f s (%s GB/s)" % (verified_b, seconds, gbps))
+    if counts['corrupt']:
+        sys.exit('Verification failed for %s bucket(s)' % counts['corrupt'])
+
+if __name__ == "__main__":
+    main()
+    sys.exit()
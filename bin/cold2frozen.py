@@ -16,6 +16,9 @@
 # splunk.cold2frozen = DEBUG
 
 from lib import libc2f
+from lib import libmetrics
+from lib import libcompress
+from lib import libgovernor
 import sys, os
 import re
 import logging
@@ -60,6 +63,11 @@ def main():
     config = libc2f.readConfig(app_path)
     # Get the storage handler
     storage = libc2f.connStorage(config)
+    # Get the metrics exporter, disabled unless METRICS_FILE is configured
+    metrics = libmetrics.fromConfig(config)
+    # Get the host-wide limits of the heavy phases, disabled unless GOVERNOR_*_SLOTS are configured
+    governor = libgovernor.fromConfig(config)
+    archivestart = time.time()
 
     logFields.add('status', None)
 
@@ -85,21 +93,21 @@ def main():
 
     # Strip off ending /
     if bucket.endswith('/'):
-        logger.debug("bucket=%s has trailing /" % bucket)
+        logger.debug("bucket=%s has trailing /", bucket)
         bucket = bucket[:-1]
 
     logFields.add('bucket', bucket)
 
     indexname = os.path.basename(os.path.dirname(os.path.dirname(bucket)))
     logFields.add('indexname', indexname)
-    logger.debug("indexname is %s" % indexname)
+    logger.debug("indexname is %s", indexname)
 
     peer_name = libc2f.getHostName()
-    logger.debug("peername is %s" % peer_name)
+    logger.debug("peername is %s", peer_name)
 
     bucket_name = bucket.split("/")[-1]
     logFields.add('bucketname', bucket_name)
-    logger.debug("bucketname is %s" % bucket_name)
+    logger.debug("bucketname is %s", bucket_name)
 
     # Get bucket UTC epoch start and UTC epoch end
     buckets_info = bucket_name.split('_')
@@ -108,12 +116,12 @@ def main():
     logFields.add('bucketend', bucket_epoch_end)
     bucket_epoch_start = buckets_info[2]
     logFields.add('bucketstart', bucket_epoch_start)
-    logger.debug("bucket_epoch_start is %s" % bucket_epoch_start)
-    logger.debug("bucket_epoch_end is %s" % bucket_epoch_end)    
+    logger.debug("bucket_epoch_start is %s", bucket_epoch_start)
+    logger.debug("bucket_epoch_end is %s", bucket_epoch_end)
 
     bucket_name_prefix = bucket_name.split("_")[0]
     logFields.add('bucketprefix', bucket_name_prefix)
-    logger.debug("bucket_name_prefix is %s" % bucket_name_prefix)
+    logger.debug("bucket_name_prefix is %s", bucket_name_prefix)
     normalized_bucket_name_array = bucket_name.split("_")[1:]
 
     if len(normalized_bucket_name_array) == 3:
@@ -134,7 +142,7 @@ def main():
         sys.exit(msg)
 
     logFields.add('peerguid', original_peer_guid)
-    logger.debug("original_peer_guid is %s" % original_peer_guid)
+    logger.debug("original_peer_guid is %s", original_peer_guid)
 
     bucket_id = normalized_bucket_name_array[2]
     logFields.add('bucketid', bucket_id)
@@ -143,74 +151,91 @@ def main():
 
     normalized_bucket_name = "_".join(normalized_bucket_name_array)
     logFields.add('buckename_norm', normalized_bucket_name)
-    logger.debug("normalized_bucket_name is %s" % normalized_bucket_name)
+    logger.debug("normalized_bucket_name is %s", normalized_bucket_name)
 
     destdir = os.path.join(indexname, "_".join([bucket_name_prefix] + normalized_bucket_name_array))
     full_destdir = libc2f.bucketDir(storage, destdir)
     logFields.add('destdir', full_destdir)
-    logger.debug("destdir is %s" % full_destdir)
+    logger.debug("destdir is %s", full_destdir)
 
     lock_file = os.path.join(os.path.dirname(destdir), normalized_bucket_name + ".lock")
 
     # Create index directory, if needed
     libc2f.createIndex(storage, indexname)
 
+    metrics_labels = {'index': indexname, 'backend': storage.type}
+    metrics.start('archive', metrics_labels)
+
     # Get the lock
-    if libc2f.getLock(storage, lock_file, timeout=10):
-        atexit.register(libc2f.exitCleanup, storage, lock_file)
+    lockstart = time.time()
+    with libc2f.span('lock'):
+        locked = libc2f.getLock(storage, lock_file, timeout=10)
+    metrics.observe('c2f_lock_wait_seconds', metrics_labels, time.time() - lockstart)
+    if locked:
+        renewer = libc2f.LockRenewer(storage, lock_file)
+        renewer.start()
+        atexit.register(libc2f.exitCleanup, storage, lock_file, renewer)
 
         # Strip of unneeded metadata files
         files = os.listdir(bucket)
         rawdatafiles = os.listdir(os.path.join(bucket,rawdatadir))
-        logger.debug("Filelist %s" % files)
+        logger.debug("Filelist %s", files)
         journal_gz = os.path.join(rawdatadir, 'journal.gz')
         journal_zst = os.path.join(rawdatadir, 'journal.zst')
-        logger.debug("is it gz? %s" % os.path.isfile(journal_gz))
-        logger.debug("is it zst? %s" % os.path.isfile(journal_zst))
+        logger.debug("is it gz? %s", os.path.isfile(journal_gz))
+        logger.debug("is it zst? %s", os.path.isfile(journal_zst))
 
         # Bucket raw size in bytes
         bucket_size_raw = libc2f.getBucketSizeRaw(bucket)
         if bucket_size_raw >= 0:
             logFields.add('bucketsize_raw_b', bucket_size_raw)
 
-        # Bucket size in bytes        
-        bucket_size_full = libc2f.getBucketSize(bucket)
+        # Bucket size in bytes, the raw size ranks the bucket before its walk
+        with governor.slot('size_walk', max(0, bucket_size_raw)), libc2f.span('size_walk'):
+            bucket_size_full = libc2f.getBucketSize(bucket)
         logFields.add('bucketsize_full_b', bucket_size_full)
-        stripstart = time.time() * 1000
-        if os.path.isfile(journal_zst) or os.path.isfile(journal_gz):
-            if not searchFilesRequired:
-                libc2f.handleNewBucket(bucket, files)
-                libc2f.handleNewBucket(os.path.join(bucket,rawdatadir), rawdatafiles)
-            else:
-                logger.debug('Argument "--search-files-required" is specified. Skipping deletion of search files !')
-        else:
-            libc2f.handleOldBucket(bucket, files)
-
-        stripend = time.time() * 1000
+        with governor.slot('strip', bucket_size_full):
+            stripstart = time.time() * 1000
+            with libc2f.span('strip'):
+                if os.path.isfile(journal_zst) or os.path.isfile(journal_gz):
+                    if not searchFilesRequired:
+                        libc2f.handleNewBucket(bucket, files)
+                        libc2f.handleNewBucket(os.path.join(bucket,rawdatadir), rawdatafiles)
+                    else:
+                        logger.debug('Argument "--search-files-required" is specified. Skipping deletion of search files !')
+                else:
+                    codec, compressprocs = libc2f.compressCodec(config)
+                    compress_stats = libc2f.handleOldBucket(bucket, files, codec, compressprocs)
+                    logFields.add('compress_codec', codec)
+                    libcompress.logstats(logFields, compress_stats, 'compress')
+            stripend = time.time() * 1000
         logFields.add('striptime_ms', round(stripend - stripstart,3))
 
         # Bucket size in bytes
-        bucket_size = libc2f.getBucketSize(bucket) 
+        with governor.slot('size_walk', bucket_size_full), libc2f.span('size_walk'):
+            bucket_size = libc2f.getBucketSize(bucket)
         logFields.add('bucketsize_b', bucket_size)
 
         # Check if bucket has been transfered already, we need to cover both db and rb prefixes
         bucket_exists = False
         destdir_db = os.path.join(indexname, "_".join(['db'] + normalized_bucket_name_array))
         destdir_rb = os.path.join(indexname, "_".join(['rb'] + normalized_bucket_name_array))
-        if libc2f.bucketExists(storage, destdir_db):
-            bucket_exists = destdir_db
-        elif libc2f.bucketExists(storage, destdir_rb):
-            bucket_exists = destdir_rb
+        with libc2f.span('exists'):
+            if libc2f.bucketExists(storage, destdir_db):
+                bucket_exists = destdir_db
+            elif libc2f.bucketExists(storage, destdir_rb):
+                bucket_exists = destdir_rb
 
         logFields.add('copytime_ms', 0)
         if bucket_exists:
             full_bucket_exists = libc2f.bucketDir(storage, bucket_exists)
-            logger.debug('Warning: This bucket already exists as %s' % full_bucket_exists)
+            logger.debug('Warning: This bucket already exists as %s', full_bucket_exists)
             logFields.add('status', 'existed')
 
             # Bucket size in bytes
-            bucket_size_target = libc2f.getBucketSizeTarget(storage, bucket_exists)
-            logger.debug("bucket_size is %s, bucket_size_target is %s" % (bucket_size, bucket_size_target))
+            with libc2f.span('size_target'):
+                bucket_size_target = libc2f.getBucketSizeTarget(storage, bucket_exists)
+            logger.debug("bucket_size is %s, bucket_size_target is %s", bucket_size, bucket_size_target)
 
             if bucket_size != bucket_size_target:
                 msg = 'Bucket exists but sizes differ bucket=%s (size=%s) targetbucket=%s (targetsize=%s)' % (bucket, bucket_size, full_bucket_exists, bucket_size_target)
@@ -218,17 +243,33 @@ def main():
                 sys.exit(msg)
 
         else:
-            copystart = time.time() * 1000
-            libc2f.copyBucket(storage, bucket, destdir)        
-            copyend = time.time() * 1000
+            with governor.slot('upload', bucket_size):
+                # Record the checksums before the copy, a failed copy is retried
+                # by Splunk and writes them again
+                if libc2f.archiveChecksums(config):
+                    with libc2f.span('checksum'):
+                        manifest = libc2f.getBucketManifest(bucket)
+                        libc2f.writeChecksums(storage, indexname, os.path.basename(destdir), manifest)
+                    logFields.add('checksum_files', len(manifest['files']))
+                copystart = time.time() * 1000
+                with libc2f.span('copy'):
+                    libc2f.copyBucket(storage, bucket, destdir)
+                copyend = time.time() * 1000
             logFields.add('status', 'archived') 
+            metrics.inc('c2f_bytes', dict(metrics_labels, op='archive'), bucket_size)
             logFields.add('copytime_ms', round(copyend - copystart, 3))
             
     else:
         logFields.add('status', 'lock_timeout')
+        metrics.inc('c2f_lock_timeouts', metrics_labels)
 
+    logFields.addstats()
     logger.info(logFields.kvout())
 
+    metrics.inc('c2f_operations', dict(metrics_labels, op='archive', status=logFields.value('status')))
+    metrics.observe('c2f_operation_seconds', dict(metrics_labels, op='archive'), time.time() - archivestart)
+    metrics.finish('archive', metrics_labels)
+
 
 if __name__ == "__main__":
     main()
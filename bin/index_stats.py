@@ -3,6 +3,7 @@
 from __future__ import print_function
 from lib import libc2f
 from lib import libbuckets
+from lib import libmetrics
 import os, sys
 import argparse
 import logging, logging.handlers
@@ -42,6 +43,8 @@ def main():
     config = libc2f.readConfig(app_path)
     # Get the storage handler
     storage = libc2f.connStorage(config)
+    # Get the metrics exporter
+    metrics = libmetrics.fromConfig(config)
 
     index_list = libc2f.listIndexes(storage)
 
@@ -58,26 +61,26 @@ def main():
         logFields.add('status', None)
         if args.index and index not in args.index[0]:
             continue
-        logger.debug("Scanning Index %s" % index)
+        logger.debug("Scanning Index %s", index)
         # Initialize bucket container object
         buckets = libbuckets.BucketIndex(index=index)
-        # Add all the buckets to the container
-        bucket_list = libc2f.listBuckets(storage, index)
-        for bucket_name in bucket_list:
+        # Add all the buckets to the container, with their sizes from one listing
+        bucket_info = libc2f.listBucketsInfo(storage, index)
+        for bucket_name in bucket_info:
             buckets.add(bucket_name)
 
         logFields.add('indexname', index)
-        logger.debug("indexname is %s" % index)
+        logger.debug("indexname is %s", index)
         destdir = libc2f.bucketDir(storage, index)
         logFields.add('destdir', destdir)
-        logger.debug("destdir is %s" % destdir)
+        logger.debug("destdir is %s", destdir)
         # Loop through the buckets
         index_size = 0
         bucket_count = 0
         earliest = 9999999999999
         latest = 0
         for bucket_obj in buckets:
-            bucket_size_source = libc2f.getBucketSizeTarget(storage, os.path.join(index,bucket_obj.name))
+            bucket_size_source = bucket_info[bucket_obj.name]['size']
             index_size += bucket_size_source
             bucket_count += 1
             if bucket_obj.end > latest:
@@ -86,25 +89,30 @@ def main():
                 earliest = bucket_obj.start
 
         logFields.add('indexsize_b', index_size)
-        logger.debug("indexsize_b is %s" % index_size)
+        logger.debug("indexsize_b is %s", index_size)
         logFields.add('bucketcount', bucket_count)
-        logger.debug("bucketcount is %s" % bucket_count)
+        logger.debug("bucketcount is %s", bucket_count)
         if bucket_count > 0:
             logFields.add('earliest', earliest)
-            logger.debug("earliest is %s" % earliest)
+            logger.debug("earliest is %s", earliest)
             logFields.add('latest', latest)
-            logger.debug("latest is %s" % latest)
+            logger.debug("latest is %s", latest)
         else:
             earliest = 0
 
+        metrics.set('c2f_archive_size_bytes', {'index': index, 'backend': storage.type}, index_size)
+        metrics.set('c2f_archive_buckets', {'index': index, 'backend': storage.type}, bucket_count)
+
         logFields.add('status', 'indexstats')
-        logger.debug("status is %s" % 'indexstats')
+        logger.debug("status is %s", 'indexstats')
         logger.info(logFields.kvout())
         if args.verbose:
             earliest_date = datetime.datetime.fromtimestamp(earliest).strftime("%d.%m.%Y %H:%M:%S")
             latest_date = datetime.datetime.fromtimestamp(latest).strftime("%d.%m.%Y %H:%M:%S")
             print('Index: %s, Buckets: %s, Size: %s, Earliest: %s, Latest: %s, Destdir: %s' % (index, bucket_count, format_bytes(index_size), earliest_date, latest_date, destdir))
 
+    metrics.flush()
+
 
 if __name__ == "__main__":
     main()
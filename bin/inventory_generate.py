@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# Purpose:
+# Writes an inventory report of the archive in the layout of S3 Inventory (a
+# manifest.json and gzipped CSV data files) to a local directory. Useful for
+# archives without an S3 Inventory configuration, for dir archives which are
+# migrated to s3, and to try S3_INVENTORY before enabling it on the bucket.
+
+from __future__ import print_function
+from lib import libc2f
+import os, sys
+import argparse
+import csv
+import gzip
+import json
+import time
+import hashlib
+import logging, logging.handlers
+from datetime import datetime, timezone
+from urllib.parse import quote_plus
+
+# Verify SPLUNK_HOME
+libc2f.verifySplunkHome()
+SPLUNK_HOME = os.environ['SPLUNK_HOME']
+
+# Create Logger
+from lib import liblogger
+logger = liblogger.setup_logging('splunk.cold2frozen')
+
+# To enable debugging
+#logger.setLevel(logging.DEBUG)
+
+FILE_SCHEMA = 'Bucket, Key, Size, LastModifiedDate'
+
+def write_data_file(path: str, rows: list) -> None:
+    with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerows(rows)
+
+def main():
+
+    # Define the App Path
+    app_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+    logger.debug('Starting main()')
+
+    # Argument Parser
+    parser = argparse.ArgumentParser(description='Write an S3 Inventory style report of the archive')
+    parser.add_argument('-o','--output', metavar='outputdir', dest='output', type=str, help='Directory of the reports, the value of S3_INVENTORY', required=True)
+    parser.add_argument('-c','--config', metavar='configfile', dest='configfile', type=str, help='config file of the archive', default='cold2frozen.conf', required=False)
+    parser.add_argument('-a','--archive-dir', metavar='prefix', dest='archive_dir', type=str, help='Key prefix of the archive in the report (default: ARCHIVE_DIR)', required=False)
+    parser.add_argument('-n','--rows', metavar='rows', dest='rows', type=int, help='Objects per data file', required=False, default=1000000)
+
+    args = parser.parse_args()
+
+    # Read in config file
+    config = libc2f.readConfig(app_path, args.configfile)
+    # Get the storage handler, a tier is listed from its s3 side
+    storage = libc2f.connStorage(config)
+    if storage.type == 'tier':
+        storage = storage.remote
+    source_bucket = storage.s3_bucket if storage.type == 's3' else 'local'
+    archive_dir = (args.archive_dir if args.archive_dir is not None else storage.archive_dir).strip('/')
+
+    created = time.time()
+    report_dir = os.path.join(args.output, datetime.fromtimestamp(created, timezone.utc).strftime('%Y-%m-%dT%H-%MZ'))
+    os.makedirs(os.path.join(report_dir, 'data'), exist_ok=True)
+
+    files = []
+    rows = []
+    objects = 0
+    size = 0
+
+    def flush() -> None:
+        key = os.path.join(os.path.basename(report_dir), 'data', '%05d.csv.gz' % len(files))
+        path = os.path.join(args.output, key)
+        write_data_file(path, rows)
+        with open(path, 'rb') as f:
+            md5 = hashlib.md5(f.read()).hexdigest()
+        files.append({'key': key, 'size': os.path.getsize(path), 'MD5checksum': md5})
+        rows.clear()
+
+    for index in libc2f.listIndexes(storage):
+        logger.debug("Listing index %s", index)
+        for bucket_name in libc2f.listBuckets(storage, index):
+            for relative_path, entry in sorted(storage.bucket_files(index, bucket_name).items()):
+                key = '/'.join(part for part in (archive_dir, index, bucket_name, relative_path) if part)
+                modified = datetime.fromtimestamp(entry['mtime'], timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+                rows.append((source_bucket, quote_plus(key, safe='/'), entry['size'], modified))
+                objects += 1
+                size += entry['size']
+                if len(rows) >= args.rows:
+                    flush()
+    if rows or not files:
+        flush()
+
+    manifest = {'sourceBucket': source_bucket, 'destinationBucket': 'local', 'version': '2016-11-30',
+                'creationTimestamp': str(int(created * 1000)), 'fileFormat': 'CSV', 'fileSchema': FILE_SCHEMA, 'files': files}
+    with open(os.path.join(report_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+    logFields = libc2f.logDict()
+    logFields.add('status', 'inventory_generated')
+    logFields.add('reportdir', report_dir)
+    logFields.add('objects', objects)
+    logFields.add('size_b', size)
+    logFields.add('datafiles', len(files))
+    logger.info(logFields.kvout())
+    print("Wrote inventory report %s with %s objects (%s bytes) in %s data file(s)" % (report_dir, objects, size, len(files)))
+
+
+if __name__ == "__main__":
+    main()
+    sys.exit()
@@ -0,0 +1,63 @@
+import os
+import gc
+import json
+import time
+import platform
+import tracemalloc
+
+# Measurement of the microbenchmarks of benchmark.py. Every case is timed in
+# repeated runs without tracing, the best run counts. One more run under
+# tracemalloc gives the peak memory and the memory blocks it left allocated,
+# which would slow down the timed runs.
+
+def measure(func, setup=None, repeat: int = 5) -> dict:
+    """ Runs func(setup()) repeat times, setup is not measured """
+    cpu_ms = []
+    wall_ms = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        gc.collect()
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        func(arg)
+        cpu_ms.append((time.process_time() - cpu_start) * 1000)
+        wall_ms.append((time.perf_counter() - wall_start) * 1000)
+    arg = setup() if setup else None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        result = func(arg)
+        peak_b = tracemalloc.get_traced_memory()[1]
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    del result
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return {'cpu_ms': round(min(cpu_ms), 3), 'wall_ms': round(min(wall_ms), 3), 'peak_kb': round(peak_b / 1024, 1), 'alloc_blocks': blocks}
+
+def environment() -> dict:
+    return {'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count(), 'created': int(time.time())}
+
+def save(results: dict, path: str) -> None:
+    with open(path, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=1, sort_keys=True)
+
+def load(path: str) -> dict:
+    with open(path, 'r') as f:
+        return json.load(f)['results']
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """ Cases whose CPU time or peak memory grew by more than threshold percent,
+        as (case, metric, baseline, current) tuples """
+    regressions = []
+    for case, current in sorted(results.items()):
+        if case not in baseline:
+            continue
+        for metric in ('cpu_ms', 'peak_kb'):
+            base = baseline[case][metric]
+            # Ignore noise of cases too small to measure
+            if metric == 'cpu_ms' and base < 1:
+                continue
+            if current[metric] > base * (1 + threshold / 100):
+                regressions.append((case, metric, base, current[metric]))
+    return regressions
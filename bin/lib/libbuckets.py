@@ -1,8 +1,10 @@
 import datetime
 
 class Bucket:
-    def __init__(self, name=None):
+    def __init__(self, name=None, size=None, archived=None):
         self.__name = name
+        self.__size = size
+        self.__archived = archived
         self.__prefix = None
         self.__start = None
         self.__end = None
@@ -46,6 +48,14 @@ class Bucket:
     def peer(self):
         return self.__peerguid
 
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def archived(self):
+        return self.__archived
+
     @name.setter
     def name(self, name):
         self.__name = name
@@ -84,8 +94,8 @@ class BucketIndex:
     def len(self):
         return len(self._buckets)
 
-    def add(self, bucket_name):
-        self._buckets.append(Bucket(name=bucket_name))
+    def add(self, bucket_name, size=None, archived=None):
+        self._buckets.append(Bucket(name=bucket_name, size=size, archived=archived))
 
     def append(self, bucket):
         self._buckets.append(bucket)
@@ -114,6 +124,15 @@ class BucketIndex:
 
         return self._filtered_buckets
 
+    def adjacent(self, epocstart, epocend, count: int):
+        """ Up to count buckets ending right before epocstart and count starting right after epocend """
+        self._filtered_buckets = BucketIndex(index=self.__index, name="adjacent")
+        before = sorted([bucket for bucket in self._buckets if bucket.end < epocstart], key=lambda bucket: bucket.end, reverse=True)
+        after = sorted([bucket for bucket in self._buckets if bucket.start > epocend], key=lambda bucket: bucket.start)
+        for bucket in before[:count] + after[:count]:
+            self._filtered_buckets.append(bucket)
+        return self._filtered_buckets
+
     def older(self, retention: int):
         self._filtered_buckets = BucketIndex(index=self.__index, name="olderthan")
         check_tstamp = datetime.datetime.today() - datetime.timedelta(days=retention)
@@ -125,4 +144,14 @@ class BucketIndex:
                 self._filtered_buckets.append(bucket)
                 #print("Bucket selected:", bucket.name)
 
-        return self._filtered_buckets
\ No newline at end of file
+        return self._filtered_buckets
+
+    def archived_older(self, retention: int):
+        self._filtered_buckets = BucketIndex(index=self.__index, name="archivedolderthan")
+        check_tstamp = datetime.datetime.today() - datetime.timedelta(days=retention)
+        for bucket in self._buckets:
+            # Bucket archive time must be older than the retention
+            if bucket.archived is not None and datetime.datetime.fromtimestamp(bucket.archived) < check_tstamp:
+                self._filtered_buckets.append(bucket)
+
+        return self._filtered_buckets
@@ -1,14 +1,27 @@
 from __future__ import print_function
 from lib import libdir
 from lib import libs3
-import sys, os, gzip, shutil, subprocess
+from lib import libtier
+from lib import libstats
+from lib import libchecksum
+from lib import libcompress
+from lib import libwalk
+from lib.libstats import span, timed, count, add_bytes
+from lib.libstats import reset as stats_reset, fields as stats_fields
+import sys, os, shutil, subprocess
 import socket
 import time
-from datetime import datetime, timedelta
+import random
+import threading
 import logging
 from io import open
 logger = logging.getLogger('splunk.cold2frozen')
 
+# Lease of a bucket lock in seconds, renewed by its holder while it copies
+LOCK_TTL = 300
+LOCK_BACKOFF_MIN = 0.05
+LOCK_BACKOFF_MAX = 2
+
 def verifySplunkHome():
     # Verify SPLUNK_HOME environment variable is available, the script is expected to be launched by Splunk which
     #  will set this for debugging or manual run, please set this variable manually
@@ -25,7 +38,7 @@ def readConfig(app_path,config_file="cold2frozen.conf"):
     # Discover app path
     # app name
     APP = os.path.basename(app_path)
-    logger.debug('Appname: %s' % APP)
+    logger.debug('Appname: %s', APP)
 
     # Check if there is a path given
     if config_file.find('/')!=-1:
@@ -39,7 +52,7 @@ def readConfig(app_path,config_file="cold2frozen.conf"):
     config_inifile = os.path.join(app_path, "local", config_file)
 
     # First read default config
-    logger.debug('Reading config file: %s' % default_config_inifile)
+    logger.debug('Reading config file: %s', default_config_inifile)
     config.read(default_config_inifile)
 
     # Check config exists
@@ -49,7 +62,7 @@ def readConfig(app_path,config_file="cold2frozen.conf"):
         sys.exit(msg)    
 
     # Then read local config
-    logger.debug('Reading config file: %s' % config_inifile)
+    logger.debug('Reading config file: %s', config_inifile)
     config.read(config_inifile)
 
     # Add the app_path to it
@@ -58,35 +71,61 @@ def readConfig(app_path,config_file="cold2frozen.conf"):
 
     return config
 
+def connS3(config):
+    CONFIG_SECTION = "cold2frozen"
+    APP_PATH = config.get("Internal", "APP_PATH")
+    kwargs = {}
+    kwargs['s3_bucket'] = config.get(CONFIG_SECTION, "S3_BUCKET")
+    if "s3_endpoint" in dict(config.items(CONFIG_SECTION)):
+        kwargs['s3_endpoint'] = config.get(CONFIG_SECTION, "S3_ENDPOINT")
+    if "s3_verify_cert" in dict(config.items(CONFIG_SECTION)):
+        s3_verify_cert = config.get(CONFIG_SECTION, "S3_VERIFY_CERT")
+        if s3_verify_cert != "False":
+            if s3_verify_cert.find('/')==-1:
+                s3_verify_cert = os.path.join(APP_PATH, "certs", s3_verify_cert)
+            if not os.path.isfile(s3_verify_cert):
+                msg = "Value '%s' for S3_VERIFY_CERT not supported, must be 'False' or a readable pem file." % s3_verify_cert
+                logger.error(msg)
+                raise Exception(msg)
+            else:
+                kwargs['s3_verify_cert'] = s3_verify_cert
+        else:
+            kwargs['s3_verify_cert'] = eval(s3_verify_cert)
+    kwargs['access_key'] = config.get(CONFIG_SECTION, "ACCESS_KEY")
+    kwargs['secret_key'] = config.get(CONFIG_SECTION, "SECRET_KEY")
+    kwargs['archive_dir'] = config.get(CONFIG_SECTION, "ARCHIVE_DIR")
+    if config.has_option(CONFIG_SECTION, "S3_INVENTORY") and config.get(CONFIG_SECTION, "S3_INVENTORY").strip():
+        # s3://bucket/prefix of the inventory reports, or a local directory
+        kwargs['s3_inventory'] = config.get(CONFIG_SECTION, "S3_INVENTORY").strip()
+        kwargs['s3_inventory_cache_dir'] = os.path.join(os.environ['SPLUNK_HOME'], 'var', 'run', 'splunk')
+        if config.has_option(CONFIG_SECTION, "S3_INVENTORY_CACHE_DIR") and config.get(CONFIG_SECTION, "S3_INVENTORY_CACHE_DIR").strip():
+            kwargs['s3_inventory_cache_dir'] = config.get(CONFIG_SECTION, "S3_INVENTORY_CACHE_DIR").strip()
+        if config.has_option(CONFIG_SECTION, "S3_INVENTORY_DELTA"):
+            kwargs['s3_inventory_delta'] = config.getboolean(CONFIG_SECTION, "S3_INVENTORY_DELTA")
+    return libs3.c2fS3(**kwargs)
+
+def dirCopyArgs(config):
+    """ Copy streams and chunk size of bucket copies to a dir archive or tier """
+    CONFIG_SECTION = "cold2frozen"
+    kwargs = {}
+    if config.has_option(CONFIG_SECTION, "COPY_STREAMS") and config.get(CONFIG_SECTION, "COPY_STREAMS").strip():
+        kwargs['copy_streams'] = config.getint(CONFIG_SECTION, "COPY_STREAMS")
+    if config.has_option(CONFIG_SECTION, "COPY_CHUNK_MB") and config.get(CONFIG_SECTION, "COPY_CHUNK_MB").strip():
+        kwargs['copy_chunk_mb'] = config.getint(CONFIG_SECTION, "COPY_CHUNK_MB")
+    return kwargs
+
 def connStorage(config):
     CONFIG_SECTION = "cold2frozen"
     ARCHIVE_TYPE = config.get(CONFIG_SECTION, "ARCHIVE_TYPE")
-    APP_PATH = config.get("Internal", "APP_PATH")
     if ARCHIVE_TYPE == "dir":
         ARCHIVE_DIR = config.get(CONFIG_SECTION, "ARCHIVE_DIR")
-        storage = libdir.c2fDir(ARCHIVE_DIR)
+        storage = libdir.c2fDir(ARCHIVE_DIR, **dirCopyArgs(config))
     elif ARCHIVE_TYPE == "s3":
-        kwargs = {}
-        kwargs['s3_bucket'] = config.get(CONFIG_SECTION, "S3_BUCKET")
-        if "s3_endpoint" in dict(config.items(CONFIG_SECTION)):
-            kwargs['s3_endpoint'] = config.get(CONFIG_SECTION, "S3_ENDPOINT")
-        if "s3_verify_cert" in dict(config.items(CONFIG_SECTION)):
-            s3_verify_cert = config.get(CONFIG_SECTION, "S3_VERIFY_CERT")
-            if s3_verify_cert != "False":
-                if s3_verify_cert.find('/')==-1:
-                    s3_verify_cert = os.path.join(APP_PATH, "certs", s3_verify_cert)
-                if not os.path.isfile(s3_verify_cert):
-                    msg = "Value '%s' for S3_VERIFY_CERT not supported, must be 'False' or a readable pem file." % s3_verify_cert
-                    logger.error(msg)
-                    raise Exception(msg)
-                else:
-                    kwargs['s3_verify_cert'] = s3_verify_cert
-            else:
-                kwargs['s3_verify_cert'] = eval(s3_verify_cert)
-        kwargs['access_key'] = config.get(CONFIG_SECTION, "ACCESS_KEY")
-        kwargs['secret_key'] = config.get(CONFIG_SECTION, "SECRET_KEY")
-        kwargs['archive_dir'] = config.get(CONFIG_SECTION, "ARCHIVE_DIR")
-        storage = libs3.c2fS3(**kwargs)
+        storage = connS3(config)
+    elif ARCHIVE_TYPE == "tier":
+        # A local dir tier in front of s3, ARCHIVE_DIR is the s3 path
+        TIER_DIR = config.get(CONFIG_SECTION, "TIER_DIR")
+        storage = libtier.c2fTier(libdir.c2fDir(TIER_DIR, **dirCopyArgs(config)), lambda: connS3(config))
     else:
         msg = 'Given ARCHIVE_TYPE=%s is not supported' % ARCHIVE_TYPE
         logger.error(msg)
@@ -100,13 +139,7 @@ def getHostName():
     return localHostname
 
 def getBucketSize(bucketPath):
-    size = 0
-    for path, dirs, files in os.walk(bucketPath):
-        for file in files:
-            filepath = os.path.join(path, file)
-            logger.debug("Getting size for file %s" % filepath)
-            size += os.path.getsize(filepath)
-    return size
+    return libwalk.tree_size(bucketPath)
 
 def getBucketSizeTarget(storage, bucketPath):
     size = storage.bucket_size(bucketPath)
@@ -117,7 +150,7 @@ def getBucketSizeRaw(bucketPath):
     rawSizeFile = os.path.join(bucketPath,".rawSize")
     if os.path.isfile(rawSizeFile):
         with open(rawSizeFile, "r") as f:
-            logger.debug("Getting raw size for bucket %s" % bucketPath)
+            logger.debug("Getting raw size for bucket %s", bucketPath)
             size = f.read().rstrip()
             size = size if size.isdigit() else -1
     return int(size)
@@ -126,18 +159,28 @@ def bucketDir(storage, bucketPath):
     full_bucket_path = storage.bucket_dir(bucketPath)
     return full_bucket_path
 
-def getLock(storage, lock_file, timeout=2):
+def getLock(storage, lock_file, timeout=2, ttl=LOCK_TTL):
     """ False if lock_file was locked, True otherwise """
-    giveUp = datetime.utcnow() + timedelta(seconds=timeout)
-    while datetime.utcnow() < giveUp:
-        if not storage.check_lock_file(lock_file):
-            if storage.write_lock_file(lock_file, getHostName()):
-                return True
-        else:
-            time.sleep(1)
+    giveUp = time.time() + timeout
+    # Retry with exponential backoff and jitter, so waiting peers do not poll in step
+    delay = LOCK_BACKOFF_MIN
+    while True:
+        if storage.acquire_lock(lock_file, getHostName(), ttl):
+            return True
+        remaining = giveUp - time.time()
+        if remaining <= 0:
+            break
+        time.sleep(min(delay * random.uniform(0.5, 1), remaining))
+        delay = min(delay * 2, LOCK_BACKOFF_MAX)
     lock_host = storage.read_lock_file(lock_file)
-    logger.debug("Lock aquire timed out for lockfile (lockhost: %s) %s" % (lock_host,lock_file))
-    lock_file_age = storage.lock_file_age(lock_file)
+    logger.debug("Lock aquire timed out for lockfile (lockhost: %s) %s", lock_host,lock_file)
+    # Stale leases of the dir backend, also the local tier, are taken over by acquire_lock
+    if storage.type in ('dir', 'tier'):
+        return False
+    try:
+        lock_file_age = storage.lock_file_age(lock_file)
+    except Exception:
+        return False
     max_age = 3600 # 1h
     if time.time() - lock_file_age > max_age:
         msg = 'Found a very old (>%s secs) lockfile from host %s: %s' % (max_age,lock_host,lock_file)
@@ -145,39 +188,74 @@ def getLock(storage, lock_file, timeout=2):
         sys.exit(msg)        
     return False
 
+class LockRenewer(threading.Thread):
+    """ Renews the lease of a lock every ttl/3 seconds while a long copy holds it """
+
+    def __init__(self, storage, lock_file, ttl=LOCK_TTL):
+        super().__init__(daemon=True)
+        self._storage = storage
+        self._lock_file = lock_file
+        self._ttl = ttl
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._ttl / 3):
+            try:
+                if not self._storage.renew_lock(self._lock_file, self._ttl):
+                    logger.error("Lost the lease of lockfile %s", self._lock_file)
+                    return
+            except Exception as ex:
+                logger.warning("Cannot renew lockfile %s: %s", self._lock_file, ex)
+
+    def stop(self):
+        self._stopped.set()
+
 def releaseLock(storage, lock_file):
     storage.remove_lock_file(lock_file)
 
 # Always release lock on exit
-def exitCleanup(storage, lock_file):
+def exitCleanup(storage, lock_file, renewer=None):
+    if renewer:
+        renewer.stop()
+        renewer.join()
     releaseLock(storage, lock_file)
 
 # For new style buckets (v4.2+), we can remove all files except for the rawdata.
 # We can later rebuild all metadata and tsidx files with "splunk rebuild"
 def handleNewBucket(base, files):
-    logger.debug('Cleanup bucket=%s, type=normal' % base)
+    logger.debug('Cleanup bucket=%s, type=normal', base)
     # the only non file is the rawdata folder, which we want to archive
     for f in files:
         full = os.path.join(base, f)
         if os.path.isfile(full) and not os.path.basename(f).startswith('journal.'):
-            logger.debug('Removing file %s' % full)
+            logger.debug('Removing file %s', full)
             os.remove(full)
 
 
 # For buckets created before 4.2, simply gzip the tsidx files
 # To thaw these buckets, be sure to first unzip the tsidx files
-def handleOldBucket(base, files):
-    logger.debug('Cleanup bucket=%s, type=old-style' % base)
+# (bucket_restore.py --decompress)
+def handleOldBucket(base, files, codec='gzip', numprocs=1):
+    logger.debug('Cleanup bucket=%s, type=old-style, codec=%s', base, codec)
+    paths = []
     for f in files:
         full = os.path.join(base, f)
         if os.path.isfile(full) and (f.endswith('.tsidx') or f.endswith('.data')):
-            fin = open(full, 'rb')
-            fout = gzip.open(full + '.gz', 'wb')
-            fout.writelines(fin)
-            fout.close()
-            fin.close()
-            logger.debug('Removing file %s' % full)
-            os.remove(full)
+            paths.append(full)
+    return libcompress.compress_files(paths, codec, numprocs)
+
+def compressCodec(config):
+    """ Codec and number of parallel files for old-style buckets, OLD_BUCKET_CODEC and COMPRESS_PROCS """
+    codec = 'gzip'
+    if config.has_option('cold2frozen', 'OLD_BUCKET_CODEC'):
+        codec = config.get('cold2frozen', 'OLD_BUCKET_CODEC').strip()
+    numprocs = 1
+    if config.has_option('cold2frozen', 'COMPRESS_PROCS'):
+        numprocs = config.getint('cold2frozen', 'COMPRESS_PROCS')
+    return libcompress.getCodec(codec), numprocs
+
+def decompressBucket(bucketPath, numprocs=1):
+    return libcompress.decompress_bucket(bucketPath, numprocs)
 
 
 # This function is not called, but serves as an example of how to do
@@ -222,11 +300,26 @@ def listIndexes(storage):
 def listBuckets(storage, index):
     return storage.list_buckets(index)   
 
+def listBucketsInfo(storage, index, sizes=True):
+    return storage.list_buckets_info(index, sizes)
+
 def restoreBucket(storage, index, bucket_name, destdir):
     storage.restore_bucket(index,bucket_name,destdir)
 
 def removeBucket(storage, index, bucket_name):
-    storage.remove_bucket(index,bucket_name)
+    return storage.remove_bucket(index,bucket_name)
+
+def archiveChecksums(config):
+    return config.has_option('cold2frozen', 'ARCHIVE_CHECKSUMS') and config.getboolean('cold2frozen', 'ARCHIVE_CHECKSUMS')
+
+def getBucketManifest(bucketPath):
+    return libchecksum.bucketManifest(bucketPath)
+
+def writeChecksums(storage, index, bucket_name, manifest):
+    storage.write_checksums(index, bucket_name, manifest)
+
+def readChecksums(storage, index, bucket_name):
+    return storage.read_checksums(index, bucket_name)
 
 class logDict(dict):
     # __init__ function 
@@ -237,6 +330,15 @@ class logDict(dict):
     def add(self, key, value): 
         self.__logevent[key] = value 
 
+    # Function to return the value of a key
+    def value(self, key):
+        return self.__logevent.get(key)
+
+    # Function to add the timing span, request and byte counter fields
+    def addstats(self, total=False):
+        for key, value in libstats.fields(total).items():
+            self.__logevent[key] = value
+
     # Function to return kv list of fields
     def kvout(self):
         kvarray = []
@@ -0,0 +1,148 @@
+from lib import libcopy
+from lib import libstats
+from lib import libwalk
+import os
+import json
+import time
+import fcntl
+import shutil
+import tempfile
+import threading
+import logging
+logger = logging.getLogger('splunk.cold2frozen')
+
+# Local cache of restored and size verified buckets, <cache>/<index>/<bucket>.
+# Buckets are cloned into the restore target and into the cache, as reflinks
+# where the filesystem supports them, else as copies. A hit needs no download,
+# and with reflinks no space. Hardlinks are never used, a rebuild or an edit of
+# the thawed bucket would change the cached one in place. The sizes and last use times are kept in
+# a JSON state file, updated under an exclusive lock by concurrent restores,
+# and the least recently used buckets are evicted beyond the size limit.
+
+STATE_FILE = '.c2f_cache_state'
+
+class RestoreCache:
+
+    def __init__(self, cache_dir=None, max_size_b=0):
+        self._cache_dir = cache_dir
+        self._max_size_b = max_size_b
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self._cache_dir is not None
+
+    def _key(self, index: str, bucket_name: str) -> str:
+        return os.path.join(index, bucket_name)
+
+    def _update(self, func):
+        """ Runs func(state) under the cache lock and writes the state back, returns its result """
+        state_file = os.path.join(self._cache_dir, STATE_FILE)
+        with self._lock, open(state_file + '.lock', 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            state = {}
+            if os.path.isfile(state_file):
+                try:
+                    with open(state_file, 'r') as f:
+                        state = json.load(f)
+                except ValueError:
+                    logger.warning('Resetting unreadable cache state %s', state_file)
+            result = func(state)
+            tmp_file = '%s.%s.tmp' % (state_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump(state, f, separators=(',', ':'))
+            os.replace(tmp_file, state_file)
+            return result
+
+    def contains(self, index: str, bucket_name: str, size: int) -> bool:
+        if not self.enabled:
+            return False
+        return self._update(lambda state: state.get(self._key(index, bucket_name), {}).get('size') == size)
+
+    def workdir(self) -> str:
+        """ A new directory on the cache filesystem to restore buckets for prefetching into """
+        return tempfile.mkdtemp(prefix='.prefetch.', dir=self._cache_dir)
+
+    def serve(self, index: str, bucket_name: str, size: int, restoredir: str) -> bool:
+        """ Clones a cached bucket of the given archived size into restoredir, False on a miss """
+        if not self.enabled:
+            return False
+        key = self._key(index, bucket_name)
+
+        def touch(state):
+            entry = state.get(key)
+            if entry is None or entry['size'] != size or not os.path.isdir(os.path.join(self._cache_dir, key)):
+                return False
+            entry['used'] = time.time()
+            return True
+
+        if not self._update(touch):
+            libstats.count('cache_miss')
+            return False
+        # Eviction removes the entry before the files, a bucket can vanish while it is cloned
+        try:
+            if libwalk.tree_size(os.path.join(self._cache_dir, key)) != size:
+                raise OSError('cached size differs')
+            methods = libcopy.clone_tree(os.path.join(self._cache_dir, key), os.path.join(restoredir, bucket_name))
+        except OSError as ex:
+            logger.warning('Cannot serve bucket %s from cache: %s', key, ex)
+            libstats.count('cache_miss')
+            return False
+        for method, n in methods.items():
+            libstats.count('cache_%s' % method, n)
+        libstats.count('cache_hit')
+        libstats.add_bytes('cache_saved', size)
+        return True
+
+    def insert(self, index: str, bucket_name: str, size: int, restoredir: str) -> None:
+        """ Adds a restored and verified bucket and evicts the least recently used ones """
+        if not self.enabled or size > self._max_size_b:
+            return
+        key = self._key(index, bucket_name)
+        cached_dir = os.path.join(self._cache_dir, key)
+        staging_dir = os.path.join(self._cache_dir, index, '.%s.%s' % (bucket_name, os.getpid()))
+        try:
+            libcopy.clone_tree(os.path.join(restoredir, bucket_name), staging_dir)
+        except OSError as ex:
+            logger.warning('Cannot add bucket %s to cache: %s', key, ex)
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            return
+
+        def add(state):
+            if os.path.isdir(cached_dir):
+                shutil.rmtree(cached_dir)
+            os.rename(staging_dir, cached_dir)
+            state[key] = {'size': size, 'used': time.time()}
+            total = sum(entry['size'] for entry in state.values())
+            evict = []
+            for old_key, entry in sorted(state.items(), key=lambda item: item[1]['used']):
+                if total <= self._max_size_b:
+                    break
+                if old_key == key:
+                    continue
+                evict.append(old_key)
+                total -= entry['size']
+            for old_key in evict:
+                del state[old_key]
+            return evict
+
+        for old_key in self._update(add):
+            logger.debug('Evicting bucket %s from cache', old_key)
+            shutil.rmtree(os.path.join(self._cache_dir, old_key), ignore_errors=True)
+            libstats.count('cache_evicted')
+
+def fromConfig(config):
+    """ Cache in RESTORE_CACHE_DIR of at most RESTORE_CACHE_MB, disabled if it is not set """
+    cache_dir = None
+    if config.has_option('cold2frozen', 'RESTORE_CACHE_DIR'):
+        cache_dir = config.get('cold2frozen', 'RESTORE_CACHE_DIR').strip() or None
+    if cache_dir is None:
+        return RestoreCache()
+    if not os.path.isdir(cache_dir) or not os.access(cache_dir, os.W_OK):
+        msg = 'Cannot write to restore cache directory %s' % cache_dir
+        logger.error(msg)
+        raise Exception(msg)
+    max_size_mb = 10240
+    if config.has_option('cold2frozen', 'RESTORE_CACHE_MB'):
+        max_size_mb = config.getint('cold2frozen', 'RESTORE_CACHE_MB')
+    return RestoreCache(cache_dir, max_size_mb * 1024 * 1024)
@@ -0,0 +1,78 @@
+import os
+import math
+import mmap
+import base64
+import time
+import hashlib
+import logging
+logger = logging.getLogger('splunk.cold2frozen')
+
+# Checksums of the files of a bucket, recorded at archive time in a manifest
+# next to the archived bucket (<index>/.checksums/<bucket>.json). The S3 ETag
+# is precomputed with the part size boto3 uploads with, so archived objects can
+# be verified against their ETag without downloading them.
+
+CHECKSUM_DIR = '.checksums'
+PART_SIZE = 8 * 1024 * 1024
+MAX_PARTS = 10000
+READ_SIZE = 8 * 1024 * 1024
+
+def manifestPath(index: str, bucket_name: str) -> str:
+    return os.path.join(index, CHECKSUM_DIR, bucket_name + '.json')
+
+def partSize(size: int) -> int:
+    """ Multipart part size of a file, doubled like boto3 does until it fits into MAX_PARTS """
+    part_size = PART_SIZE
+    while math.ceil(size / part_size) > MAX_PARTS:
+        part_size *= 2
+    return part_size
+
+def fileChecksums(path: str):
+    """ Returns the sha256 and the expected S3 ETag of a file, reading it once """
+    sha256 = hashlib.sha256()
+    part_md5s = []
+    size = os.path.getsize(path)
+    part_size = partSize(size)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(part_size)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            part_md5s.append(hashlib.md5(chunk).digest())
+    # Files below the multipart threshold are uploaded with a single PUT
+    if size < PART_SIZE:
+        etag = part_md5s[0].hex() if part_md5s else hashlib.md5(b'').hexdigest()
+    else:
+        etag = '%s-%s' % (hashlib.md5(b''.join(part_md5s)).hexdigest(), len(part_md5s))
+    return sha256.hexdigest(), etag
+
+def bucketManifest(bucket: str) -> dict:
+    files = {}
+    for path, dirs, filenames in os.walk(bucket):
+        for filename in filenames:
+            filepath = os.path.join(path, filename)
+            sha256, etag = fileChecksums(filepath)
+            files[os.path.relpath(filepath, bucket)] = {'size': os.path.getsize(filepath), 'sha256': sha256, 'etag': etag}
+    return {'version': 1, 'created': int(time.time()), 'part_size': PART_SIZE, 'files': files}
+
+def hashFile(path: str) -> str:
+    """ sha256 of a file using a memory-mapped read, runs in pool worker processes """
+    sha256 = hashlib.sha256()
+    if os.path.getsize(path) == 0:
+        return sha256.hexdigest()
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for offset in range(0, len(mm), READ_SIZE):
+                sha256.update(mm[offset:offset + READ_SIZE])
+    return sha256.hexdigest()
+
+def hashStream(stream) -> str:
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(READ_SIZE), b''):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+def s3Checksum(sha256: str) -> str:
+    """ The base64 form S3 stores a SHA256 additional checksum in """
+    return base64.b64encode(bytes.fromhex(sha256)).decode('ascii')
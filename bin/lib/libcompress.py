@@ -0,0 +1,118 @@
+import os
+import gzip
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+import logging
+logger = logging.getLogger('splunk.cold2frozen')
+
+# zstandard is optional, without it old-style buckets are compressed with gzip
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compression of the .tsidx and .data files of old-style (pre 4.2) buckets.
+# The files are streamed in large blocks, several files at once: zlib and
+# zstandard release the GIL while compressing, so threads use several cores.
+
+BUFFER_SIZE = 4 * 1024 * 1024
+EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+COMPRESSED_SUFFIXES = ('.tsidx.gz', '.data.gz', '.tsidx.zst', '.data.zst')
+# Left in a decompressed bucket with its archived size, Splunk does not read it
+DECOMPRESSED_MARKER = '.c2f_decompressed'
+
+def getCodec(codec: str) -> str:
+    if codec not in EXTENSIONS:
+        msg = 'Compression codec %s is not supported, must be one of %s' % (codec, ', '.join(EXTENSIONS))
+        logger.error(msg)
+        raise Exception(msg)
+    if codec == 'zstd' and zstandard is None:
+        logger.warning('Python module zstandard is not installed, compressing with gzip')
+        return 'gzip'
+    return codec
+
+def _open_compressed(path: str, codec: str):
+    if codec == 'zstd':
+        # The frame is compressed by zstd worker threads
+        return zstandard.ZstdCompressor(level=3, threads=-1).stream_writer(open(path, 'wb'), closefd=True)
+    return gzip.open(path, 'wb', compresslevel=9)
+
+def _open_decompressed(path: str):
+    if path.endswith('.zst'):
+        if zstandard is None:
+            msg = 'Python module zstandard is required to decompress %s' % path
+            logger.error(msg)
+            raise Exception(msg)
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return gzip.open(path, 'rb')
+
+def compress_file(path: str, codec: str = 'gzip'):
+    """ Replaces a file by its compressed version, returns the bytes read and written """
+    target = path + EXTENSIONS[codec]
+    tmp_file = target + '.tmp'
+    with open(path, 'rb') as fin, _open_compressed(tmp_file, codec) as fout:
+        shutil.copyfileobj(fin, fout, BUFFER_SIZE)
+    os.replace(tmp_file, target)
+    in_b, out_b = os.path.getsize(path), os.path.getsize(target)
+    logger.debug('Removing file %s', path)
+    os.remove(path)
+    return in_b, out_b
+
+def decompress_file(path: str):
+    """ Replaces a compressed file by its content, returns the bytes read and written """
+    target = os.path.splitext(path)[0]
+    tmp_file = target + '.tmp'
+    with _open_decompressed(path) as fin, open(tmp_file, 'wb') as fout:
+        shutil.copyfileobj(fin, fout, BUFFER_SIZE)
+    os.replace(tmp_file, target)
+    in_b, out_b = os.path.getsize(path), os.path.getsize(target)
+    os.remove(path)
+    return in_b, out_b
+
+def _run(func, paths: list, numprocs: int, *args) -> dict:
+    start = time.time()
+    in_b = out_b = 0
+    with ThreadPoolExecutor(max_workers=max(1, numprocs)) as pool:
+        for file_in_b, file_out_b in pool.map(lambda path: func(path, *args), paths):
+            in_b += file_in_b
+            out_b += file_out_b
+    return {'files': len(paths), 'in_b': in_b, 'out_b': out_b, 'ms': (time.time() - start) * 1000}
+
+def compress_files(paths: list, codec: str = 'gzip', numprocs: int = 1) -> dict:
+    return _run(compress_file, paths, numprocs, codec)
+
+def compressed_files(bucketdir: str) -> list:
+    """ Index files compressed by handleOldBucket, the journal is left alone """
+    paths = []
+    for path, dirs, files in os.walk(bucketdir):
+        for file in files:
+            if file.endswith(COMPRESSED_SUFFIXES):
+                paths.append(os.path.join(path, file))
+    return paths
+
+def decompress_bucket(bucketdir: str, numprocs: int = 1) -> dict:
+    return _run(decompress_file, compressed_files(bucketdir), numprocs)
+
+def mark_decompressed(bucketdir: str, archived_size: int) -> None:
+    """ Keeps the archived size of a decompressed bucket, so a restore can tell it is complete """
+    with open(os.path.join(bucketdir, DECOMPRESSED_MARKER), 'w') as f:
+        f.write(str(archived_size))
+
+def decompressed_size(bucketdir: str):
+    marker = os.path.join(bucketdir, DECOMPRESSED_MARKER)
+    if not os.path.isfile(marker):
+        return None
+    with open(marker, 'r') as f:
+        size = f.read().strip()
+    return int(size) if size.isdigit() else None
+
+def logstats(logFields, stats: dict, prefix: str) -> None:
+    """ Adds <prefix>_ratio and <prefix>_mbps (uncompressed MB/s) to a logDict """
+    raw_b = stats['in_b'] if prefix == 'compress' else stats['out_b']
+    packed_b = stats['out_b'] if prefix == 'compress' else stats['in_b']
+    logFields.add('%s_files' % prefix, stats['files'])
+    logFields.add('%s_raw_b' % prefix, raw_b)
+    logFields.add('%s_packed_b' % prefix, packed_b)
+    logFields.add('%s_ratio' % prefix, round(raw_b / packed_b, 3) if packed_b else 0)
+    logFields.add('%s_mbps' % prefix, round(raw_b / 1024 / 1024 / (stats['ms'] / 1000), 3) if stats['ms'] > 0 else 0)
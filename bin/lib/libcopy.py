@@ -0,0 +1,208 @@
+import os
+import errno
+import mmap
+import fcntl
+import shutil
+import threading
+import logging
+logger = logging.getLogger('splunk.cold2frozen')
+
+# File copies inside the kernel. A reflink (FICLONE) shares the extents of the
+# source on XFS and btrfs, copy_file_range lets the filesystem clone or copy
+# server side (NFSv4.2), sendfile at least avoids copies to userspace. Large
+# buffered reads and writes are the last resort.
+#
+# Large files can be copied in chunks over several streams (ChunkedCopy), each
+# chunk with copy_file_range at its offsets or positional reads and writes of
+# a page aligned buffer. A single stream to NFS or SMB does not fill the link.
+
+FICLONE = 0x40049409
+BUFFER_SIZE = 8 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024 * 1024
+# Chunks of a ChunkedCopy start at multiples of this
+CHUNK_ALIGNMENT = 1024 * 1024
+
+# Errors meaning a method is not supported for the pair of filesystems
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EBADF, errno.ETXTBSY)
+
+# Methods which failed per (source device, target device), so they are not tried for every file
+_failed = set()
+_failed_lock = threading.Lock()
+
+def _reflink(fsrc, fdst, size: int) -> None:
+    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+def _short_copy(name: str, offset: int) -> None:
+    # Some FUSE and overlay filesystems and older kernels copy nothing and return 0
+    if offset == 0:
+        raise OSError(errno.EOPNOTSUPP, '%s copied nothing' % name)
+    raise OSError(errno.EIO, 'Source file ended at offset %s' % offset)
+
+def _copy_file_range(fsrc, fdst, size: int) -> None:
+    offset = 0
+    while offset < size:
+        copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(CHUNK_SIZE, size - offset))
+        if copied == 0:
+            _short_copy('copy_file_range', offset)
+        offset += copied
+
+def _sendfile(fsrc, fdst, size: int) -> None:
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, min(CHUNK_SIZE, size - offset))
+        if sent == 0:
+            _short_copy('sendfile', offset)
+        offset += sent
+
+def _buffered(fsrc, fdst, size: int) -> None:
+    shutil.copyfileobj(fsrc, fdst, BUFFER_SIZE)
+
+METHODS = [('reflink', _reflink), ('copy_file_range', _copy_file_range), ('sendfile', _sendfile), ('buffered', _buffered)]
+if not hasattr(os, 'copy_file_range'):
+    METHODS = [method for method in METHODS if method[0] != 'copy_file_range']
+
+def copy_file(src: str, dst: str) -> str:
+    """ Copy a file with the cheapest method the filesystems support, like
+        shutil.copy2 including the metadata. Returns the method used. """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        devices = (os.fstat(fsrc.fileno()).st_dev, os.fstat(fdst.fileno()).st_dev)
+        for name, method in METHODS:
+            if (devices, name) in _failed:
+                continue
+            try:
+                method(fsrc, fdst, size)
+            except OSError as ex:
+                if name == 'buffered' or ex.errno not in _UNSUPPORTED:
+                    raise
+                logger.debug("Copy method %s not supported from %s to %s: %s", name, src, dst, ex)
+                with _failed_lock:
+                    _failed.add((devices, name))
+                # Start over, the failed method may have written a part
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+                continue
+            break
+        fdst.flush()
+        copied = os.fstat(fdst.fileno()).st_size
+        if copied != size:
+            raise OSError(errno.EIO, 'Copied %s of %s bytes from %s to %s' % (copied, size, src, dst))
+    shutil.copystat(src, dst)
+    return name
+
+def _chunk_copy_file_range(src_fd: int, dst_fd: int, offset: int, length: int) -> None:
+    end = offset + length
+    while offset < end:
+        copied = os.copy_file_range(src_fd, dst_fd, min(CHUNK_SIZE, end - offset), offset, offset)
+        if copied == 0:
+            raise OSError(errno.EIO, 'Source file ended at offset %s' % offset)
+        offset += copied
+
+def _chunk_pread(src_fd: int, dst_fd: int, offset: int, length: int) -> None:
+    # Anonymous maps are page aligned, which suits O_DIRECT capable servers and avoids copies
+    buf = mmap.mmap(-1, BUFFER_SIZE)
+    view = memoryview(buf)
+    try:
+        end = offset + length
+        while offset < end:
+            n = os.preadv(src_fd, [view[:min(BUFFER_SIZE, end - offset)]], offset)
+            if n == 0:
+                raise OSError(errno.EIO, 'Source file ended at offset %s' % offset)
+            written = 0
+            while written < n:
+                written += os.pwrite(dst_fd, view[written:n], offset + written)
+            offset += n
+    finally:
+        view.release()
+        buf.close()
+
+CHUNK_METHODS = [('copy_file_range', _chunk_copy_file_range), ('pread', _chunk_pread)]
+if not hasattr(os, 'copy_file_range'):
+    CHUNK_METHODS = [method for method in CHUNK_METHODS if method[0] != 'copy_file_range']
+
+class ChunkedCopy:
+    """ Copy of one file whose chunks are copied by concurrent callers of
+        copy_chunk. A reflink needs no chunks. The metadata is copied by finish,
+        so the target looks complete to a resumed copy only after all chunks. """
+
+    def __init__(self, src: str, dst: str):
+        self._src = src
+        self._dst = dst
+        self._fsrc = open(src, 'rb')
+        self._fdst = open(dst, 'wb')
+        self.size = os.fstat(self._fsrc.fileno()).st_size
+        self._devices = (os.fstat(self._fsrc.fileno()).st_dev, os.fstat(self._fdst.fileno()).st_dev)
+        self._methods = set()
+        self._lock = threading.Lock()
+        self.reflinked = False
+        if (self._devices, 'reflink') not in _failed:
+            try:
+                _reflink(self._fsrc, self._fdst, self.size)
+                self.reflinked = True
+                self._methods.add('reflink')
+            except OSError as ex:
+                if ex.errno not in _UNSUPPORTED:
+                    self.close()
+                    raise
+                with _failed_lock:
+                    _failed.add((self._devices, 'reflink'))
+        if not self.reflinked:
+            # Chunks are written at their offsets into a file of the final size
+            os.ftruncate(self._fdst.fileno(), self.size)
+
+    def chunks(self, chunk_b: int) -> list:
+        """ (offset, length) of the chunks to copy """
+        if self.reflinked:
+            return []
+        chunk_b = max(CHUNK_ALIGNMENT, chunk_b // CHUNK_ALIGNMENT * CHUNK_ALIGNMENT)
+        return [(offset, min(chunk_b, self.size - offset)) for offset in range(0, self.size, chunk_b)]
+
+    def copy_chunk(self, offset: int, length: int) -> None:
+        for name, method in CHUNK_METHODS:
+            if (self._devices, name) in _failed:
+                continue
+            try:
+                method(self._fsrc.fileno(), self._fdst.fileno(), offset, length)
+            except OSError as ex:
+                if name == 'pread' or ex.errno not in _UNSUPPORTED:
+                    raise
+                logger.debug("Copy method %s not supported from %s to %s: %s", name, self._src, self._dst, ex)
+                with _failed_lock:
+                    _failed.add((self._devices, name))
+                # The next method writes the whole chunk again at its offsets
+                continue
+            with self._lock:
+                self._methods.add(name)
+            return
+
+    def close(self) -> None:
+        self._fsrc.close()
+        self._fdst.close()
+
+    def finish(self) -> str:
+        """ Closes the files and copies the metadata, returns the method used """
+        self.close()
+        shutil.copystat(self._src, self._dst)
+        # A chunk may have fallen back to another method, the slowest one counts
+        for name in ('pread', 'copy_file_range', 'reflink'):
+            if name in self._methods:
+                return name
+        return CHUNK_METHODS[0][0]
+
+def clone_file(src: str, dst: str) -> str:
+    """ Copy a file as a reflink where possible, else a full copy, never a hardlink:
+        an in-place write to one of the files must not change the other. Returns the method used. """
+    # An existing target may be a hardlink to another file, it must not be truncated
+    if os.path.lexists(dst):
+        os.remove(dst)
+    return copy_file(src, dst)
+
+def clone_tree(src: str, dst: str) -> dict:
+    """ clone_file for every file of a directory tree, returns the count per method """
+    methods = {}
+    def clone(s, d):
+        method = clone_file(s, d)
+        methods[method] = methods.get(method, 0) + 1
+    shutil.copytree(src, dst, copy_function=clone, dirs_exist_ok=True)
+    return methods
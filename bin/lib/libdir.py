@@ -1,14 +1,53 @@
 import sys, os, shutil
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from lib import libstats
+from lib import libchecksum
+from lib import libcopy
+from lib import libwalk
 import logging
 from io import open
 logger = logging.getLogger('splunk.cold2frozen')
 
+# Buckets are copied to <index>/.staging/<bucket> and renamed when complete
+STAGING_DIR = '.staging'
+
+# A lease is taken over if it expired, or its process on this host is gone. The
+# takeover itself is guarded by a second exclusive file, which is given up if
+# its owner does not finish within TAKEOVER_TIMEOUT seconds.
+TAKEOVER_TIMEOUT = 60
+
+# Streams of a bucket copy to a network filesystem if COPY_STREAMS is not set,
+# files of at least two chunks are copied chunk by chunk
+NETWORK_COPY_STREAMS = 4
+COPY_CHUNK_MB = 256
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
 class c2fDir:
 
-    def __init__(self, archive_dir):
+    def __init__(self, archive_dir, copy_streams=None, copy_chunk_mb=None):
         self._type = 'dir'
         self._archive_dir = self._is_valid_dir(archive_dir)
         self._is_writable_dir(archive_dir)
+        # Threads of directory traversals, more than one on network filesystems
+        self._walk_threads = libwalk.default_threads(self._archive_dir)
+        # Concurrent file and chunk copies of a bucket copy
+        if copy_streams is None:
+            copy_streams = NETWORK_COPY_STREAMS if libwalk.fs_type(self._archive_dir) in libwalk.NETWORK_FS else 1
+        self._copy_streams = max(1, copy_streams)
+        self._copy_chunk_b = (copy_chunk_mb or COPY_CHUNK_MB) * 1024 * 1024
+        # Tokens of the leases held by this process
+        self._leases = {}
 
     @property
     def type(self):
@@ -33,54 +72,213 @@ class c2fDir:
             logger.error(msg)
             raise Exception(msg)
 
+    def _copy_file(self, src: str, dst: str) -> None:
+        method = libcopy.copy_file(src, dst)
+        libstats.count('copy_%s' % method)
+        libstats.add_bytes('archive', os.path.getsize(dst))
+
+    def _copy_files(self, files: list) -> None:
+        """ Copies the (source, target) files over the copy streams, large files in chunks """
+        if self._copy_streams <= 1:
+            for source_file, target_file in files:
+                self._copy_file(source_file, target_file)
+            return
+        chunked = []
+        futures = []
+        with ThreadPoolExecutor(max_workers=self._copy_streams) as pool:
+            try:
+                for source_file, target_file in files:
+                    if os.path.getsize(source_file) < 2 * self._copy_chunk_b:
+                        futures.append(pool.submit(self._copy_file, source_file, target_file))
+                        continue
+                    copy = libcopy.ChunkedCopy(source_file, target_file)
+                    chunked.append(copy)
+                    for offset, length in copy.chunks(self._copy_chunk_b):
+                        futures.append(pool.submit(copy.copy_chunk, offset, length))
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # The bucket is not committed, a resumed copy repeats the incomplete files
+                for future in futures:
+                    future.cancel()
+                # Running chunk copies still use the files
+                pool.shutdown(wait=True)
+                for copy in chunked:
+                    copy.close()
+                raise
+        for copy in chunked:
+            method = copy.finish()
+            libstats.count('copy_%s' % method)
+            libstats.count('copy_chunked')
+            libstats.add_bytes('archive', copy.size)
+
+    def _restore_file(self, src: str, dst: str) -> None:
+        method = libcopy.copy_file(src, dst)
+        libstats.count('copy_%s' % method)
+        libstats.add_bytes('restore', os.path.getsize(dst))
+
+    def _staging_path(self, destdir: str) -> str:
+        return os.path.join(os.path.dirname(destdir), STAGING_DIR, os.path.basename(destdir))
+
+    def _is_copied(self, src: str, dst: str) -> bool:
+        # Size and mtime are only equal after a complete copy, the mtime is set last
+        try:
+            dst_stat = os.stat(dst)
+        except FileNotFoundError:
+            return False
+        src_stat = os.stat(src)
+        return dst_stat.st_size == src_stat.st_size and dst_stat.st_mtime_ns == src_stat.st_mtime_ns
+
     def _full_path(self, path: str) -> None:
         full_path = os.path.join(self._archive_dir, path)
         return full_path
 
+    @libstats.timed('index_exists')
+    def index_exists(self, indexname: str) -> bool:
+        indexdir = self._full_path(indexname)
+        logger.debug("Checking for index directory %s", indexdir)
+        return os.path.isdir(indexdir)
+
+    @libstats.timed('create_index_dir')
     def create_index_dir(self, indexname):
         indexdir = self._full_path(indexname)
         if not os.path.isdir(indexdir):
-            logger.debug("Creating index directory %s" % indexname)
-            os.mkdir(indexdir)
+            logger.debug("Creating index directory %s", indexname)
+            # Concurrent archives or migrations may create it at the same time
+            os.makedirs(indexdir, exist_ok=True)
 
+    @libstats.timed('check_lock_file')
     def check_lock_file(self, lock_file):
         full_lock_file = self._full_path(lock_file)
-        logger.debug("Checking for lockfile %s" % full_lock_file)
+        logger.debug("Checking for lockfile %s", full_lock_file)
         if os.path.isfile(full_lock_file):
-            logger.debug("Found existing lockfile %s" % full_lock_file)
+            logger.debug("Found existing lockfile %s", full_lock_file)
             return True
         else:
-            logger.debug("No lockfile %s" % full_lock_file)
+            logger.debug("No lockfile %s", full_lock_file)
             return False
 
+    @libstats.timed('lock_file_age')
     def lock_file_age(self, lock_file):
         full_lock_file = self._full_path(lock_file)
         lock_age = os.path.getmtime(full_lock_file)
         return lock_age
 
+    @libstats.timed('write_lock_file')
     def write_lock_file(self, lock_file, hostname):
         full_lock_file = self._full_path(lock_file)
         with open(full_lock_file, 'w') as file:
             file.write(hostname)
-            logger.debug("Created lockfile %s" % full_lock_file)
+            logger.debug("Created lockfile %s", full_lock_file)
             return True
 
+    @libstats.timed('read_lock_file')
     def read_lock_file(self, lock_file):
+        lease = self._read_lease(self._full_path(lock_file))
+        return lease['host'] if lease else None
+
+    def _create_lease(self, full_lock_file: str, lease: dict) -> bool:
+        """ Creates the lock file atomically, also on NFS """
+        try:
+            fd = os.open(full_lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump(lease, f)
+        return True
+
+    def _read_lease(self, full_lock_file: str):
+        """ The lease of a lock file, None if there is none. Lock files being written
+            or written by older versions (the hostname only) expire ttl after their mtime. """
+        try:
+            with open(full_lock_file, 'r') as f:
+                content = f.read()
+            mtime = os.path.getmtime(full_lock_file)
+        except FileNotFoundError:
+            return None
+        try:
+            lease = json.loads(content)
+            if isinstance(lease, dict) and 'expires' in lease:
+                return lease
+        except ValueError:
+            pass
+        return {'host': content.strip() or None, 'pid': None, 'token': None, 'mtime': mtime}
+
+    def _lease_stale(self, lease: dict, hostname: str, ttl: int) -> bool:
+        expires = lease.get('expires', lease.get('mtime', 0) + ttl)
+        if expires < time.time():
+            return True
+        return lease['host'] == hostname and lease['pid'] is not None and not _pid_alive(lease['pid'])
+
+    @libstats.timed('acquire_lock')
+    def acquire_lock(self, lock_file: str, hostname: str, ttl: int) -> bool:
+        """ Creates a lease for host and pid valid for ttl seconds, takes over a stale one """
         full_lock_file = self._full_path(lock_file)
-        with open(full_lock_file, "r") as f:
-            lock_host = f.read().rstrip()
-        return lock_host
+        token = uuid.uuid4().hex
+        lease = {'host': hostname, 'pid': os.getpid(), 'token': token, 'expires': time.time() + ttl}
+        if self._create_lease(full_lock_file, lease):
+            logger.debug("Created lockfile %s", full_lock_file)
+            self._leases[lock_file] = token
+            return True
+        current = self._read_lease(full_lock_file)
+        if current is None or not self._lease_stale(current, hostname, ttl):
+            return False
+        takeover_file = full_lock_file + '.takeover'
+        try:
+            os.close(os.open(takeover_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(takeover_file) > TAKEOVER_TIMEOUT:
+                    os.remove(takeover_file)
+            except FileNotFoundError:
+                pass
+            return False
+        try:
+            # Only remove the lease read before, not one another host created meanwhile
+            if self._read_lease(full_lock_file) == current:
+                logger.warning("Taking over stale lockfile %s of host=%s pid=%s", full_lock_file, current['host'], current['pid'])
+                os.remove(full_lock_file)
+            lease['expires'] = time.time() + ttl
+            if self._create_lease(full_lock_file, lease):
+                self._leases[lock_file] = token
+                return True
+            return False
+        finally:
+            os.remove(takeover_file)
 
+    @libstats.timed('renew_lock')
+    def renew_lock(self, lock_file: str, ttl: int) -> bool:
+        """ Extends the lease of this process, False if it was lost """
+        full_lock_file = self._full_path(lock_file)
+        lease = self._read_lease(full_lock_file)
+        if lease is None or lease.get('token') != self._leases.get(lock_file):
+            return False
+        lease['expires'] = time.time() + ttl
+        tmp_file = '%s.%s.tmp' % (full_lock_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(lease, f)
+        os.replace(tmp_file, full_lock_file)
+        return True
+
+    @libstats.timed('remove_lock_file')
     def remove_lock_file(self, lock_file):
         full_lock_file = self._full_path(lock_file)
-        if os.path.isfile(full_lock_file):
-            os.remove(full_lock_file)
-            logger.debug("Removed lockfile %s" % full_lock_file)
+        # Never remove a lease another process took over
+        lease = self._read_lease(full_lock_file)
+        if lease is None:
+            return
+        if lock_file in self._leases and lease.get('token') != self._leases.pop(lock_file):
+            logger.warning("Lockfile %s was taken over by host=%s pid=%s", full_lock_file, lease['host'], lease['pid'])
+            return
+        os.remove(full_lock_file)
+        logger.debug("Removed lockfile %s", full_lock_file)
 
+    @libstats.timed('bucket_dir')
     def bucket_dir(self, bucket_dir):
         full_bucket_dir = self._full_path(bucket_dir)
         return full_bucket_dir
 
+    @libstats.timed('bucket_exists')
     def bucket_exists(self, bucket_dir):
         full_bucket_dir = self._full_path(bucket_dir)
         if os.path.isdir(full_bucket_dir):
@@ -88,27 +286,42 @@ class c2fDir:
         else:
             return False
 
+    @libstats.timed('bucket_size')
     def bucket_size(self, bucketPath):
-        size = 0
         full_bucket_dir = self._full_path(bucketPath)
-        for path, dirs, files in os.walk(full_bucket_dir):
-            for file in files:
-                filepath = os.path.join(path, file)
-                logger.debug("Getting size for file %s" % filepath)
-                size += os.path.getsize(filepath)
-        return size
+        return libwalk.tree_size(full_bucket_dir, self._walk_threads)
 
+    @libstats.timed('bucket_copy')
     def bucket_copy(self, bucket, destdir):
         full_bucket_dir = self._full_path(destdir)
+        staging_dir = self._full_path(self._staging_path(destdir))
         try:
-            shutil.copytree(bucket, full_bucket_dir)
+            # Resume an interrupted copy, files copied completely are skipped
+            copy_files = []
+            for path, dirs, files in os.walk(bucket):
+                target_path = os.path.join(staging_dir, os.path.relpath(path, bucket))
+                os.makedirs(target_path, exist_ok=True)
+                for file in files:
+                    source_file = os.path.join(path, file)
+                    target_file = os.path.join(target_path, file)
+                    if self._is_copied(source_file, target_file):
+                        logger.debug("Skipping copied file %s", target_file)
+                        libstats.count('copy_skipped')
+                        continue
+                    copy_files.append((source_file, target_file))
+            self._copy_files(copy_files)
+            for path, dirs, files in os.walk(bucket, topdown=False):
+                shutil.copystat(path, os.path.join(staging_dir, os.path.relpath(path, bucket)))
+            # Commit the complete bucket at once
+            os.rename(staging_dir, full_bucket_dir)
         except OSError:
             msg = 'Failed to copy bucket %s to destination %s' % (bucket, full_bucket_dir)
             logger.error(msg)
             sys.exit(msg)
 
+    @libstats.timed('list_indexes')
     def list_indexes(self): 
-        logger.debug("Listing indexes for path %s" % (self._archive_dir))
+        logger.debug("Listing indexes for path %s", self._archive_dir)
         index_list = []
         for index in os.scandir(self._archive_dir):
             index_dir = os.path.join(self._archive_dir, index.name)
@@ -117,25 +330,84 @@ class c2fDir:
             index_list.append(os.path.basename(index_dir))
         return index_list
 
+    @libstats.timed('list_buckets')
     def list_buckets(self, index: str):
         full_index_dir = self._full_path(index)
-        logger.debug("Listing buckets for path %s" % (full_index_dir))
+        logger.debug("Listing buckets for path %s", full_index_dir)
         bucket_list = []
         for object in os.scandir(full_index_dir):
             bucket_name = object.name
-            bucket_dir = os.path.join(full_index_dir, object.name)
             if bucket_name.startswith('db_') or bucket_name.startswith('rb_'):
                 bucket_list.append(bucket_name)
-                bucket_stats = os.stat(bucket_dir)
-                #logger.debug("bucketname=%s, destdir=%s %s" % (bucket_name, bucket_dir, bucket_stats))
         return bucket_list
 
+    @libstats.timed('list_buckets_info')
+    def list_buckets_info(self, index: str, sizes: bool = True) -> dict:
+        """ Size, file count and archive time (ctime of the bucket directory) per bucket """
+        full_index_dir = self._full_path(index)
+        logger.debug("Listing bucket info for path %s", full_index_dir)
+        with os.scandir(full_index_dir) as entries:
+            buckets = [entry for entry in entries if entry.name.startswith('db_') or entry.name.startswith('rb_')]
+        bucket_info = {}
+        for entry, stat in libwalk.stat_entries(buckets, self._walk_threads):
+            bucket_info[entry.name] = {'size': None, 'objects': None, 'archived': stat.st_ctime}
+        if sizes:
+            # All buckets are walked by one pool
+            for path, stats in libwalk.tree_stats([entry.path for entry in buckets], self._walk_threads).items():
+                bucket_info[os.path.basename(path)].update(stats)
+        return bucket_info
+
+    @libstats.timed('restore_bucket')
+    def restore_bucket(self, index: str, bucket_name: str, destdir: str):
+        full_bucket_dir = self._full_path(os.path.join(index,bucket_name))
+        target_dir = os.path.join(destdir, bucket_name)
+        logger.debug("Restoring bucket %s to %s", full_bucket_dir, target_dir)
+        shutil.copytree(full_bucket_dir, target_dir, copy_function=self._restore_file, dirs_exist_ok=True)
+
+    @libstats.timed('remove_bucket')
     def remove_bucket(self, index: str, bucket_name: str):
         full_bucket_dir = self._full_path(os.path.join(index,bucket_name))
+        full_manifest = self._full_path(libchecksum.manifestPath(index, bucket_name))
         try:
-            logger.debug("Remove bucket %s" % (full_bucket_dir))
+            logger.debug("Remove bucket %s", full_bucket_dir)
             shutil.rmtree(full_bucket_dir)
+            if os.path.isfile(full_manifest):
+                os.remove(full_manifest)
         except OSError as ex:
             msg = 'Cannot remove bucket=%s' % full_bucket_dir
             logger.error(msg)
+            return False
+        return True
+
+    @libstats.timed('write_checksums')
+    def write_checksums(self, index: str, bucket_name: str, manifest: dict) -> None:
+        full_manifest = self._full_path(libchecksum.manifestPath(index, bucket_name))
+        os.makedirs(os.path.dirname(full_manifest), exist_ok=True)
+        tmp_file = '%s.%s.tmp' % (full_manifest, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f, separators=(',', ':'))
+        os.replace(tmp_file, full_manifest)
+        logger.debug("Wrote checksums %s", full_manifest)
+
+    @libstats.timed('read_checksums')
+    def read_checksums(self, index: str, bucket_name: str):
+        full_manifest = self._full_path(libchecksum.manifestPath(index, bucket_name))
+        if not os.path.isfile(full_manifest):
+            return None
+        with open(full_manifest, 'r') as f:
+            return json.load(f)
+
+    @libstats.timed('bucket_files')
+    def bucket_files(self, index: str, bucket_name: str) -> dict:
+        """ Path and size per file of an archived bucket, keyed by the path relative to the bucket """
+        full_bucket_dir = self._full_path(os.path.join(index,bucket_name))
+        bucket_files = {}
+        for relative_path, (filepath, stat) in libwalk.tree_files(full_bucket_dir, self._walk_threads).items():
+            bucket_files[relative_path] = {'path': filepath, 'size': stat.st_size, 'mtime': stat.st_mtime}
+        return bucket_files
+
+    @libstats.timed('open_file')
+    def open_file(self, entry: dict):
+        """ File object of a file listed by bucket_files """
+        return open(entry['path'], 'rb')
 
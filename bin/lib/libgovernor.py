@@ -0,0 +1,131 @@
+from lib import libstats
+import os
+import time
+import fcntl
+import errno
+import logging
+from contextlib import contextmanager
+logger = logging.getLogger('splunk.cold2frozen')
+
+# Host-wide limits of the heavy phases of concurrent cold2frozen.py processes.
+# Every phase has a number of slot files, a process holds a slot by an exclusive
+# flock on one of them, which the kernel releases when the process dies. Waiters
+# register in the queue directory of the phase with the size of their bucket, a
+# free slot goes to the smallest bucket waiting, or to a bucket which has waited
+# longer than STARVATION_WAIT regardless of its size.
+
+PHASES = ('size_walk', 'strip', 'upload')
+STARVATION_WAIT = 300
+POLL_MIN = 0.02
+POLL_MAX = 0.5
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        return ex.errno == errno.EPERM
+    return True
+
+class Governor:
+
+    def __init__(self, governor_dir=None, slots=None):
+        self._governor_dir = governor_dir
+        # Slots per phase, a phase without slots is not limited
+        self._slots = slots or {}
+
+    def _phase_dir(self, phase: str) -> str:
+        return os.path.join(self._governor_dir, phase)
+
+    def _try_slots(self, phase: str):
+        """ An open slot file with the lock held, None if all slots are taken """
+        for n in range(self._slots[phase]):
+            f = open(os.path.join(self._phase_dir(phase), '%s.slot' % n), 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return f
+            except BlockingIOError:
+                f.close()
+        return None
+
+    def _free_slots(self, phase: str) -> int:
+        free = 0
+        for n in range(self._slots[phase]):
+            with open(os.path.join(self._phase_dir(phase), '%s.slot' % n), 'a') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                    free += 1
+                except BlockingIOError:
+                    pass
+        return free
+
+    def _rank(self, queue_dir: str, own: str, now: float) -> int:
+        """ Waiters ahead of this one, entries of dead processes are removed """
+        waiters = []
+        for entry in os.scandir(queue_dir):
+            try:
+                size, pid, enqueued = entry.name.split('_')
+                pid, enqueued = int(pid), float(enqueued)
+            except ValueError:
+                continue
+            if entry.name != own and not _pid_alive(pid):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+                continue
+            starving = now - enqueued >= STARVATION_WAIT
+            waiters.append(((0 if starving else 1, int(size), enqueued), entry.name))
+        waiters.sort()
+        return [name for key, name in waiters].index(own)
+
+    @contextmanager
+    def slot(self, phase: str, size: int = 0):
+        """ Holds a slot of the phase for the body, the wait is counted as span wait_<phase> """
+        if self._governor_dir is None or not self._slots.get(phase):
+            yield
+            return
+        queue_dir = os.path.join(self._phase_dir(phase), 'queue')
+        os.makedirs(queue_dir, exist_ok=True)
+        waitstart = time.time()
+        # Zero padded, so a listing sorts by size as well
+        own = '%020d_%s_%.6f' % (max(0, size), os.getpid(), waitstart)
+        open(os.path.join(queue_dir, own), 'w').close()
+        slot_file = None
+        try:
+            with libstats.span('wait_%s' % phase):
+                delay = POLL_MIN
+                while True:
+                    if self._rank(queue_dir, own, time.time()) < self._free_slots(phase):
+                        slot_file = self._try_slots(phase)
+                        if slot_file is not None:
+                            break
+                    time.sleep(delay)
+                    delay = min(delay * 2, POLL_MAX)
+        finally:
+            os.remove(os.path.join(queue_dir, own))
+        waited = time.time() - waitstart
+        if waited > 1:
+            logger.debug('Waited %.1fs for a %s slot (size=%s)', waited, phase, size)
+        try:
+            yield
+        finally:
+            fcntl.flock(slot_file, fcntl.LOCK_UN)
+            slot_file.close()
+
+def fromConfig(config):
+    """ Governor with GOVERNOR_<PHASE>_SLOTS per phase, in GOVERNOR_DIR
+        (default $SPLUNK_HOME/var/run/splunk/cold2frozen_governor) """
+    slots = {}
+    for phase in PHASES:
+        option = 'GOVERNOR_%s_SLOTS' % phase.upper()
+        if config.has_option('cold2frozen', option) and config.get('cold2frozen', option).strip():
+            slots[phase] = config.getint('cold2frozen', option)
+    if not any(slots.values()):
+        return Governor()
+    governor_dir = os.path.join(os.environ['SPLUNK_HOME'], 'var', 'run', 'splunk', 'cold2frozen_governor')
+    if config.has_option('cold2frozen', 'GOVERNOR_DIR') and config.get('cold2frozen', 'GOVERNOR_DIR').strip():
+        governor_dir = config.get('cold2frozen', 'GOVERNOR_DIR').strip()
+    for phase in slots:
+        os.makedirs(os.path.join(governor_dir, phase), exist_ok=True)
+    return Governor(governor_dir, slots)
@@ -0,0 +1,212 @@
+import os
+import io
+import csv
+import gzip
+import json
+import time
+import hashlib
+import threading
+from datetime import datetime, timezone
+from urllib.parse import unquote_plus
+import logging
+logger = logging.getLogger('splunk.cold2frozen')
+
+# pyarrow is optional, without it only CSV inventories can be read
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# S3 Inventory reports as the source of bucket listings of very large archives.
+# A report is <prefix>/<YYYY-MM-DDTHH-MMZ>/manifest.json listing gzipped CSV or
+# Parquet data files with one row per object. The rows are aggregated per index
+# and bucket once and kept in a local cache file, so listing an index costs no
+# object listing, only the live listing of the bucket names (see c2fS3).
+
+MANIFEST = 'manifest.json'
+DEFAULT_SCHEMA = 'Bucket, Key, Size, LastModifiedDate'
+STALE_DAYS = 7
+STAGING_DIR = '.staging'
+
+class LocalSource:
+    """ Inventory reports in a local directory, e.g. generated by inventory_generate.py """
+
+    def __init__(self, path: str):
+        self._path = path
+
+    def list(self, prefix: str) -> list:
+        keys = []
+        for path, dirs, files in os.walk(os.path.join(self._path, prefix)):
+            for file in files:
+                keys.append(os.path.relpath(os.path.join(path, file), self._path))
+        return keys
+
+    def read(self, key: str) -> bytes:
+        with open(os.path.join(self._path, key), 'rb') as f:
+            return f.read()
+
+class S3Source:
+    """ Inventory reports in an s3 bucket, read with an s3 client """
+
+    def __init__(self, client, bucket: str):
+        self._client = client
+        self._bucket = bucket
+
+    def list(self, prefix: str) -> list:
+        keys = []
+        paginator = self._client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self._bucket, Prefix=prefix):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        return keys
+
+    def read(self, key: str) -> bytes:
+        return self._client.get_object(Bucket=self._bucket, Key=key)['Body'].read()
+
+def latest_manifest(source, prefix: str):
+    """ Key of the newest manifest.json below prefix, the report folders sort by date """
+    manifests = [key for key in source.list(prefix) if os.path.basename(key) == MANIFEST and '/hive/' not in key]
+    if not manifests:
+        return None
+    return max(manifests, key=lambda key: os.path.basename(os.path.dirname(key)))
+
+def _rows(manifest: dict, data: bytes):
+    """ (key, size, last_modified) of every object of a data file """
+    file_format = manifest.get('fileFormat', 'CSV')
+    if file_format == 'CSV':
+        schema = [field.strip() for field in manifest.get('fileSchema', DEFAULT_SCHEMA).split(',')]
+        key_col, size_col, modified_col = schema.index('Key'), schema.index('Size'), schema.index('LastModifiedDate')
+        for row in csv.reader(io.TextIOWrapper(gzip.GzipFile(fileobj=io.BytesIO(data)), encoding='utf-8', newline='')):
+            # Keys are URL encoded in CSV reports, delete markers have no size
+            if not row[size_col]:
+                continue
+            yield unquote_plus(row[key_col]), int(row[size_col]), row[modified_col]
+    elif file_format == 'Parquet':
+        if pyarrow is None:
+            msg = 'Python module pyarrow is required to read Parquet inventory reports'
+            logger.error(msg)
+            raise Exception(msg)
+        table = pyarrow.parquet.read_table(io.BytesIO(data), columns=['key', 'size', 'last_modified_date']).to_pydict()
+        for key, size, modified in zip(table['key'], table['size'], table['last_modified_date']):
+            if size is not None:
+                yield key, size, modified
+    else:
+        msg = 'Inventory format %s is not supported, must be CSV or Parquet' % file_format
+        logger.error(msg)
+        raise Exception(msg)
+
+def _timestamp(modified) -> float:
+    if isinstance(modified, datetime):
+        return modified.replace(tzinfo=timezone.utc).timestamp()
+    return datetime.strptime(modified[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+
+class Inventory:
+
+    def __init__(self, source, prefix: str, archive_dir: str, cache_dir=None):
+        self._source = source
+        self._prefix = prefix
+        self._archive_dir = os.path.join(archive_dir.strip('/'), '')
+        self._cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._indexes = None
+        self.created = None
+
+    def _aggregate(self, manifest: dict) -> dict:
+        indexes = {}
+        # Buckets with an upload marker, see c2fS3
+        uploading = set()
+        for data_file in manifest['files']:
+            for key, size, modified in _rows(manifest, self._source.read(data_file['key'])):
+                if not key.startswith(self._archive_dir):
+                    continue
+                parts = key[len(self._archive_dir):].split('/', 2)
+                if len(parts) == 3 and parts[1] == STAGING_DIR:
+                    uploading.add((parts[0], parts[2].split('/', 1)[0]))
+                    continue
+                # Objects of buckets only, not of .staging or .checksums
+                if len(parts) < 3 or not (parts[1].startswith('db') or parts[1].startswith('rb')):
+                    continue
+                archived = _timestamp(modified)
+                info = indexes.setdefault(parts[0], {}).get(parts[1])
+                if info is None:
+                    info = indexes[parts[0]][parts[1]] = {'size': 0, 'objects': 0, 'archived': archived}
+                info['size'] += size
+                info['objects'] += 1
+                if archived > info['archived']:
+                    info['archived'] = archived
+        for index, bucket_name in uploading:
+            indexes.get(index, {}).pop(bucket_name, None)
+        return indexes
+
+    def _load(self) -> None:
+        manifest_key = latest_manifest(self._source, self._prefix)
+        if manifest_key is None:
+            msg = 'No inventory manifest found below %s' % self._prefix
+            logger.error(msg)
+            raise Exception(msg)
+        cache_file = None
+        if self._cache_dir:
+            # One cache file per inventory, named after the inventory and its latest manifest
+            inventory = hashlib.md5((self._prefix + self._archive_dir).encode('utf-8')).hexdigest()
+            digest = hashlib.md5((manifest_key + self._archive_dir).encode('utf-8')).hexdigest()
+            cache_file = os.path.join(self._cache_dir, 'cold2frozen_inventory_%s_%s.json' % (inventory, digest))
+        if cache_file and os.path.isfile(cache_file):
+            try:
+                with open(cache_file, 'r') as f:
+                    cached = json.load(f)
+                self.created, self._indexes = cached['created'], cached['indexes']
+                return
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.warning('Unreadable inventory cache file=%s, aggregating the manifest again: %s', cache_file, e)
+        manifest = json.loads(self._source.read(manifest_key))
+        # creationTimestamp is in milliseconds
+        self.created = int(manifest['creationTimestamp']) / 1000
+        loadstart = time.time()
+        self._indexes = self._aggregate(manifest)
+        logger.info('Loaded inventory manifest=%s created=%s indexes=%s in %.1fs', manifest_key, int(self.created), len(self._indexes), time.time() - loadstart)
+        if cache_file:
+            tmp_file = '%s.%s.tmp' % (cache_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump({'created': self.created, 'indexes': self._indexes}, f, separators=(',', ':'))
+            os.replace(tmp_file, cache_file)
+            self._remove_old_caches(cache_file, 'cold2frozen_inventory_%s_' % inventory)
+
+    def _remove_old_caches(self, cache_file: str, name_prefix: str) -> None:
+        """ Removes the cache files of older manifests of the inventory """
+        try:
+            names = os.listdir(self._cache_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self._cache_dir, name)
+            if name.startswith(name_prefix) and name.endswith('.json') and path != cache_file:
+                try:
+                    os.remove(path)
+                    logger.debug('Removed old inventory cache file=%s', path)
+                except OSError as e:
+                    logger.warning('Failed to remove old inventory cache file=%s: %s', path, e)
+
+    def buckets(self, index: str) -> dict:
+        """ Size, object count and archive time per bucket of the index at the inventory date """
+        with self._lock:
+            if self._indexes is None:
+                self._load()
+                if self.created < time.time() - STALE_DAYS * 86400:
+                    logger.warning('Inventory is %s days old, buckets archived since are listed live', int((time.time() - self.created) / 86400))
+        return self._indexes.get(index, {})
+
+# Inventories by location and archive dir, the storage handlers of all threads share them
+_inventories = {}
+_inventories_lock = threading.Lock()
+
+def open_inventory(location: str, client, archive_dir: str, cache_dir=None):
+    """ Inventory at s3://bucket/prefix or in a local directory, loaded on first use """
+    with _inventories_lock:
+        inventory = _inventories.get((location, archive_dir))
+        if inventory is None:
+            if location.startswith('s3://'):
+                bucket, _, prefix = location[len('s3://'):].partition('/')
+                source = S3Source(client, bucket)
+            else:
+                source, prefix = LocalSource(location), ''
+            inventory = _inventories[(location, archive_dir)] = Inventory(source, prefix, archive_dir, cache_dir)
+        return inventory
@@ -1,19 +1,32 @@
 import os
+import atexit
+import multiprocessing
 import logging, logging.handlers
 import splunk
 
+# Loggers set up by this process, with the listener writing their records
+_listeners = {}
+
 def setup_logging(name):
 
     ### Logging examples
     # logger.debug('debug message')
-    # logger.info('info message')
+    # logger.info('info message %s', value)
     # logger.warning('warn message')
     # logger.error('error message')
     # logger.critical('critical message')
 
+    # Pass the values as arguments instead of formatting the message with %,
+    # so the message is only formatted if the level is enabled
+
     # INSTANCE_NAME = os.path.basename(__file__).split(".")[0].lower()
     LOGFILE_NAME = 'cold2frozen'
     logger = logging.getLogger(name)
+
+    # Set up every logger only once, also if a script calls this repeatedly
+    if name in _listeners:
+        return logger
+
     SPLUNK_HOME = os.environ['SPLUNK_HOME']
     LOGGING_DEFAULT_CONFIG_FILE = os.path.join(SPLUNK_HOME, 'etc', 'log.cfg')
     LOGGING_LOCAL_CONFIG_FILE = os.path.join(SPLUNK_HOME, 'etc', 'log-local.cfg')
@@ -24,6 +37,16 @@ def setup_logging(name):
     # Use the same format as splunkd.log
     LOGGING_FORMAT = logging.Formatter("%(asctime)s %(levelname)-s  %(module)s - %(message)s", "%m-%d-%Y %H:%M:%S.%03d %z")
     splunk_log_handler.setFormatter(LOGGING_FORMAT)
-    logger.addHandler(splunk_log_handler)
+
+    # The logger only puts the records on a queue, a listener thread of this
+    # process writes them to the file. Forked worker processes inherit the
+    # queue handler, so all of them write through the one file handler.
+    log_queue = multiprocessing.Queue(-1)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, splunk_log_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    _listeners[name] = listener
+
     splunk.setupSplunkLogger(logger, LOGGING_DEFAULT_CONFIG_FILE, LOGGING_LOCAL_CONFIG_FILE, LOGGING_STANZA_NAME)
-    return logger
\ No newline at end of file
+    return logger
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import fcntl
+import threading
+import logging
+logger = logging.getLogger('splunk.cold2frozen')
+
+# OpenMetrics textfile for a node-exporter style collector. Many cold2frozen
+# processes update it concurrently, so the values are merged into a JSON state
+# file under an exclusive lock and the text file is rendered from it and
+# replaced atomically.
+
+HISTOGRAM_BUCKETS = [0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600]
+
+METRICS = {
+    'c2f_bytes': ('counter', 'Bytes archived, restored or removed'),
+    'c2f_operations': ('counter', 'Finished bucket operations by status'),
+    'c2f_lock_timeouts': ('counter', 'Bucket lock acquisitions that timed out'),
+    'c2f_operation_seconds': ('histogram', 'Duration of bucket operations'),
+    'c2f_lock_wait_seconds': ('histogram', 'Time spent waiting for bucket locks'),
+    'c2f_in_progress': ('gauge', 'Bucket operations currently running'),
+    'c2f_archive_size_bytes': ('gauge', 'Archived bytes per index'),
+    'c2f_archive_buckets': ('gauge', 'Archived buckets per index'),
+}
+
+def _labelkey(labels: dict) -> str:
+    return ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in sorted(labels.items()))
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class Metrics:
+
+    def __init__(self, metrics_file=None, flush_interval=10):
+        self._metrics_file = metrics_file
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = self._empty()
+        self._lastflush = time.time()
+
+    @property
+    def enabled(self):
+        return self._metrics_file is not None
+
+    def _empty(self) -> dict:
+        return {'counter': {}, 'histogram': {}, 'gauge': {}, 'start': [], 'finish': []}
+
+    def inc(self, name: str, labels: dict, value=1) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            series = self._pending['counter'].setdefault(name, {})
+            key = _labelkey(labels)
+            series[key] = series.get(key, 0) + value
+        self._maybe_flush()
+
+    def observe(self, name: str, labels: dict, seconds: float) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pending['histogram'].setdefault(name, {}).setdefault(_labelkey(labels), []).append(seconds)
+        self._maybe_flush()
+
+    def set(self, name: str, labels: dict, value) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pending['gauge'].setdefault(name, {})[_labelkey(labels)] = value
+        self._maybe_flush()
+
+    def record(self, op: str, labels: dict, status: str, seconds: float, size=None) -> None:
+        """ Count a finished operation, its duration and, if known, its bytes """
+        self.inc('c2f_operations', dict(labels, op=op, status=status))
+        self.observe('c2f_operation_seconds', dict(labels, op=op), seconds)
+        if size is not None:
+            self.inc('c2f_bytes', dict(labels, op=op), size)
+
+    def start(self, op: str, labels: dict) -> None:
+        """ Count an operation of this process as in progress until finish() """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pending['start'].append(_labelkey(dict(labels, op=op)))
+        self.flush()
+
+    def finish(self, op: str, labels: dict) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pending['finish'].append(_labelkey(dict(labels, op=op)))
+        self.flush()
+
+    def _maybe_flush(self) -> None:
+        if time.time() - self._lastflush >= self._flush_interval:
+            self.flush()
+
+    def _merge(self, state: dict, pending: dict) -> None:
+        for name, series in pending['counter'].items():
+            target = state['counter'].setdefault(name, {})
+            for key, value in series.items():
+                target[key] = target.get(key, 0) + value
+        for name, series in pending['histogram'].items():
+            target = state['histogram'].setdefault(name, {})
+            for key, values in series.items():
+                hist = target.setdefault(key, {'buckets': [0] * len(HISTOGRAM_BUCKETS), 'count': 0, 'sum': 0.0})
+                for value in values:
+                    for i, bound in enumerate(HISTOGRAM_BUCKETS):
+                        if value <= bound:
+                            hist['buckets'][i] += 1
+                    hist['count'] += 1
+                    hist['sum'] += value
+        for name, series in pending['gauge'].items():
+            state['gauge'].setdefault(name, {}).update(series)
+        # In progress operations are kept per pid, so crashed processes drop out
+        pid = str(os.getpid())
+        inprogress = state['inprogress']
+        for key in pending['start']:
+            inprogress.setdefault(pid, []).append(key)
+        for key in pending['finish']:
+            if key in inprogress.get(pid, []):
+                inprogress[pid].remove(key)
+        for stale in [p for p, keys in inprogress.items() if not keys or not _pid_alive(int(p))]:
+            del inprogress[stale]
+
+    def _render(self, state: dict) -> str:
+        inprogress = {}
+        for keys in state['inprogress'].values():
+            for key in keys:
+                inprogress[key] = inprogress.get(key, 0) + 1
+        gauges = dict(state['gauge'])
+        gauges['c2f_in_progress'] = inprogress
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            if kind == 'counter':
+                series = state['counter'].get(name, {})
+            elif kind == 'histogram':
+                series = state['histogram'].get(name, {})
+            else:
+                series = gauges.get(name, {})
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('# HELP %s %s' % (name, help_text))
+            for key, value in sorted(series.items()):
+                if kind == 'counter':
+                    lines.append('%s_total{%s} %s' % (name, key, value))
+                elif kind == 'gauge':
+                    lines.append('%s{%s} %s' % (name, key, value))
+                else:
+                    sep = ',' if key else ''
+                    for bound, bucket_count in zip(HISTOGRAM_BUCKETS, value['buckets']):
+                        lines.append('%s_bucket{%s%sle="%s"} %s' % (name, key, sep, bound, bucket_count))
+                    lines.append('%s_bucket{%s%sle="+Inf"} %s' % (name, key, sep, value['count']))
+                    lines.append('%s_count{%s} %s' % (name, key, value['count']))
+                    lines.append('%s_sum{%s} %s' % (name, key, round(value['sum'], 6)))
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def _replace(self, path: str, content: str) -> None:
+        tmp_file = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_file, 'w') as f:
+            f.write(content)
+        os.replace(tmp_file, path)
+
+    def flush(self) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            pending = self._pending
+            self._pending = self._empty()
+            self._lastflush = time.time()
+        state_file = self._metrics_file + '.json'
+        try:
+            with open(self._metrics_file + '.lock', 'a') as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                state = {'counter': {}, 'histogram': {}, 'gauge': {}, 'inprogress': {}}
+                if os.path.isfile(state_file):
+                    try:
+                        with open(state_file, 'r') as f:
+                            state.update(json.load(f))
+                    except ValueError:
+                        logger.warning('Resetting unreadable metrics state %s', state_file)
+                self._merge(state, pending)
+                self._replace(state_file, json.dumps(state, separators=(',', ':')))
+                self._replace(self._metrics_file, self._render(state))
+        except OSError as ex:
+            # Metrics must never fail an archive or restore
+            logger.warning('Cannot update metrics file %s: %s', self._metrics_file, ex)
+
+def fromConfig(config):
+    """ Metrics for METRICS_FILE of the [cold2frozen] stanza, disabled if it is not set """
+    metrics_file = None
+    if config.has_option('cold2frozen', 'METRICS_FILE'):
+        metrics_file = config.get('cold2frozen', 'METRICS_FILE').strip() or None
+    if metrics_file and metrics_file.find('/') == -1:
+        metrics_file = os.path.join(os.environ['SPLUNK_HOME'], 'var', 'run', 'splunk', metrics_file)
+    return Metrics(metrics_file)
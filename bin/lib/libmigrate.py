@@ -0,0 +1,135 @@
+from lib import libc2f
+from lib import libverify
+from lib import libchecksum
+import os
+import shutil
+import tempfile
+import threading
+import time
+import logging
+logger = logging.getLogger('splunk.cold2frozen')
+
+# Migration of archived buckets between two backends. A bucket of a dir source
+# is copied straight from the archive, other sources are restored into a work
+# directory first. Both bucket_copy implementations are staged and resume an
+# interrupted copy, a bucket is only visible on the target once it is complete.
+
+def local_bucket_dir(storage, index: str, bucket_name: str):
+    """ The local path of an archived bucket, None if it must be downloaded """
+    if storage.type == 'tier':
+        storage = storage.nearest(os.path.join(index,bucket_name))
+    if storage.type == 'dir':
+        return storage.bucket_dir(os.path.join(index,bucket_name))
+    return None
+
+def verify_target(target, index: str, bucket_name: str, manifest: dict, pool) -> dict:
+    """ Checks the migrated bucket against the manifest on its nearest tier """
+    if target.type == 'tier':
+        target = target.nearest(os.path.join(index,bucket_name))
+    if target.type == 'dir':
+        return libverify.DirVerification(target, index, bucket_name, manifest, pool).result()
+    return libverify.verify_s3(target, index, bucket_name, manifest)
+
+def migrate_bucket(source, target, index: str, bucket_name: str, size: int, workdir: str, pool, checksums: bool = True) -> str:
+    """ Copies one bucket from source to target and verifies it, returns the status """
+    bucket_dir = os.path.join(index,bucket_name)
+    if target.bucket_exists(bucket_dir) and target.bucket_size(bucket_dir) == size:
+        return 'existed'
+    target.create_index_dir(index)
+    bucketpath = local_bucket_dir(source, index, bucket_name)
+    downloaddir = None
+    try:
+        if bucketpath is None:
+            downloaddir = tempfile.mkdtemp(prefix='.migrate.', dir=workdir)
+            with libc2f.span('download'):
+                source.restore_bucket(index, bucket_name, downloaddir)
+            bucketpath = os.path.join(downloaddir, bucket_name)
+        manifest = None
+        if checksums:
+            manifest = source.read_checksums(index, bucket_name)
+            if manifest is None:
+                # Record the checksums now, the target can be verified and bucket_verify.py can check it later
+                with libc2f.span('checksum'):
+                    manifest = libchecksum.bucketManifest(bucketpath)
+        try:
+            with libc2f.span('upload'):
+                target.bucket_copy(bucketpath, bucket_dir)
+        except SystemExit:
+            return 'failed_copy'
+    finally:
+        if downloaddir:
+            shutil.rmtree(downloaddir, ignore_errors=True)
+    # A bad copy is removed, otherwise the next run would skip it as existing
+    if target.bucket_size(bucket_dir) != size:
+        target.remove_bucket(index, bucket_name)
+        return 'failed_size'
+    if manifest is not None:
+        target.write_checksums(index, bucket_name, manifest)
+        with libc2f.span('verify'):
+            result = verify_target(target, index, bucket_name, manifest, pool)
+        if libverify.status(result) == 'corrupt':
+            logger.error('Migrated bucket=%s differs from its checksums: missing=%s mismatched=%s', bucket_name, result['missing'], result['mismatched'])
+            target.remove_bucket(index, bucket_name)
+            return 'failed_verify'
+    return 'migrated'
+
+class Throughput:
+    """ Bytes migrated over the whole run and over the last progress interval. With a
+        target, the buckets in flight are limited to between 1 and numprocs and the
+        limit is adjusted toward the target by interval. """
+
+    def __init__(self, numprocs: int, target_mbps=0):
+        self._numprocs = numprocs
+        self._target_mbps = target_mbps
+        self._lock = threading.Lock()
+        self._slots = threading.Condition(self._lock)
+        self._start = self._interval_start = time.time()
+        self.total_b = 0
+        self._interval_b = 0
+        self.limit = numprocs
+        self._in_flight = 0
+
+    def acquire(self) -> None:
+        """ Waits until one more bucket may be in flight """
+        with self._slots:
+            while self._in_flight >= self.limit:
+                self._slots.wait()
+            self._in_flight += 1
+
+    def release(self) -> None:
+        with self._slots:
+            self._in_flight -= 1
+            self._slots.notify()
+
+    def add(self, size: int) -> None:
+        with self._lock:
+            self.total_b += size
+            self._interval_b += size
+
+    def mbps(self) -> float:
+        seconds = time.time() - self._start
+        return round(self.total_b / 1024 / 1024 / seconds, 3) if seconds > 0 else 0
+
+    def interval(self, remaining_b: int) -> dict:
+        """ Progress fields of the interval since the last call, adjusts the limit toward the target """
+        with self._slots:
+            now = time.time()
+            seconds = now - self._interval_start
+            mbps = self._interval_b / 1024 / 1024 / seconds if seconds > 0 else 0
+            self._interval_start = now
+            self._interval_b = 0
+            # An interval without a finished bucket tells nothing about the rate
+            if self._target_mbps and mbps > 0:
+                # Buckets are copied independently, throughput scales with the parallel buckets until a link or disk saturates
+                if mbps > self._target_mbps:
+                    self.limit = max(1, int(self.limit * self._target_mbps / mbps))
+                else:
+                    self.limit = min(self._numprocs, int(self.limit * self._target_mbps / mbps) + 1)
+                self._slots.notify_all()
+            limit = self.limit
+        fields = {'mbps': round(mbps, 3), 'migrated_b': self.total_b, 'remaining_b': remaining_b, 'numprocs': limit}
+        fields['eta_s'] = round(remaining_b / 1024 / 1024 / mbps) if mbps > 0 else None
+        if self._target_mbps and 0 < mbps < self._target_mbps and limit == self._numprocs:
+            # The target needs more parallel buckets than allowed
+            fields['suggested_numprocs'] = int(limit * self._target_mbps / mbps) + 1
+        return fields
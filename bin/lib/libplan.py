@@ -0,0 +1,111 @@
+from lib import libcompress
+from lib import libwalk
+import os
+import shutil
+import logging
+logger = logging.getLogger('splunk.cold2frozen')
+
+# Restore plans: the bytes, objects and estimated duration of a restore from one
+# listing of the index, and the buckets admitted to it. Buckets are admitted in
+# the planned order until the next one would exceed the free space of the target
+# (less a reserve) or the byte budget, so a restore never stops halfway through
+# a bucket for lack of space. Decompressed and rebuilt buckets take more space
+# on the target than in the archive, their sizes are scaled by an expansion
+# ratio.
+
+ORDERS = ('oldest', 'newest', 'smallest')
+# Assumed throughput and request latency per object, if not configured
+DEFAULT_MBPS = {'dir': 500, 's3': 100, 'tier': 100}
+OBJECT_LATENCY = {'dir': 0.001, 's3': 0.03, 'tier': 0.03}
+# Assumed ratio of the restored to the archived size, if not configured
+DEFAULT_EXPANSION = {'decompress': 3.0, 'rebuild': 2.0}
+
+def default_expansion(decompress: bool = False, rebuild: bool = False) -> float:
+    """ Expansion ratio of the restored buckets, the largest of the requested modes """
+    ratios = [1.0]
+    if decompress:
+        ratios.append(DEFAULT_EXPANSION['decompress'])
+    if rebuild:
+        ratios.append(DEFAULT_EXPANSION['rebuild'])
+    return max(ratios)
+
+class RestorePlan:
+
+    def __init__(self, backend: str, mbps=None, expansion: float = 1.0):
+        self.backend = backend
+        self.mbps = mbps or DEFAULT_MBPS.get(backend, 100)
+        self.expansion = expansion
+        self.admitted = []
+        # Admitted and existing buckets in the planned order
+        self.buckets = []
+        self.existing = []
+        self.deferred = []
+        self.bytes = 0
+        # Space the admitted buckets need on the target, bytes scaled by the expansion
+        self.needed_b = 0
+        self.objects = 0
+        self.free_b = None
+        self.limit_b = None
+
+    @property
+    def estimate_s(self) -> float:
+        """ Transfer time at the assumed throughput plus a request latency per object """
+        seconds = self.bytes / 1024 / 1024 / self.mbps + self.objects * OBJECT_LATENCY.get(self.backend, 0.03)
+        return round(seconds, 1)
+
+    @property
+    def complete(self) -> bool:
+        return not self.deferred
+
+    def fields(self) -> dict:
+        """ Log fields of the plan """
+        return {'plan_buckets': len(self.admitted), 'plan_existing': len(self.existing), 'plan_deferred': len(self.deferred),
+                'plan_b': self.bytes, 'plan_objects': self.objects, 'plan_estimate_s': self.estimate_s,
+                'plan_needed_b': self.needed_b, 'plan_expansion': self.expansion,
+                'plan_free_b': self.free_b, 'plan_limit_b': self.limit_b}
+
+def _order(buckets: list, order: str) -> list:
+    if order == 'newest':
+        return sorted(buckets, key=lambda bucket: bucket.end, reverse=True)
+    if order == 'smallest':
+        return sorted(buckets, key=lambda bucket: bucket.size)
+    return sorted(buckets, key=lambda bucket: bucket.start)
+
+def existing_size(targetdir: str, bucket_name: str):
+    """ Size of a bucket restored earlier, None if there is none """
+    bucketdir = os.path.join(targetdir, bucket_name)
+    if not os.path.isdir(bucketdir):
+        return None
+    # A decompressed bucket keeps its archived size in a marker
+    archived_size = libcompress.decompressed_size(bucketdir)
+    if archived_size is not None:
+        return archived_size
+    return libwalk.tree_size(bucketdir)
+
+def plan_restore(buckets, objects: dict, targetdir: str, backend: str, order: str = 'oldest', reserve_b: int = 0, budget_b: int = 0, mbps=None, expansion: float = 1.0) -> RestorePlan:
+    """ Admits the buckets (with sizes from the listing) which fit into targetdir.
+        objects is the object count per bucket name. A complete bucket in the
+        target takes no space, a partial one is replaced and its space counts as free.
+        Every bucket needs its size times expansion. """
+    plan = RestorePlan(backend, mbps, expansion)
+    plan.free_b = shutil.disk_usage(targetdir).free
+    plan.limit_b = max(0, plan.free_b - reserve_b)
+    if budget_b:
+        plan.limit_b = min(plan.limit_b, budget_b)
+    for bucket in _order(list(buckets), order):
+        size = existing_size(targetdir, bucket.name)
+        if size == bucket.size:
+            plan.existing.append(bucket)
+            plan.buckets.append(bucket)
+            continue
+        needed = max(0, int(bucket.size * expansion) - (size or 0))
+        if plan.deferred or plan.needed_b + needed > plan.limit_b:
+            # Admit a prefix of the order, a gap in the middle of a time range is worse than a shorter range
+            plan.deferred.append(bucket)
+            continue
+        plan.admitted.append(bucket)
+        plan.buckets.append(bucket)
+        plan.bytes += max(0, bucket.size - (size or 0))
+        plan.needed_b += needed
+        plan.objects += objects.get(bucket.name) or 0
+    return plan
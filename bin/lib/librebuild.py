@@ -0,0 +1,278 @@
+from __future__ import print_function
+from lib import libc2f
+import os
+import subprocess
+import re
+import time
+import json
+import shutil
+import signal
+import threading
+import logging
+logger = logging.getLogger('splunk.cold2frozen')
+
+STATE_FILE = '.c2f_rebuild_state'
+
+# Patterns for the output of splunk rebuild, compiled once
+LEVEL_PATTERN = re.compile(r'\b(INFO|WARN|ERROR)\b')
+SKIP_PATTERN = re.compile(r'IndexConfig - Asked to check if idx= is an index')
+
+def parse_line(line: str):
+    """ Returns the level of a relevant output line, None otherwise """
+    match = LEVEL_PATTERN.search(line)
+    if not match:
+        return None
+    level = match.group(1)
+    if level == 'ERROR' and SKIP_PATTERN.search(line):
+        return None
+    return level
+
+def rebuilding_marker(bucketdir: str) -> str:
+    """ Marker beside the bucket while its rebuild runs, left behind if the rebuild is killed """
+    return os.path.join(os.path.dirname(bucketdir), '.%s.rebuilding' % os.path.basename(bucketdir))
+
+def is_rebuilt(bucketdir: str) -> bool:
+    """ Cheap check of the top level of a bucket, a rebuilt bucket has tsidx files and Hosts.data """
+    if os.path.exists(rebuilding_marker(bucketdir)):
+        return False
+    has_tsidx = False
+    has_hosts = False
+    try:
+        for entry in os.scandir(bucketdir):
+            if entry.name.endswith('.tsidx'):
+                has_tsidx = True
+            elif entry.name == 'Hosts.data':
+                has_hosts = True
+    except OSError:
+        return False
+    return has_tsidx and has_hosts
+
+class RebuildState:
+    """ Rebuild results of a thawed directory, checkpointed to a state file after every change """
+
+    def __init__(self, thaweddir: str):
+        self._state_file = os.path.join(thaweddir, STATE_FILE)
+        self._lock = threading.Lock()
+        self._buckets = {}
+        if os.path.isfile(self._state_file):
+            try:
+                with open(self._state_file, 'r') as f:
+                    self._buckets = json.load(f)
+            except ValueError:
+                logger.warning('Ignoring unreadable rebuild state file %s', self._state_file)
+
+    def status(self, bucketname: str):
+        entry = self._buckets.get(bucketname)
+        if entry:
+            return entry.get('status')
+        return None
+
+    def record(self, bucketname: str, status: str, reason=None) -> None:
+        with self._lock:
+            self._buckets[bucketname] = {'status': status, 'reason': reason, 'time': int(time.time())}
+            tmp_file = self._state_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(self._buckets, f)
+            os.replace(tmp_file, self._state_file)
+
+    def done(self, thaweddir: str, bucketname: str) -> bool:
+        """ True if the bucket was rebuilt already, per state file, or per bucket contents if it has no state """
+        status = self.status(bucketname)
+        if status == 'rebuilt':
+            return True
+        # A failed or killed rebuild may have left tsidx files behind, it is retried
+        if status is not None and status.startswith('failed'):
+            return False
+        return is_rebuilt(os.path.join(thaweddir, bucketname))
+
+class PressureMonitor:
+    """ System pressure in percent, from Linux PSI if available, else from the load average """
+
+    PSI_RESOURCES = ['cpu', 'io', 'memory']
+
+    def __init__(self):
+        if os.path.isfile('/proc/pressure/cpu'):
+            self._source = 'psi'
+        else:
+            self._source = 'loadavg'
+        self._cpus = os.cpu_count() or 1
+
+    @property
+    def source(self):
+        return self._source
+
+    def _psi(self, resource: str) -> float:
+        # some avg10=1.23 avg60=0.50 avg300=0.10 total=12345
+        with open(os.path.join('/proc/pressure', resource), 'r') as f:
+            for line in f:
+                fields = line.split()
+                if fields and fields[0] == 'some':
+                    return float(fields[1].split('=')[1])
+        return 0.0
+
+    def sample(self) -> float:
+        if self._source == 'psi':
+            try:
+                return max(self._psi(resource) for resource in self.PSI_RESOURCES)
+            except (OSError, ValueError, IndexError):
+                logger.warning('Cannot read /proc/pressure, falling back to load average')
+                self._source = 'loadavg'
+        return os.getloadavg()[0] / self._cpus * 100
+
+class ConcurrencyController:
+    """ Raises or lowers a process limit between bounds based on system pressure """
+
+    # Default thresholds (high, low) in percent per pressure source
+    THRESHOLDS = {'psi': (40.0, 10.0), 'loadavg': (90.0, 60.0)}
+
+    def __init__(self, minprocs: int, maxprocs: int, high=None, low=None):
+        self._minprocs = max(1, minprocs)
+        self._maxprocs = max(self._minprocs, maxprocs)
+        self._monitor = PressureMonitor()
+        default_high, default_low = self.THRESHOLDS[self._monitor.source]
+        self._high = high if high is not None else default_high
+        self._low = low if low is not None else default_low
+
+    @property
+    def minprocs(self):
+        return self._minprocs
+
+    def adjust(self, limit: int, active: int) -> int:
+        """ Returns the new limit, one step per call """
+        pressure = self._monitor.sample()
+        newlimit = limit
+        if pressure > self._high and limit > self._minprocs:
+            newlimit = limit - 1
+        # Only raise the limit if the current one is used up
+        elif pressure < self._low and limit < self._maxprocs and active >= limit:
+            newlimit = limit + 1
+        if newlimit != limit:
+            logFields = libc2f.logDict()
+            logFields.add('status', 'concurrency')
+            logFields.add('source', self._monitor.source)
+            logFields.add('pressure', round(pressure, 2))
+            logFields.add('active', active)
+            logFields.add('procs_old', limit)
+            logFields.add('procs_new', newlimit)
+            logger.info(logFields.kvout())
+        return newlimit
+
+def rebuild_command(bucketdir: str, ionice=None) -> list:
+    command = ['splunk', 'rebuild', bucketdir]
+    if ionice is not None:
+        if shutil.which('ionice'):
+            command = ['ionice', '-c', str(ionice)] + command
+        else:
+            logger.warning('ionice not found, running rebuild without io class')
+    return command
+
+def skip_bucket(bucketname: str, thaweddir: str):
+    logFields = libc2f.logDict()
+    logFields.add('status', 'existed')
+    logFields.add('bucketname', bucketname)
+    logFields.add('destdir', os.path.join(thaweddir, bucketname))
+    msg = 'Skipping already rebuilt bucket %s' % bucketname
+    print(msg, flush=True)
+    logger.info(logFields.kvout())
+
+def log_event(workerid, bucketname: str, level: str, line: str):
+    logFields = libc2f.logDict()
+    if level == 'ERROR':
+        logFields.add('status', 'rebuild_error')
+    else:
+        logFields.add('status', 'rebuild_progress')
+    logFields.add('bucketname', bucketname)
+    logFields.add('level', level)
+    logFields.add('output', "'" + line + "'")
+    print('%s: %s' % (workerid, line), flush=True)
+    if level == 'ERROR':
+        logger.warning(logFields.kvout())
+    else:
+        logger.info(logFields.kvout())
+
+def rebuild_bucket(workerid, bucketname: str, thaweddir: str, nice=None, ionice=None, timeout=None):
+    logFields = libc2f.logDict()
+    logFields.add('status', 'rebuilt')
+    logger.debug('Starting rebuild_bucket(), workerid: %s, bucketname: %s', workerid, bucketname)
+    logFields.add('bucketname', bucketname)
+    logger.debug("bucketname is %s", bucketname)
+    destdir = os.path.join(thaweddir, bucketname)
+    logFields.add('destdir', destdir)
+    logger.debug("destdir is %s", destdir)
+    msg = '%s: START - Rebuilding bucket %s' % (workerid, bucketname)
+    print(msg, flush=True)
+    bucket_size_source = libc2f.getBucketSize(os.path.join(thaweddir,bucketname))
+    logFields.add('bucketsize_b', bucket_size_source)
+    # Run the rebuild command
+    rebuildstart = time.time() * 1000
+    preexec = None
+    if nice is not None:
+        preexec = lambda: os.nice(nice)
+    # Unfortunately, the command outputs all to stderr, so both are read as one stream.
+    # A new session lets a timeout kill splunk and all of its children.
+    marker = rebuilding_marker(destdir)
+    open(marker, 'w').close()
+    process = subprocess.Popen(rebuild_command(os.path.join(thaweddir,bucketname), ionice), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=preexec, start_new_session=True)
+    timed_out = threading.Event()
+    def kill():
+        timed_out.set()
+        logger.warning('Rebuild of bucket=%s timed out after %ss, killing it', bucketname, timeout)
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+    # Only the first relevant and the last error line are kept
+    outmsg = None
+    errmsg = None
+    try:
+        for raw in process.stdout:
+            line = raw.decode('utf-8', errors='replace').rstrip()
+            level = parse_line(line)
+            if level is None:
+                continue
+            if outmsg is None:
+                outmsg = line
+            if level == 'ERROR':
+                errmsg = line
+            log_event(workerid, bucketname, level, line)
+        process.wait()
+    finally:
+        if timer:
+            timer.cancel()
+        process.stdout.close()
+    rebuildend = time.time() * 1000
+    bucket_size_full = libc2f.getBucketSize(os.path.join(thaweddir,bucketname))
+    logFields.add('bucketsize_full_b', bucket_size_full)
+    logFields.add('rebuildtime_ms', round(rebuildend - rebuildstart,3))
+
+    reason = None
+    if process.returncode == 0 and not timed_out.is_set():
+        os.remove(marker)
+        status = 'SUCCESS'
+        logFields.add('status', 'rebuilt')
+    else:
+        status = 'ERROR'
+        if timed_out.is_set():
+            reason = 'timeout'
+        else:
+            reason = 'returncode_%s' % process.returncode
+        logFields.add('status', 'failed_rebuilt')
+        logFields.add('reason', reason)
+    summary = outmsg
+    if status == 'ERROR' and errmsg:
+        summary = errmsg
+    msg = '%s: %s - Rebuilding bucket %s\n%s' % (workerid, status, bucketname, summary)
+    print(msg, flush=True)
+    if outmsg and len(outmsg) > 0:
+        logFields.add('output', "'" + outmsg + "'")
+    if errmsg:
+        logFields.add('error', "'" + errmsg + "'")
+    logger.info(logFields.kvout())
+    if status == 'SUCCESS':
+        return ('rebuilt', None)
+    return ('failed_rebuilt', reason)
@@ -0,0 +1,283 @@
+from lib import libc2f
+from lib import libbuckets
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import logging
+logger = logging.getLogger('splunk.cold2frozen')
+
+def _plan_index(storage, index: str, days: int, usectime: bool) -> dict:
+    # Initialize bucket container object, the listing has the archive times
+    # and on s3 the sizes as well
+    buckets = libbuckets.BucketIndex(index=index)
+    with libc2f.span('list'):
+        bucket_info = libc2f.listBucketsInfo(storage, index, sizes=False)
+    for bucket_name, info in bucket_info.items():
+        buckets.add(bucket_name, size=info['size'], archived=info['archived'])
+    if not usectime:
+        selected = buckets.older(days)
+    else:
+        selected = buckets.archived_older(days)
+    entries = []
+    for bucket_obj in selected:
+        size = bucket_obj.size
+        if size is None:
+            size = libc2f.getBucketSizeTarget(storage, os.path.join(index,bucket_obj.name))
+        entries.append([bucket_obj.name, size])
+    return {'count': len(entries), 'size_b': sum(entry[1] for entry in entries), 'buckets': entries}
+
+def build_plan(storage, index_list: list, days: int, usectime=False) -> dict:
+    """ Select the buckets to remove without removing anything """
+    plan = {
+        'created': int(time.time()),
+        'storage': storage.type,
+        'archive_dir': storage.archive_dir,
+        'days': days,
+        'usectime': usectime,
+        'indexes': {},
+    }
+    for index in index_list:
+        logger.debug("Planning Index %s", index)
+        plan['indexes'][index] = _plan_index(storage, index, days, usectime)
+    plan['count'] = sum(index['count'] for index in plan['indexes'].values())
+    plan['size_b'] = sum(index['size_b'] for index in plan['indexes'].values())
+    return plan
+
+class RetentionPolicy:
+    """ Maximum age, maximum archived size and minimum number of buckets to keep for an index """
+
+    def __init__(self, max_age_days=None, max_size_b=None, min_buckets=0):
+        self._max_age_days = max_age_days
+        self._max_size_b = max_size_b
+        self._min_buckets = min_buckets
+
+    def __str__(self) -> str:
+        return "max_age_days=%s, max_size_b=%s, min_buckets=%s" % (self._max_age_days, self._max_size_b, self._min_buckets)
+
+    @property
+    def max_age_days(self):
+        return self._max_age_days
+
+    @property
+    def max_size_b(self):
+        return self._max_size_b
+
+    @property
+    def min_buckets(self):
+        return self._min_buckets
+
+    def active(self) -> bool:
+        return self._max_age_days is not None or self._max_size_b is not None
+
+    def evaluate(self, buckets, now=None) -> list:
+        """ Returns the buckets to drop, oldest first, so that every limit is satisfied """
+        if now is None:
+            now = time.time()
+        cutoff = None
+        if self._max_age_days is not None:
+            cutoff = now - self._max_age_days * 86400
+        ordered = sorted(buckets, key=lambda bucket: (bucket.end, bucket.archived or 0))
+        total = sum(bucket.size or 0 for bucket in ordered)
+        keep = len(ordered)
+        drop = []
+        for bucket in ordered:
+            if keep <= self._min_buckets:
+                break
+            too_old = cutoff is not None and bucket.end <= cutoff
+            too_big = self._max_size_b is not None and total > self._max_size_b
+            # Buckets are ordered by age, so the first one within all limits ends the pass
+            if not too_old and not too_big:
+                break
+            drop.append(bucket)
+            total -= bucket.size or 0
+            keep -= 1
+        return drop
+
+def _policy_value(config, section: str, option: str, default):
+    if config.has_section(section) and config.has_option(section, option):
+        value = config.get(section, option).strip()
+        if value == '':
+            return None
+        if not value.isdigit():
+            msg = 'Value %s for %s in [%s] must be a number' % (value, option, section)
+            logger.error(msg)
+            raise Exception(msg)
+        return int(value)
+    return default
+
+def readPolicies(config):
+    """ Returns the default policy of the [retention] stanza and the ones of the [retention:<index>] stanzas """
+    def policy(section, default):
+        max_size_mb = _policy_value(config, section, 'MAX_SIZE_MB', None)
+        return RetentionPolicy(
+            max_age_days=_policy_value(config, section, 'MAX_AGE_DAYS', default.max_age_days if default else None),
+            max_size_b=max_size_mb * 1024 * 1024 if max_size_mb is not None else (default.max_size_b if default else None),
+            min_buckets=_policy_value(config, section, 'MIN_BUCKETS', default.min_buckets if default else 0),
+        )
+    default_policy = policy('retention', None)
+    index_policies = {}
+    for section in config.sections():
+        if section.startswith('retention:'):
+            index_policies[section.split(':', 1)[1]] = policy(section, default_policy)
+    return default_policy, index_policies
+
+def _plan_index_policy(storage, index: str, policy: RetentionPolicy, now: float) -> dict:
+    # Sizes are only needed to enforce a size quota
+    buckets = libbuckets.BucketIndex(index=index)
+    with libc2f.span('list'):
+        bucket_info = libc2f.listBucketsInfo(storage, index, sizes=policy.max_size_b is not None)
+    for bucket_name, info in bucket_info.items():
+        buckets.add(bucket_name, size=info['size'], archived=info['archived'])
+    entries = []
+    for bucket_obj in policy.evaluate(buckets, now):
+        size = bucket_obj.size
+        if size is None:
+            size = libc2f.getBucketSizeTarget(storage, os.path.join(index,bucket_obj.name))
+        entries.append([bucket_obj.name, size])
+    return {'count': len(entries), 'size_b': sum(entry[1] for entry in entries), 'buckets': entries, 'policy': str(policy)}
+
+def build_policy_plan(config, storage, index_list: list, numprocs=1) -> dict:
+    """ Evaluate the retention policies of all given indexes, one listing per index """
+    default_policy, index_policies = readPolicies(config)
+    now = time.time()
+    plan = {
+        'created': int(now),
+        'storage': storage.type,
+        'archive_dir': storage.archive_dir,
+        'policy': True,
+        'indexes': {},
+    }
+    local = threading.local()
+
+    def evaluate(index, policy):
+        # boto3 resources must not be shared between threads
+        if not hasattr(local, 'storage'):
+            local.storage = libc2f.connStorage(config)
+        logger.debug("Planning Index %s with policy %s", index, policy)
+        return _plan_index_policy(local.storage, index, policy, now)
+
+    with ThreadPoolExecutor(max_workers=numprocs) as pool:
+        futures = {}
+        for index in index_list:
+            policy = index_policies.get(index, default_policy)
+            if not policy.active():
+                continue
+            futures[index] = pool.submit(evaluate, index, policy)
+        for index, future in futures.items():
+            plan['indexes'][index] = future.result()
+    plan['count'] = sum(index['count'] for index in plan['indexes'].values())
+    plan['size_b'] = sum(index['size_b'] for index in plan['indexes'].values())
+    return plan
+
+def write_plan(plan: dict, plan_file: str) -> None:
+    tmp_file = plan_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(plan, f, separators=(',', ':'))
+    os.replace(tmp_file, plan_file)
+
+def read_plan(plan_file: str) -> dict:
+    if not os.path.isfile(plan_file):
+        msg = 'Plan file %s does not exist' % plan_file
+        logger.error(msg)
+        raise Exception(msg)
+    with open(plan_file, 'r') as f:
+        return json.load(f)
+
+def print_plan(plan: dict) -> None:
+    for index, entry in sorted(plan['indexes'].items()):
+        print("Index: %s, Buckets: %s, Size: %s" % (index, entry['count'], entry['size_b']))
+    print("Total: Buckets: %s, Size: %s" % (plan['count'], plan['size_b']))
+
+class PlanCheckpoint:
+    """ Buckets of a plan which are removed already, one 'index/bucket' line each """
+
+    def __init__(self, plan_file=None):
+        self._done_file = None
+        if plan_file:
+            self._done_file = plan_file + '.done'
+        self._lock = threading.Lock()
+        self._done = set()
+        if self._done_file and os.path.isfile(self._done_file):
+            with open(self._done_file, 'r') as f:
+                self._done = set(line.rstrip('\n') for line in f if line.strip())
+
+    def done(self, index: str, bucket_name: str) -> bool:
+        return os.path.join(index, bucket_name) in self._done
+
+    def record(self, index: str, bucket_name: str) -> None:
+        with self._lock:
+            self._done.add(os.path.join(index, bucket_name))
+            if not self._done_file:
+                return
+            with open(self._done_file, 'a') as f:
+                f.write(os.path.join(index, bucket_name) + '\n')
+
+def execute_plan(config, plan: dict, plan_file=None, numprocs=1, dryrun=False, metrics=None) -> int:
+    """ Remove the buckets of a plan with a pool of deletion threads, returns the number of failures.
+        Progress is checkpointed next to the plan file if one is given. """
+    storage = libc2f.connStorage(config)
+    if storage.type != plan['storage'] or storage.archive_dir != plan['archive_dir']:
+        msg = 'Plan %s was created for %s:%s, not for %s:%s' % (plan_file, plan['storage'], plan['archive_dir'], storage.type, storage.archive_dir)
+        logger.error(msg)
+        raise Exception(msg)
+
+    checkpoint = PlanCheckpoint(plan_file)
+    local = threading.local()
+    failed = []
+
+    def remove(index: str, bucket_name: str, size: int) -> None:
+        logFields = libc2f.logDict()
+        logFields.add('status', None)
+        logFields.add('bucketname', bucket_name)
+        logFields.add('indexname', index)
+        logFields.add('bucketsize_b', size)
+        rmstart = time.time() * 1000
+        try:
+            # boto3 resources must not be shared between threads
+            if not hasattr(local, 'storage'):
+                local.storage = libc2f.connStorage(config)
+            destdir = libc2f.bucketDir(local.storage, os.path.join(index,bucket_name))
+            logFields.add('destdir', destdir)
+            if dryrun:
+                print("(Dryrun) Remove bucket (size_b: %s) %s" % (size, destdir))
+                return
+            with libc2f.span('remove'):
+                removed = libc2f.removeBucket(local.storage, index, bucket_name)
+        except (Exception, SystemExit) as ex:
+            logger.error('Failed to remove bucket=%s: %s', bucket_name, ex)
+            removed = False
+        metrics_labels = {'index': index, 'backend': storage.type}
+        if not removed:
+            if metrics:
+                metrics.record('remove', metrics_labels, 'failed_removed', (time.time() * 1000 - rmstart) / 1000)
+            logFields.add('status', 'failed_removed')
+            logger.info(logFields.kvout())
+            failed.append(bucket_name)
+            return
+        rmend = time.time() * 1000
+        logFields.add('rmtime_ms', round(rmend - rmstart,3))
+        logFields.add('status', 'removed')
+        logger.info(logFields.kvout())
+        if metrics:
+            metrics.record('remove', metrics_labels, 'removed', (rmend - rmstart) / 1000, size)
+        checkpoint.record(index, bucket_name)
+
+    futures = {}
+    with ThreadPoolExecutor(max_workers=numprocs) as pool:
+        for index, entry in plan['indexes'].items():
+            for bucket_name, size in entry['buckets']:
+                if checkpoint.done(index, bucket_name):
+                    logger.debug("Skipping removed bucket %s/%s", index, bucket_name)
+                    continue
+                futures[pool.submit(remove, index, bucket_name, size)] = bucket_name
+    # Errors after the removal, e.g. of the checkpoint, count as failed
+    for future, bucket_name in futures.items():
+        try:
+            future.result()
+        except Exception as ex:
+            logger.error('Failed to record removed bucket=%s: %s', bucket_name, ex)
+            failed.append(bucket_name)
+
+    return len(failed)
@@ -1,11 +1,27 @@
 import sys, os
+import json
+import math
 import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timezone
 import boto3
 import botocore
+from lib import libstats
+from lib import libchecksum
+from lib import libinventory
 import logging
 logger = logging.getLogger('splunk.cold2frozen')
 
+# Buckets are uploaded to their final prefix <index>/<bucket>/, a marker object
+# <index>/.staging/<bucket>/.uploading flags them as incomplete until the last
+# object is uploaded. bucket_exists and the listings skip flagged buckets, and
+# buckets archived without a marker are complete. Uploading in place writes
+# every object once, a server side copy would double the writes and requests.
+STAGING_DIR = '.staging'
+UPLOADING_MARKER = '.uploading'
+UPLOAD_THREADS = 8
+
 class c2fS3:
 
     def __init__(self, access_key: str, secret_key: str, s3_bucket: str, archive_dir: str, **kwargs):
@@ -20,10 +36,17 @@ class c2fS3:
         self._s3_resource = self._resource_s3(access_key=self._access_key, secret_key=self._secret_key, s3_endpoint=self._s3_endpoint, s3_verify_cert=self._s3_verify_cert)
         self._s3_bucket = self._s3_resource.Bucket(self._s3_bucket_name)
         self._s3_client = self._client_s3(access_key=self._access_key, secret_key=self._secret_key, s3_endpoint=self._s3_endpoint, s3_verify_cert=self._s3_verify_cert)
+        libstats.count_requests(self._s3_client)
+        libstats.count_requests(self._s3_resource.meta.client)
         self._is_valid_s3bucket(self._s3_bucket_name)
         self._is_writable_s3bucket(self._s3_bucket_name)
         if self._is_valid_archive_dir(archive_dir):
             self._archive_dir = os.path.join(archive_dir.strip('/'), '')
+        # Bucket listings from S3 Inventory reports instead of object listings
+        self._inventory = None
+        self._inventory_delta = kwargs.get('s3_inventory_delta', True)
+        if kwargs.get('s3_inventory'):
+            self._inventory = libinventory.open_inventory(kwargs['s3_inventory'], self._s3_client, self._archive_dir, kwargs.get('s3_inventory_cache_dir'))
 
     @property
     def type(self):
@@ -70,9 +93,9 @@ class c2fS3:
     def _is_dir(self, s3_path: str) -> bool:
         """Returns T/F whether the directory exists."""
         s3_path = os.path.join(s3_path.strip('/'), '')
-        logger.debug("Checking path s3://%s/%s" % (self._s3_bucket_name, s3_path))
+        logger.debug("Checking path s3://%s/%s", self._s3_bucket_name, s3_path)
         objects = list(self._s3_bucket.objects.filter(Prefix=s3_path, MaxKeys=1, limit=1))
-        logger.debug("Checking path s3://%s/%s - done" % (self._s3_bucket_name, s3_path))
+        logger.debug("Checking path s3://%s/%s - done", self._s3_bucket_name, s3_path)
         return len(objects) >= 1
 
     def _is_valid_archive_dir(self, s3_path: str) -> bool:
@@ -87,20 +110,108 @@ class c2fS3:
         full_path = os.path.join(self._archive_dir, path).strip('/')
         return full_path
 
+    def _staging_path(self, destdir: str) -> str:
+        return os.path.join(os.path.dirname(destdir), STAGING_DIR, os.path.basename(destdir))
+
+    def _list_objects(self, prefix: str) -> dict:
+        paginator = self._s3_client.get_paginator('list_objects_v2')
+        objects = {}
+        for page in paginator.paginate(Bucket=self._s3_bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                objects[obj['Key']] = {'size': obj['Size'], 'etag': obj['ETag'].strip('"')}
+        return objects
+
+    def _delete_prefix(self, prefix: str) -> bool:
+        # Delete each listed page (up to 1000 keys) with a single request
+        paginator = self._s3_client.get_paginator('list_objects_v2')
+        removed = True
+        for page in paginator.paginate(Bucket=self._s3_bucket_name, Prefix=prefix):
+            keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if not keys:
+                continue
+            response = self._s3_client.delete_objects(Bucket=self._s3_bucket_name, Delete={'Objects': keys, 'Quiet': True})
+            for error in response.get('Errors', []):
+                logger.error('Cannot remove object s3://%s/%s: %s', self._s3_bucket_name, error['Key'], error.get('Message'))
+                removed = False
+        return removed
+
+    def _find_upload(self, key: str):
+        """ Id of the newest unfinished multipart upload of a key """
+        response = self._s3_client.list_multipart_uploads(Bucket=self._s3_bucket_name, Prefix=key)
+        uploads = [upload for upload in response.get('Uploads', []) if upload['Key'] == key]
+        if not uploads:
+            return None
+        return max(uploads, key=lambda upload: upload['Initiated'])['UploadId']
+
+    def _multipart_upload(self, source_file: str, key: str, size: int) -> None:
+        part_size = libchecksum.partSize(size)
+        upload_id = self._find_upload(key)
+        done = {}
+        if upload_id is None:
+            upload_id = self._s3_client.create_multipart_upload(Bucket=self._s3_bucket_name, Key=key)['UploadId']
+        else:
+            logger.debug("Resuming upload of %s", key)
+            paginator = self._s3_client.get_paginator('list_parts')
+            for page in paginator.paginate(Bucket=self._s3_bucket_name, Key=key, UploadId=upload_id):
+                for part in page.get('Parts', []):
+                    done[part['PartNumber']] = part
+
+        def upload_part(number: int) -> dict:
+            offset = (number - 1) * part_size
+            length = min(part_size, size - offset)
+            with open(source_file, 'rb') as f:
+                f.seek(offset)
+                data = f.read(length)
+            # A part uploaded before is kept if it has the same content
+            part = done.get(number)
+            if part and part['Size'] == length and part['ETag'].strip('"') == hashlib.md5(data).hexdigest():
+                libstats.count('upload_part_skipped')
+                return {'PartNumber': number, 'ETag': part['ETag']}
+            response = self._s3_client.upload_part(Bucket=self._s3_bucket_name, Key=key, UploadId=upload_id, PartNumber=number, Body=data)
+            libstats.add_bytes('archive', length)
+            return {'PartNumber': number, 'ETag': response['ETag']}
+
+        with ThreadPoolExecutor(max_workers=UPLOAD_THREADS) as pool:
+            parts = list(pool.map(upload_part, range(1, math.ceil(size / part_size) + 1)))
+        self._s3_client.complete_multipart_upload(Bucket=self._s3_bucket_name, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+
+    def _upload_file(self, source_file: str, key: str, staged) -> None:
+        size = os.path.getsize(source_file)
+        # A complete object from an earlier attempt is kept if its ETag matches
+        if staged and staged['size'] == size and staged['etag'] == libchecksum.fileChecksums(source_file)[1]:
+            logger.debug("Skipping uploaded file %s", key)
+            libstats.count('upload_skipped')
+            return
+        logger.debug("Uploading file %s to %s", source_file, key)
+        if size < libchecksum.PART_SIZE:
+            with open(source_file, 'rb') as f:
+                self._s3_client.put_object(Bucket=self._s3_bucket_name, Key=key, Body=f)
+            libstats.add_bytes('archive', size)
+        else:
+            self._multipart_upload(source_file, key, size)
+
+    def _uploading(self, full_index_dir: str) -> set:
+        """ Names of the buckets of an index whose upload is not complete """
+        staging_dir = os.path.join(full_index_dir, STAGING_DIR, '')
+        return set(self._list_bucket_names(staging_dir))
+
+    @libstats.timed('index_exists')
     def index_exists(self, indexname: str) -> bool:
         indexdir = self._full_path(indexname)
-        logger.debug("Checking for index directory %s" % indexdir)
+        logger.debug("Checking for index directory %s", indexdir)
         if self._is_dir(indexdir):
             return True
         else:
             return False
 
+    @libstats.timed('create_index_dir')
     def create_index_dir(self, indexname: str) -> None:
         indexdir = self._full_path(indexname)
         if not self.index_exists(indexname):
-            logger.debug("Creating index directory %s" % indexdir)
+            logger.debug("Creating index directory %s", indexdir)
             self._s3_client.put_object(Bucket=self._s3_bucket_name, Key=(indexdir+'/'))
 
+    @libstats.timed('check_lock_file')
     def check_lock_file(self, lock_file: str) -> bool:
         full_lock_file = self._full_path(lock_file)
         try:
@@ -109,73 +220,105 @@ class c2fS3:
             return False
         return True
 
+    @libstats.timed('lock_file_age')
     def lock_file_age(self, lock_file: str) -> str:
         full_lock_file = self._full_path(lock_file)
-        logger.debug("Checking age for lockfile %s" % full_lock_file)
+        logger.debug("Checking age for lockfile %s", full_lock_file)
         obj = self._s3_resource.Object(self._s3_bucket_name, full_lock_file).get()
         lock_age_datetime = (obj["LastModified"])
         from datetime import timezone
         lock_age = lock_age_datetime.replace(tzinfo=timezone.utc).timestamp()
         return lock_age
 
+    @libstats.timed('write_lock_file')
     def write_lock_file(self, lock_file: str, hostname: str) -> bool:
         full_lock_file = self._full_path(lock_file)
         try:
             self._s3_resource.Object(self._s3_bucket_name, full_lock_file).put(Body=hostname)
         except:
             return False
-        logger.debug("Created lockfile %s" % full_lock_file)
+        logger.debug("Created lockfile %s", full_lock_file)
         return True
 
+    @libstats.timed('acquire_lock')
+    def acquire_lock(self, lock_file: str, hostname: str, ttl: int) -> bool:
+        # Without conditional writes this is a check then create, stale locks
+        # are not taken over
+        if self.check_lock_file(lock_file):
+            return False
+        return self.write_lock_file(lock_file, hostname)
+
+    @libstats.timed('renew_lock')
+    def renew_lock(self, lock_file: str, ttl: int) -> bool:
+        """ Rewrites the lock file, so its age (LastModified) starts again """
+        if not self.check_lock_file(lock_file):
+            return False
+        return self.write_lock_file(lock_file, self.read_lock_file(lock_file))
+
+    @libstats.timed('read_lock_file')
     def read_lock_file(self, lock_file: str) -> str:
         full_lock_file = self._full_path(lock_file)
-        logger.debug("Reading lockfile %s" % full_lock_file)
+        logger.debug("Reading lockfile %s", full_lock_file)
         obj = self._s3_resource.Object(self._s3_bucket_name, full_lock_file).get()
         hostname = obj["Body"].read().decode("utf-8")
         return hostname
 
+    @libstats.timed('remove_lock_file')
     def remove_lock_file(self, lock_file: str) -> None:
         full_lock_file = self._full_path(lock_file)
         if self.check_lock_file(lock_file):
             self._s3_client.delete_object(Bucket=self._s3_bucket_name, Key=full_lock_file)
-            logger.debug("Removed lockfile %s" % full_lock_file)
+            logger.debug("Removed lockfile %s", full_lock_file)
 
+    @libstats.timed('bucket_dir')
     def bucket_dir(self, bucket_dir: str) -> str:
         full_bucket_dir = "s3://%s/%s" % (self._s3_bucket_name, self._full_path(bucket_dir))
         return full_bucket_dir
 
+    @libstats.timed('bucket_exists')
     def bucket_exists(self, bucket_dir: str) -> bool:
         full_bucket_dir = self._full_path(bucket_dir)
-        if self._is_dir(full_bucket_dir):
+        # A bucket with a staging prefix left is not committed completely
+        if self._is_dir(full_bucket_dir) and not self._is_dir(self._full_path(self._staging_path(bucket_dir))):
             return True
         else:
             return False
 
+    @libstats.timed('bucket_size')
     def bucket_size(self, bucketPath: str) -> int:
         size = 0
         full_bucket_dir = self._full_path(bucketPath)
         for obj in self._s3_resource.Bucket(self._s3_bucket_name).objects.filter(Prefix=full_bucket_dir):
-            logger.debug("Getting size for file %s" % obj)
+            logger.debug("Getting size for file %s", obj)
             size += obj.size
         return size
 
+    @libstats.timed('bucket_copy')
     def bucket_copy(self, bucket: str, destdir: str) -> None:
         full_bucket_dir = self._full_path(destdir)
+        staging_dir = os.path.join(self._full_path(self._staging_path(destdir)), '')
         try:
+            # Flag the bucket as incomplete before its first object
+            self._s3_client.put_object(Bucket=self._s3_bucket_name, Key=staging_dir + UPLOADING_MARKER, Body=b'')
+            # Resume an interrupted upload, complete objects are skipped
+            uploaded = self._list_objects(os.path.join(full_bucket_dir, ''))
             for root,dirs,files in os.walk(bucket):
                 for file in files:
                     source_file = os.path.join(root,file)
                     relative_path = os.path.relpath(source_file, bucket)
-                    dest_file = os.path.join(full_bucket_dir, relative_path)
-                    logger.debug("Uploading file %s to %s" % (source_file,dest_file))
-                    self._s3_client.upload_file(source_file,self._s3_bucket_name,dest_file)
+                    target_file = os.path.join(full_bucket_dir, relative_path)
+                    self._upload_file(source_file, target_file, uploaded.get(target_file))
+            # Removes the marker, and objects staged by earlier versions
+            if not self._delete_prefix(staging_dir):
+                raise Exception('Cannot remove staging prefix %s' % staging_dir)
         except Exception:
             msg = 'Failed to copy bucket %s to destination %s' % (bucket, full_bucket_dir)
             logger.error(msg)
             sys.exit(msg)
 
+    @libstats.timed('list_indexes')
     def list_indexes(self): 
-        logger.debug("Listing indexes for path s3://%s/%s" % (self._s3_bucket_name, self._archive_dir))
+        logger.debug("Listing indexes for path s3://%s/%s", self._s3_bucket_name, self._archive_dir)
         response = self._s3_client.list_objects(Bucket=self._s3_bucket_name, Prefix=self._archive_dir, Delimiter='/')
         index_list = []
         for index in response['CommonPrefixes']:
@@ -183,17 +326,73 @@ class c2fS3:
             index_list.append(index_name)
         return index_list
 
-    def list_buckets(self, index: str):
-        full_bucket_dir = self._full_path(index) + str('/')
-        logger.debug("Listing buckets for path s3://%s/%s" % (self._s3_bucket_name, full_bucket_dir))
-        buckets = list(self._s3_bucket.objects.filter(Prefix=full_bucket_dir))
+    def _list_bucket_names(self, full_bucket_dir: str) -> list:
+        """ Bucket names below an index prefix from a delimiter listing, one entry per bucket instead of per object """
+        paginator = self._s3_client.get_paginator('list_objects_v2')
         bucket_list = []
-        for bucket in buckets:
-            bucket_name = os.path.relpath(bucket.key, full_bucket_dir).split('/', 1)[0]
-            if (bucket_name.startswith('db') or bucket_name.startswith('rb')) and not bucket_name in bucket_list:
-                bucket_list.append(bucket_name)
+        for page in paginator.paginate(Bucket=self._s3_bucket_name, Prefix=full_bucket_dir, Delimiter='/'):
+            for prefix in page.get('CommonPrefixes', []):
+                bucket_name = prefix['Prefix'][len(full_bucket_dir):].strip('/')
+                if bucket_name.startswith('db') or bucket_name.startswith('rb'):
+                    bucket_list.append(bucket_name)
         return bucket_list
+
+    def _add_objects(self, bucket_info: dict, full_bucket_dir: str, prefix: str) -> None:
+        """ Adds size, object count and archive time of the listed objects to bucket_info """
+        paginator = self._s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self._s3_bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                bucket_name = obj['Key'][len(full_bucket_dir):].split('/', 1)[0]
+                if not (bucket_name.startswith('db') or bucket_name.startswith('rb')):
+                    continue
+                archived = obj['LastModified'].replace(tzinfo=timezone.utc).timestamp()
+                info = bucket_info.get(bucket_name)
+                if info is None:
+                    info = bucket_info[bucket_name] = {'size': 0, 'objects': 0, 'archived': archived}
+                info['size'] += obj['Size']
+                info['objects'] += 1
+                if archived > info['archived']:
+                    info['archived'] = archived
+
+    @libstats.timed('list_buckets')
+    def list_buckets(self, index: str):
+        full_bucket_dir = self._full_path(index) + str('/')
+        logger.debug("Listing buckets for path s3://%s/%s", self._s3_bucket_name, full_bucket_dir)
+        if self._inventory is not None and not self._inventory_delta:
+            return list(self._inventory.buckets(index))
+        uploading = self._uploading(full_bucket_dir)
+        return [bucket_name for bucket_name in self._list_bucket_names(full_bucket_dir) if bucket_name not in uploading]
  
+    @libstats.timed('list_buckets_info')
+    def list_buckets_info(self, index: str, sizes: bool = True) -> dict:
+        """ Size, object count and archive time (newest LastModified) per bucket from one paginated listing,
+            or from the inventory with a live listing of the buckets archived since """
+        full_bucket_dir = self._full_path(index) + str('/')
+        bucket_info = {}
+        if self._inventory is None:
+            logger.debug("Listing bucket info for path s3://%s/%s", self._s3_bucket_name, full_bucket_dir)
+            self._add_objects(bucket_info, full_bucket_dir, full_bucket_dir)
+            for bucket_name in self._uploading(full_bucket_dir):
+                bucket_info.pop(bucket_name, None)
+            return bucket_info
+        inventory = self._inventory.buckets(index)
+        if not self._inventory_delta:
+            return {bucket_name: dict(info) for bucket_name, info in inventory.items()}
+        # Buckets removed since the inventory are not listed any more, new ones are listed object by object
+        new_buckets = 0
+        uploading = self._uploading(full_bucket_dir)
+        for bucket_name in self._list_bucket_names(full_bucket_dir):
+            if bucket_name in uploading:
+                continue
+            if bucket_name in inventory:
+                bucket_info[bucket_name] = dict(inventory[bucket_name])
+            else:
+                self._add_objects(bucket_info, full_bucket_dir, os.path.join(full_bucket_dir, bucket_name, ''))
+                new_buckets += 1
+        logger.debug("Listed bucket info for path s3://%s/%s from inventory, buckets=%s new_buckets=%s", self._s3_bucket_name, full_bucket_dir, len(bucket_info), new_buckets)
+        return bucket_info
+
+    @libstats.timed('restore_bucket')
     def restore_bucket(self, index: str, bucket_name: str, destdir: str):
         full_bucket_dir = self._full_path(os.path.join(index,bucket_name))
         objects = self._s3_bucket.objects.filter(Prefix=full_bucket_dir)
@@ -206,10 +405,64 @@ class c2fS3:
                 os.makedirs(object_dir)
             
             self._s3_client.download_file(self._s3_bucket_name, object.key, os.path.join(destdir,object_partdir))
+            libstats.add_bytes('restore', object.size)
 
-    def remove_bucket(self, index: str, bucket_name: str):
-        full_bucket_dir = self._full_path(os.path.join(index,bucket_name))
-        objects = self._s3_bucket.objects.filter(Prefix=full_bucket_dir)
-        logger.debug("Remove bucket s3://%s/%s" % (self._s3_bucket_name, full_bucket_dir))
-        for object in objects:
-            self._s3_client.delete_object(Bucket=self._s3_bucket_name, Key=object.key)
\ No newline at end of file
+    @libstats.timed('remove_bucket')
+    def remove_bucket(self, index: str, bucket_name: str) -> bool:
+        full_bucket_dir = os.path.join(self._full_path(os.path.join(index,bucket_name)), '')
+        logger.debug("Remove bucket s3://%s/%s", self._s3_bucket_name, full_bucket_dir)
+        removed = self._delete_prefix(full_bucket_dir)
+        if removed:
+            self._s3_client.delete_object(Bucket=self._s3_bucket_name, Key=self._full_path(libchecksum.manifestPath(index, bucket_name)))
+        return removed
+
+    @libstats.timed('write_checksums')
+    def write_checksums(self, index: str, bucket_name: str, manifest: dict) -> None:
+        full_manifest = self._full_path(libchecksum.manifestPath(index, bucket_name))
+        self._s3_client.put_object(Bucket=self._s3_bucket_name, Key=full_manifest, Body=json.dumps(manifest, separators=(',', ':')))
+        logger.debug("Wrote checksums s3://%s/%s", self._s3_bucket_name, full_manifest)
+
+    @libstats.timed('read_checksums')
+    def read_checksums(self, index: str, bucket_name: str):
+        full_manifest = self._full_path(libchecksum.manifestPath(index, bucket_name))
+        try:
+            obj = self._s3_client.get_object(Bucket=self._s3_bucket_name, Key=full_manifest)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return json.loads(obj['Body'].read().decode('utf-8'))
+
+    @libstats.timed('bucket_files')
+    def bucket_files(self, index: str, bucket_name: str) -> dict:
+        """ Key, size and ETag per object of an archived bucket, keyed by the path relative to the bucket """
+        full_bucket_dir = os.path.join(self._full_path(os.path.join(index,bucket_name)), '')
+        paginator = self._s3_client.get_paginator('list_objects_v2')
+        bucket_files = {}
+        for page in paginator.paginate(Bucket=self._s3_bucket_name, Prefix=full_bucket_dir):
+            for obj in page.get('Contents', []):
+                bucket_files[obj['Key'][len(full_bucket_dir):]] = {'key': obj['Key'], 'size': obj['Size'], 'etag': obj['ETag'].strip('"'), 'mtime': obj['LastModified'].timestamp()}
+        return bucket_files
+
+    @libstats.timed('open_file')
+    def open_file(self, entry: dict):
+        """ Streaming body of an object listed by bucket_files, the client is safe to share between threads """
+        obj = self._s3_client.get_object(Bucket=self._s3_bucket_name, Key=entry['key'])
+        libstats.add_bytes('download', obj['ContentLength'])
+        return obj['Body']
+
+    @libstats.timed('object_checksum')
+    def object_checksum(self, key: str):
+        """ Stored full object SHA256 checksum of an object (base64), None if there is none """
+        response = self._s3_client.head_object(Bucket=self._s3_bucket_name, Key=key, ChecksumMode='ENABLED')
+        checksum = response.get('ChecksumSHA256')
+        # Checksums of multipart uploads are composite checksums of the parts
+        if checksum is None or '-' in checksum:
+            return None
+        return checksum
+
+    @libstats.timed('hash_object')
+    def hash_object(self, key: str) -> str:
+        obj = self._s3_client.get_object(Bucket=self._s3_bucket_name, Key=key)
+        libstats.add_bytes('download', obj['ContentLength'])
+        return libchecksum.hashStream(obj['Body'])
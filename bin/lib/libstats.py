@@ -0,0 +1,91 @@
+import re
+import time
+import threading
+import functools
+from contextlib import contextmanager
+
+# Timing spans, request counters and byte counters of the running process.
+# Every value is kept twice: for the current window, which an entry point
+# resets per bucket, and as a total over the whole run.
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = self._empty()
+        self._total = self._empty()
+
+    def _empty(self) -> dict:
+        return {'spans': {}, 'counts': {}, 'bytes': {}}
+
+    def _add(self, kind: str, name: str, value) -> None:
+        with self._lock:
+            for window in (self._current, self._total):
+                window[kind][name] = window[kind].get(name, 0) + value
+
+    def add_time(self, name: str, ms: float) -> None:
+        self._add('spans', name, ms)
+
+    def count(self, name: str, n: int = 1) -> None:
+        self._add('counts', name, n)
+
+    def add_bytes(self, name: str, n: int) -> None:
+        self._add('bytes', name, n)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._current = self._empty()
+
+    def fields(self, total: bool = False) -> dict:
+        """ Log fields t_<span>_ms, n_<request> and bytes_<name> """
+        with self._lock:
+            window = self._total if total else self._current
+            fields = {}
+            for name, ms in sorted(window['spans'].items()):
+                fields['t_%s_ms' % name] = round(ms, 3)
+            for name, n in sorted(window['counts'].items()):
+                fields['n_%s' % name] = n
+            for name, n in sorted(window['bytes'].items()):
+                fields['bytes_%s' % name] = n
+            return fields
+
+_stats = Stats()
+
+@contextmanager
+def span(name: str):
+    start = time.time() * 1000
+    try:
+        yield
+    finally:
+        _stats.add_time(name, time.time() * 1000 - start)
+
+def timed(name: str):
+    """ Decorator counting the calls of a function and timing them as a span """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            _stats.count(name)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name: str, n: int = 1) -> None:
+    _stats.count(name, n)
+
+def add_bytes(name: str, n: int) -> None:
+    _stats.add_bytes(name, n)
+
+def reset() -> None:
+    _stats.reset()
+
+def fields(total: bool = False) -> dict:
+    return _stats.fields(total)
+
+def _snake(name: str) -> str:
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', name).lower()
+
+def count_requests(client, prefix: str = 's3') -> None:
+    """ Count every API request of a botocore client, e.g. n_s3_head_object """
+    def before_call(model, **kwargs):
+        _stats.count('%s_%s' % (prefix, _snake(model.name)))
+    client.meta.events.register('before-call.s3', before_call)
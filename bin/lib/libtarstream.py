@@ -0,0 +1,148 @@
+from lib import libstats
+import os, sys
+import io
+import gzip
+import queue
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import logging
+logger = logging.getLogger('splunk.cold2frozen')
+
+# zstandard is optional, without it the tar stream can be compressed with gz or xz
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Archived buckets written as one tar stream, e.g. to stdout for ssh. The tar is
+# written in file order by one thread, while a pool fetches the upcoming files
+# into memory. Fetched but unwritten files are bounded by a byte budget, files
+# larger than a quarter of it are streamed when their turn comes.
+
+COMPRESSIONS = ('none', 'gz', 'xz', 'zstd')
+CHUNK_SIZE = 8 * 1024 * 1024
+
+class Budget:
+    """ Bytes of prefetched files held in memory """
+
+    def __init__(self, budget: int):
+        self._budget = budget
+        self._used = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def reserve(self, size: int) -> None:
+        with self._cond:
+            while not self._closed and self._used > 0 and self._used + size > self._budget:
+                self._cond.wait()
+            self._used += size
+
+    def close(self) -> None:
+        """ Stops waiting for releases, the writer is gone """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def release(self, size: int) -> None:
+        with self._cond:
+            self._used -= size
+            self._cond.notify_all()
+
+def _nearest(storage, index: str, bucket_name: str):
+    if storage.type == 'tier':
+        return storage.nearest(os.path.join(index,bucket_name))
+    return storage
+
+def _read(storage, entry: dict) -> bytes:
+    with storage.open_file(entry) as f:
+        return f.read()
+
+def _tarinfo(name: str, entry: dict) -> tarfile.TarInfo:
+    info = tarfile.TarInfo(name)
+    info.size = entry['size']
+    info.mtime = int(entry.get('mtime', 0))
+    info.mode = 0o644
+    return info
+
+def open_output(path: str, compression: str = 'none'):
+    """ Returns the file objects to close after the tarfile, outermost first, and the
+        tarfile writing a stream to them, '-' is stdout """
+    raw = sys.stdout.buffer if path == '-' else open(path, 'wb')
+    fileobj = raw
+    if compression == 'zstd':
+        if zstandard is None:
+            raw.close()
+            msg = 'Python module zstandard is required for a zstd compressed tar stream'
+            logger.error(msg)
+            raise Exception(msg)
+        fileobj = zstandard.ZstdCompressor(level=3, threads=-1).stream_writer(raw, closefd=False)
+    elif compression == 'gz':
+        # The gz stream of tarfile always uses level 9, several times slower for little gain
+        fileobj = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6)
+    mode = 'w|xz' if compression == 'xz' else 'w|'
+    # The raw file is closed explicitly, so errors like ENOSPC of its last write are raised
+    outputs = [fileobj, raw] if fileobj is not raw else [raw]
+    return outputs, tarfile.open(fileobj=fileobj, mode=mode, bufsize=CHUNK_SIZE)
+
+def write_tar(storage, index: str, bucket_names: list, tar, numprocs: int = 4, memory_b: int = 256 * 1024 * 1024) -> dict:
+    """ Adds the buckets as <bucket>/<file> to tar, returns the file and byte count """
+    budget = Budget(memory_b)
+    max_prefetch = memory_b // 4
+    # Fetched files in tar order, a bounded queue keeps the lookahead finite also for tiny files
+    pending = queue.Queue(maxsize=max(16, numprocs * 4))
+    stopped = threading.Event()
+
+    def produce(pool) -> None:
+        try:
+            for bucket_name in bucket_names:
+                backend = _nearest(storage, index, bucket_name)
+                for relpath, entry in sorted(backend.bucket_files(index, bucket_name).items()):
+                    if stopped.is_set():
+                        return
+                    name = os.path.join(bucket_name, relpath)
+                    if entry['size'] > max_prefetch:
+                        pending.put((name, entry, backend, None))
+                        continue
+                    budget.reserve(entry['size'])
+                    pending.put((name, entry, backend, pool.submit(_read, backend, entry)))
+            pending.put(None)
+        except Exception as ex:
+            pending.put(ex)
+
+    files = written_b = 0
+    with ThreadPoolExecutor(max_workers=numprocs, thread_name_prefix='prefetch') as pool:
+        producer = threading.Thread(target=produce, args=(pool,), daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = pending.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                name, entry, backend, future = item
+                with libstats.span('stream'):
+                    if future is None:
+                        with backend.open_file(entry) as f:
+                            tar.addfile(_tarinfo(name, entry), f)
+                    else:
+                        data = future.result()
+                        tar.addfile(_tarinfo(name, entry), io.BytesIO(data))
+                        del data
+                        budget.release(entry['size'])
+                files += 1
+                written_b += entry['size']
+                libstats.add_bytes('stream', entry['size'])
+        finally:
+            # Unblock the producer, e.g. after the reader of the pipe went away
+            stopped.set()
+            budget.close()
+            while producer.is_alive():
+                try:
+                    item = pending.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is not None and not isinstance(item, Exception) and item[3] is not None:
+                    item[3].cancel()
+    return {'files': files, 'bytes': written_b}
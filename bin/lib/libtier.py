@@ -0,0 +1,169 @@
+import os
+import time
+import threading
+import logging
+logger = logging.getLogger('splunk.cold2frozen')
+
+# Tiered archive: buckets are archived to a local c2fDir tier and replicated
+# to a c2fS3 tier by tier_replicate.py, which also evicts replicated buckets
+# from the local tier. Reads are served by the local tier if it has the bucket.
+
+class c2fTier:
+
+    def __init__(self, local, remote_factory):
+        self._type = 'tier'
+        self._local = local
+        # The remote tier is connected on first use, archiving to the local tier needs no WAN round trip
+        self._remote_factory = remote_factory
+        self._remote = None
+        self._remote_lock = threading.Lock()
+
+    @property
+    def type(self):
+        return self._type
+
+    @property
+    def archive_dir(self):
+        return self._local.archive_dir
+
+    @property
+    def local(self):
+        return self._local
+
+    @property
+    def remote(self):
+        with self._remote_lock:
+            if self._remote is None:
+                self._remote = self._remote_factory()
+            return self._remote
+
+    def nearest(self, bucket_dir: str):
+        """ The tier which has the bucket, preferring the local one """
+        if self._local.bucket_exists(bucket_dir):
+            return self._local
+        return self.remote
+
+    def index_exists(self, indexname: str) -> bool:
+        return self._local.index_exists(indexname) or self.remote.index_exists(indexname)
+
+    def create_index_dir(self, indexname: str) -> None:
+        self._local.create_index_dir(indexname)
+
+    # Bucket locks live on the local tier, where buckets are archived
+    def acquire_lock(self, lock_file: str, hostname: str, ttl: int) -> bool:
+        return self._local.acquire_lock(lock_file, hostname, ttl)
+
+    def renew_lock(self, lock_file: str, ttl: int) -> bool:
+        return self._local.renew_lock(lock_file, ttl)
+
+    def check_lock_file(self, lock_file: str) -> bool:
+        return self._local.check_lock_file(lock_file)
+
+    def lock_file_age(self, lock_file: str):
+        return self._local.lock_file_age(lock_file)
+
+    def write_lock_file(self, lock_file: str, hostname: str) -> bool:
+        return self._local.write_lock_file(lock_file, hostname)
+
+    def read_lock_file(self, lock_file: str) -> str:
+        return self._local.read_lock_file(lock_file)
+
+    def remove_lock_file(self, lock_file: str) -> None:
+        self._local.remove_lock_file(lock_file)
+
+    def bucket_dir(self, bucket_dir: str) -> str:
+        # Only a connected remote tier is asked, naming a bucket must not connect to s3
+        if self._remote is None or self._local.bucket_exists(bucket_dir) or not self.remote.bucket_exists(bucket_dir):
+            return self._local.bucket_dir(bucket_dir)
+        return self.remote.bucket_dir(bucket_dir)
+
+    def bucket_exists(self, bucket_dir: str) -> bool:
+        # Local tier only, so archiving never waits for s3. A bucket archived again
+        # after its eviction is not copied to s3 twice, tier_replicate.py finds it there.
+        return self._local.bucket_exists(bucket_dir)
+
+    def bucket_size(self, bucketPath: str) -> int:
+        return self.nearest(bucketPath).bucket_size(bucketPath)
+
+    def bucket_copy(self, bucket: str, destdir: str) -> None:
+        self._local.bucket_copy(bucket, destdir)
+
+    def list_indexes(self) -> list:
+        index_list = self._local.list_indexes()
+        return index_list + [index for index in self.remote.list_indexes() if index not in index_list]
+
+    def list_buckets(self, index: str) -> list:
+        return list(self.list_buckets_info(index, sizes=False))
+
+    def list_buckets_info(self, index: str, sizes: bool = True) -> dict:
+        bucket_info = {}
+        if self.remote.index_exists(index):
+            bucket_info.update(self.remote.list_buckets_info(index, sizes))
+        if self._local.index_exists(index):
+            bucket_info.update(self._local.list_buckets_info(index, sizes))
+        return bucket_info
+
+    def restore_bucket(self, index: str, bucket_name: str, destdir: str):
+        self.nearest(os.path.join(index,bucket_name)).restore_bucket(index, bucket_name, destdir)
+
+    def remove_bucket(self, index: str, bucket_name: str) -> bool:
+        removed = True
+        if self._local.bucket_exists(os.path.join(index,bucket_name)):
+            removed = self._local.remove_bucket(index, bucket_name)
+        if self.remote.bucket_exists(os.path.join(index,bucket_name)):
+            removed = self.remote.remove_bucket(index, bucket_name) and removed
+        return removed
+
+    def write_checksums(self, index: str, bucket_name: str, manifest: dict) -> None:
+        self._local.write_checksums(index, bucket_name, manifest)
+
+    def read_checksums(self, index: str, bucket_name: str):
+        manifest = self._local.read_checksums(index, bucket_name)
+        if manifest is None:
+            manifest = self.remote.read_checksums(index, bucket_name)
+        return manifest
+
+def replicate_bucket(local, remote, index: str, bucket_name: str) -> str:
+    """ Copies a bucket of the local tier to the remote tier, returns the status """
+    bucket_dir = os.path.join(index,bucket_name)
+    remote.create_index_dir(index)
+    try:
+        # The s3 copy is staged and resumes an interrupted replication
+        remote.bucket_copy(local.bucket_dir(bucket_dir), bucket_dir)
+    except SystemExit:
+        return 'failed_replicated'
+    manifest = local.read_checksums(index, bucket_name)
+    if manifest is not None:
+        remote.write_checksums(index, bucket_name, manifest)
+    if remote.bucket_size(bucket_dir) != local.bucket_size(bucket_dir):
+        return 'failed_size'
+    return 'replicated'
+
+def readTierPolicy(config):
+    """ Returns TIER_MAX_AGE_DAYS, TIER_MAX_SIZE_MB in bytes and TIER_REPLICATION_PROCS """
+    def value(option, default):
+        if config.has_option('cold2frozen', option) and config.get('cold2frozen', option).strip():
+            return config.getint('cold2frozen', option)
+        return default
+    max_size_mb = value('TIER_MAX_SIZE_MB', None)
+    return value('TIER_MAX_AGE_DAYS', None), max_size_mb * 1024 * 1024 if max_size_mb is not None else None, value('TIER_REPLICATION_PROCS', 4)
+
+def evict_candidates(buckets: list, max_age_days=None, max_size_b=None, now=None) -> list:
+    """ Replicated local buckets to evict, oldest archived first. buckets is a list of
+        (index, bucket_name, size, archived, replicated) tuples of the whole local tier. """
+    if now is None:
+        now = time.time()
+    total = sum(bucket[2] for bucket in buckets)
+    evict = []
+    for bucket in sorted(buckets, key=lambda bucket: bucket[3]):
+        index, bucket_name, size, archived, replicated = bucket
+        too_old = max_age_days is not None and archived < now - max_age_days * 86400
+        too_big = max_size_b is not None and total > max_size_b
+        if not too_old and not too_big:
+            break
+        # A bucket which is not replicated yet is kept, also over the capacity
+        if not replicated:
+            continue
+        evict.append(bucket)
+        total -= size
+    return evict
@@ -0,0 +1,101 @@
+from lib import libc2f
+from lib import libchecksum
+import os
+import threading
+import logging
+logger = logging.getLogger('splunk.cold2frozen')
+
+def _result(index: str, bucket_name: str) -> dict:
+    return {'index': index, 'bucket': bucket_name, 'files': 0, 'bytes': 0,
+            'missing': [], 'unexpected': [], 'mismatched': [], 'unverified': []}
+
+def _compare_listing(manifest: dict, listing: dict, result: dict) -> list:
+    """ Checks names and sizes, returns the files whose content needs to be checked """
+    expected = manifest['files']
+    result['unexpected'] = sorted(set(listing) - set(expected))
+    candidates = []
+    for relpath, entry in sorted(expected.items()):
+        if relpath not in listing:
+            result['missing'].append(relpath)
+        elif listing[relpath]['size'] != entry['size']:
+            result['mismatched'].append(relpath)
+        else:
+            candidates.append(relpath)
+    return candidates
+
+def status(result: dict) -> str:
+    if result['missing'] or result['unexpected'] or result['mismatched']:
+        return 'corrupt'
+    if result['unverified']:
+        return 'unverified'
+    return 'verified'
+
+class DirVerification:
+    """ Hashes the files of an archived bucket in a process pool, result() waits for them """
+
+    def __init__(self, storage, index: str, bucket_name: str, manifest: dict, pool):
+        self._manifest = manifest
+        self._result = _result(index, bucket_name)
+        listing = storage.bucket_files(index, bucket_name)
+        self._futures = {}
+        for relpath in _compare_listing(manifest, listing, self._result):
+            self._futures[relpath] = pool.submit(libchecksum.hashFile, listing[relpath]['path'])
+
+    def result(self) -> dict:
+        for relpath, future in self._futures.items():
+            size = self._manifest['files'][relpath]['size']
+            if future.result() != self._manifest['files'][relpath]['sha256']:
+                self._result['mismatched'].append(relpath)
+            self._result['files'] += 1
+            self._result['bytes'] += size
+            libc2f.add_bytes('verify', size)
+        return self._result
+
+def verify_s3(storage, index: str, bucket_name: str, manifest: dict, deep=False) -> dict:
+    """ Compares the ETags of the listing with the manifest. An ETag which does not
+        match (e.g. objects encrypted with SSE-KMS) is checked against the stored
+        SHA256 checksum, or with deep by downloading and hashing the object. """
+    result = _result(index, bucket_name)
+    listing = storage.bucket_files(index, bucket_name)
+    for relpath in _compare_listing(manifest, listing, result):
+        expected = manifest['files'][relpath]
+        obj = listing[relpath]
+        if obj['etag'] == expected['etag']:
+            matched = True
+        else:
+            checksum = storage.object_checksum(obj['key'])
+            if checksum is not None:
+                matched = checksum == libchecksum.s3Checksum(expected['sha256'])
+            elif deep:
+                matched = storage.hash_object(obj['key']) == expected['sha256']
+            else:
+                result['unverified'].append(relpath)
+                continue
+        if not matched:
+            result['mismatched'].append(relpath)
+        result['files'] += 1
+        result['bytes'] += expected['size']
+        libc2f.add_bytes('verify', expected['size'])
+    return result
+
+class VerifyCheckpoint:
+    """ Buckets verified already by an interrupted run, one 'index/bucket' line each """
+
+    def __init__(self, checkpoint_file=None):
+        self._checkpoint_file = checkpoint_file
+        self._lock = threading.Lock()
+        self._done = set()
+        if checkpoint_file and os.path.isfile(checkpoint_file):
+            with open(checkpoint_file, 'r') as f:
+                self._done = set(line.rstrip('\n') for line in f if line.strip())
+
+    def done(self, index: str, bucket_name: str) -> bool:
+        return os.path.join(index, bucket_name) in self._done
+
+    def record(self, index: str, bucket_name: str) -> None:
+        with self._lock:
+            self._done.add(os.path.join(index, bucket_name))
+            if not self._checkpoint_file:
+                return
+            with open(self._checkpoint_file, 'a') as f:
+                f.write(os.path.join(index, bucket_name) + '\n')
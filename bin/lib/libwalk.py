@@ -0,0 +1,136 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logging
+logger = logging.getLogger('splunk.cold2frozen')
+
+# Directory traversal for sizing and listing archives and buckets. Directories
+# are read with os.scandir, whose entries know their type without a stat, and
+# every file is stat-ed once through DirEntry.stat, which caches the result. On
+# network filesystems every stat is a round trip to the server, so there the
+# directories are read and the files stat-ed by a thread pool, in batches.
+
+NETWORK_FS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ceph', 'glusterfs', 'lustre', 'gpfs', 'beegfs', 'fuse.sshfs', 'fuse.s3fs')
+NETWORK_THREADS = 16
+STAT_BATCH = 64
+
+_mounts = None
+_mounts_lock = threading.Lock()
+
+def _read_mounts() -> list:
+    """ (mount point, filesystem type) of all mounts, longest mount point first """
+    mounts = []
+    try:
+        with open('/proc/mounts', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 3:
+                    # Blanks in mount points are octal escapes
+                    mounts.append((fields[1].replace('\\040', ' '), fields[2]))
+    except OSError:
+        pass
+    return sorted(mounts, key=lambda mount: len(mount[0]), reverse=True)
+
+def fs_type(path: str):
+    """ Filesystem type of the mount holding path, None if unknown """
+    global _mounts
+    with _mounts_lock:
+        if _mounts is None:
+            _mounts = _read_mounts()
+    path = os.path.realpath(path)
+    for mount_point, mount_type in _mounts:
+        if path == mount_point or path.startswith(os.path.join(mount_point, '')):
+            return mount_type
+    return None
+
+def default_threads(path: str) -> int:
+    """ Threads for a traversal below path, a thread pool only pays off on network filesystems """
+    if fs_type(path) in NETWORK_FS:
+        return NETWORK_THREADS
+    return 1
+
+def _scandir(path: str):
+    """ Files and subdirectories of a directory, a missing directory is empty like with os.walk """
+    files, subdirs = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    # Like os.walk, symlinked directories are not followed
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                else:
+                    files.append(entry)
+    except OSError:
+        pass
+    return files, subdirs
+
+def _stat(entries: list) -> list:
+    return [(entry, entry.stat()) for entry in entries]
+
+def walk(roots: list, threads=None):
+    """ Yields (root, DirEntry, stat) of every file below the roots, unordered with threads > 1 """
+    if not roots:
+        return
+    if threads is None:
+        threads = default_threads(roots[0])
+    if threads <= 1:
+        for root in roots:
+            stack = [root]
+            while stack:
+                try:
+                    entries = os.scandir(stack.pop())
+                except OSError:
+                    continue
+                # Stat-ed while listing, without keeping the entries of large directories
+                with entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            if not entry.is_symlink():
+                                stack.append(entry.path)
+                        else:
+                            yield root, entry, entry.stat()
+        return
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = {pool.submit(_scandir, root): (root, True) for root in roots}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                root, is_dir = pending.pop(future)
+                if not is_dir:
+                    for entry, stat in future.result():
+                        yield root, entry, stat
+                    continue
+                files, subdirs = future.result()
+                for n in range(0, len(files), STAT_BATCH):
+                    pending[pool.submit(_stat, files[n:n + STAT_BATCH])] = (root, False)
+                for subdir in subdirs:
+                    pending[pool.submit(_scandir, subdir)] = (root, True)
+
+def tree_size(path: str, threads=None) -> int:
+    """ Size of all files below path """
+    return sum(stat.st_size for root, entry, stat in walk([path], threads))
+
+def tree_stats(paths: list, threads=None) -> dict:
+    """ Size and file count per path, the paths are walked together """
+    stats = {path: {'size': 0, 'objects': 0} for path in paths}
+    for root, entry, stat in walk(list(paths), threads):
+        stats[root]['size'] += stat.st_size
+        stats[root]['objects'] += 1
+    return stats
+
+def tree_files(path: str, threads=None) -> dict:
+    """ (path, stat) per file below path, keyed by the path relative to it """
+    return {os.path.relpath(entry.path, path): (entry.path, stat) for root, entry, stat in walk([path], threads)}
+
+def stat_entries(entries: list, threads=None) -> list:
+    """ (DirEntry, stat) of the entries of one directory listing, stat-ed in parallel on network filesystems """
+    if not entries:
+        return []
+    if threads is None:
+        threads = default_threads(os.path.dirname(entries[0].path))
+    if threads <= 1:
+        return _stat(entries)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        batches = pool.map(_stat, [entries[n:n + STAT_BATCH] for n in range(0, len(entries), STAT_BATCH)])
+        return [result for batch in batches for result in batch]
@@ -54,7 +54,7 @@ def main():
     normalized_bucket_name = bucket_name
     destdir = os.path.join(indexname, bucket_name)
     full_destdir = libc2f.bucketDir(storage, destdir)
-    logger.debug("destdir is %s" % full_destdir)
+    logger.debug("destdir is %s", full_destdir)
 
     # Create lockfile
     lock_file = os.path.join(os.path.dirname(destdir), normalized_bucket_name + ".lock")
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+# Purpose:
+# Replicates the buckets of the local tier of ARCHIVE_TYPE = tier to s3 and
+# evicts replicated buckets from the local tier by age (TIER_MAX_AGE_DAYS) or
+# capacity (TIER_MAX_SIZE_MB). Run it regularly, e.g. as a scripted input.
+
+from __future__ import print_function
+from lib import libc2f
+from lib import libtier
+from lib import libmetrics
+import os, sys
+import argparse
+import logging, logging.handlers
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Verify SPLUNK_HOME
+libc2f.verifySplunkHome()
+SPLUNK_HOME = os.environ['SPLUNK_HOME']
+
+# Create Logger
+from lib import liblogger
+logger = liblogger.setup_logging('splunk.cold2frozen')
+
+# To enable debugging
+#logger.setLevel(logging.DEBUG)
+
+def main():
+
+    # Define the App Path
+    app_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+    logger.debug('Starting main()')
+
+    # Argument Parser
+    parser = argparse.ArgumentParser(description='Replicate the local tier to s3 and evict replicated buckets')
+    parser.add_argument('-i','--index', metavar='index', dest='index', type=str, help='Index(es)', action='append', nargs='*', required=False)
+    parser.add_argument('-p','--numprocs', metavar='numprocs', dest='numprocs', type=int, help='Number of parallel replications (default TIER_REPLICATION_PROCS)', required=False)
+    parser.add_argument('-n','--no-evict', dest='no_evict', action="store_true", help='Replicate only, do not evict from the local tier')
+    parser.add_argument('-r','--dryrun', action="store_true", help='Only print the buckets to replicate and evict')
+
+    args = parser.parse_args()
+
+    # Read in config file
+    config = libc2f.readConfig(app_path)
+    # Get the storage handler
+    storage = libc2f.connStorage(config)
+    if storage.type != 'tier':
+        msg = 'Replication needs ARCHIVE_TYPE=tier, not %s' % storage.type
+        logger.error(msg)
+        sys.exit(msg)
+    # Get the metrics exporter
+    metrics = libmetrics.fromConfig(config)
+    max_age_days, max_size_b, numprocs = libtier.readTierPolicy(config)
+    if args.numprocs:
+        numprocs = args.numprocs
+
+    index_list = storage.local.list_indexes()
+    if args.index:
+        index_list = [index for index in index_list if index in args.index[0]]
+
+    local = threading.local()
+    # (index, bucket_name, size, archived, replicated) of every local bucket
+    buckets = []
+    failed = []
+
+    def replicate(index: str, bucket_name: str, size: int) -> bool:
+        # boto3 resources must not be shared between threads
+        if not hasattr(local, 'storage'):
+            local.storage = libc2f.connStorage(config)
+        logFields = libc2f.logDict()
+        logFields.add('status', None)
+        logFields.add('indexname', index)
+        logFields.add('bucketname', bucket_name)
+        logFields.add('bucketsize_b', size)
+        replstart = time.time()
+        try:
+            status = libtier.replicate_bucket(local.storage.local, local.storage.remote, index, bucket_name)
+        except Exception as ex:
+            logger.error('Failed to replicate bucket=%s: %s', bucket_name, ex)
+            status = 'failed_replicated'
+        seconds = time.time() - replstart
+        logFields.add('status', status)
+        logFields.add('replicatetime_ms', round(seconds * 1000, 3))
+        logger.info(logFields.kvout())
+        metrics.record('replicate', {'index': index, 'backend': 'tier'}, status, seconds, size if status == 'replicated' else None)
+        if status != 'replicated':
+            failed.append(bucket_name)
+        return status == 'replicated'
+
+    futures = {}
+    with ThreadPoolExecutor(max_workers=numprocs) as pool:
+        for index in index_list:
+            logger.debug("Replicating Index %s", index)
+            # One listing per tier and index, a bucket is replicated if s3 has it with the same size
+            with libc2f.span('list'):
+                local_info = storage.local.list_buckets_info(index, sizes=True)
+                remote_info = storage.remote.list_buckets_info(index, sizes=True) if storage.remote.index_exists(index) else {}
+            for bucket_name, info in local_info.items():
+                # The db and rb copies of a bucket are the same, s3 needs only one of them
+                counterpart = ('rb' if bucket_name.startswith('db') else 'db') + bucket_name[2:]
+                replicated = any(name in remote_info and remote_info[name]['size'] == info['size'] for name in (bucket_name, counterpart))
+                if not replicated:
+                    if args.dryrun:
+                        print("(Dryrun) Replicate bucket (size_b: %s) %s" % (info['size'], os.path.join(index,bucket_name)))
+                    else:
+                        futures[(index, bucket_name)] = pool.submit(replicate, index, bucket_name, info['size'])
+                buckets.append([index, bucket_name, info['size'], info['archived'], replicated])
+    for bucket in buckets:
+        if (bucket[0], bucket[1]) in futures:
+            bucket[4] = futures[(bucket[0], bucket[1])].result()
+
+    evicted = 0
+    if not args.no_evict:
+        for index, bucket_name, size, archived, replicated in libtier.evict_candidates([tuple(bucket) for bucket in buckets], max_age_days, max_size_b):
+            if args.dryrun:
+                print("(Dryrun) Evict bucket (size_b: %s) %s" % (size, os.path.join(index,bucket_name)))
+                continue
+            logFields = libc2f.logDict()
+            logFields.add('status', None)
+            logFields.add('indexname', index)
+            logFields.add('bucketname', bucket_name)
+            logFields.add('bucketsize_b', size)
+            # Evict under the bucket lock, so no archive of the same bucket runs meanwhile
+            lock_file = os.path.join(index, bucket_name.split('_', 1)[1] + '.lock')
+            if not libc2f.getLock(storage.local, lock_file, timeout=10):
+                logFields.add('status', 'lock_timeout')
+                logger.info(logFields.kvout())
+                continue
+            evictstart = time.time()
+            try:
+                removed = storage.local.remove_bucket(index, bucket_name)
+            finally:
+                libc2f.releaseLock(storage.local, lock_file)
+            logFields.add('status', 'evicted' if removed else 'failed_evicted')
+            logger.info(logFields.kvout())
+            if removed:
+                evicted += 1
+                metrics.record('evict', {'index': index, 'backend': 'tier'}, 'evicted', time.time() - evictstart, size)
+
+    # Totals of the whole run
+    logFields = libc2f.logDict()
+    logFields.add('status', 'summary')
+    logFields.add('localbuckets', len(buckets))
+    logFields.add('failed', len(failed))
+    logFields.add('evicted', evicted)
+    logFields.addstats(total=True)
+    logger.info(logFields.kvout())
+    metrics.flush()
+
+    if failed:
+        sys.exit('Replication failed for %s bucket(s)' % len(failed))
+
+if __name__ == "__main__":
+    main()
+    sys.exit()